@@ -0,0 +1,9 @@
+"""Micro-benchmarks for the components that the swarm solver is built on.
+
+Run them from the mathy_python folder with `python -m benchmarks`."""
+from .micro import (  # noqa
+    BENCHMARKS,
+    compare_benchmarks,
+    run_benchmarks,
+    time_callable,
+)
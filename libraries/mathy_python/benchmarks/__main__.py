@@ -0,0 +1,73 @@
+import sys
+from typing import Optional, Tuple
+
+import click
+import srsly
+from wasabi import msg
+
+from .micro import BENCHMARKS, compare_benchmarks, run_benchmarks
+
+
+@click.command()
+@click.option(
+    "names",
+    "--only",
+    multiple=True,
+    type=click.Choice(list(BENCHMARKS.keys())),
+    help="Run only this benchmark (can be given more than once)",
+)
+@click.option("repeat", "--repeat", default=5, help="The number of timing repeats")
+@click.option(
+    "number",
+    "--number",
+    default=None,
+    type=int,
+    help="The number of calls per repeat (picked automatically by default)",
+)
+@click.option(
+    "output",
+    "--output",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the JSON results to this file instead of stdout",
+)
+@click.option(
+    "baseline",
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Saved JSON results to compare with",
+)
+@click.option(
+    "tolerance",
+    "--tolerance",
+    default=0.2,
+    help="How much slower than the baseline a benchmark can be before it fails",
+)
+def main(
+    names: Tuple[str, ...],
+    repeat: int,
+    number: Optional[int],
+    output: Optional[str],
+    baseline: Optional[str],
+    tolerance: float,
+):
+    """Run the solver micro-benchmarks and report the time per call as JSON."""
+    results = run_benchmarks(list(names) or None, repeat=repeat, number=number)
+    if output is not None:
+        srsly.write_json(output, results)
+        msg.good(f"Wrote results to {output}")
+    else:
+        print(srsly.json_dumps(results, indent=2))
+    if baseline is not None:
+        slowdowns = compare_benchmarks(results, srsly.read_json(baseline))
+        rows = [(name, f"{ratio:.2f}x") for name, ratio in slowdowns.items()]
+        msg.table(rows, header=("Benchmark", "vs baseline"), divider=True)
+        slower = [name for name, ratio in slowdowns.items() if ratio > 1 + tolerance]
+        if slower:
+            msg.fail(f"Slower than the baseline: {', '.join(slower)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Time the hot paths of `mathy.solver` in isolation, so that a drop in end-to-end
+throughput (see `mathy bench`) can be traced back to the stage that regressed.
+
+Each benchmark is a setup function that returns the callable to time, so that
+building envs and inputs isn't part of the measurement."""
+import random
+import timeit
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from mathy_core.parser import ExpressionParser
+from mathy_envs import MathyEnvState
+
+from mathy.solver import (
+    DiscreteMasked,
+    FragileEnvironment,
+    FragileMathyEnv,
+    decode_state,
+    encode_state,
+    mathy_dist,
+)
+
+# The problem that states are generated from
+PROBLEM = "4x + 2y + 3x^2 + 7z - 2x + 6y^2 + 2z + 3x + 8x^2"
+# The number of moves each walker state can make
+MAX_STEPS = 64
+# The length of the random walks that walker states are sampled from
+WALK_LENGTH = 8
+# Walker counts that the batched benchmarks run with
+WALKER_COUNTS = (16, 128, 512)
+
+
+def _env() -> FragileEnvironment:
+    return FragileEnvironment(name="mathy_v0", problem=PROBLEM, max_steps=MAX_STEPS)
+
+
+def _walker_states(
+    env: FragileEnvironment, count: int, seed: int = 1337
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return `count` walker state rows reached by random valid moves from the
+    problem, and a valid action for each of them."""
+    rng = random.Random(seed)
+    state, _ = env.reset()
+    states: List[np.ndarray] = []
+    actions: List[int] = []
+    steps = 0
+    while len(states) < count:
+        _, mask = env.observe(env.to_env_state(state))
+        action = rng.choice(np.nonzero(mask)[0].tolist())
+        states.append(state)
+        actions.append(action)
+        state, _, _, oob, info = env.step(action, state)
+        steps += 1
+        if oob or info["done"] or steps % WALK_LENGTH == 0:
+            state, _ = env.reset()
+    return np.stack(states), np.array(actions, dtype=np.int64)
+
+
+def bench_to_np() -> Callable[[], Any]:
+    state = MathyEnvState(problem=PROBLEM, max_moves=MAX_STEPS)
+    return lambda: state.to_np(2048)
+
+
+def bench_from_np() -> Callable[[], Any]:
+    codes = MathyEnvState(problem=PROBLEM, max_moves=MAX_STEPS).to_np(2048)
+    return lambda: MathyEnvState.from_np(codes)
+
+
+def bench_encode_state() -> Callable[[], Any]:
+    state = MathyEnvState(problem=PROBLEM, max_moves=MAX_STEPS)
+    return lambda: encode_state(state)
+
+
+def bench_decode_state() -> Callable[[], Any]:
+    codes = encode_state(MathyEnvState(problem=PROBLEM, max_moves=MAX_STEPS))
+    return lambda: decode_state(codes)
+
+
+def bench_parse() -> Callable[[], Any]:
+    parser = ExpressionParser()
+
+    def parse():
+        # Parsers cache their results by text, so start from an empty cache
+        parser.clear_cache()
+        return parser.parse(PROBLEM)
+
+    return parse
+
+
+def bench_parse_cached() -> Callable[[], Any]:
+    parser = ExpressionParser()
+    parser.parse(PROBLEM)
+    return lambda: parser.parse(PROBLEM)
+
+
+def bench_env_step() -> Callable[[], Any]:
+    env = _env()
+    states, actions = _walker_states(env, 1)
+    return lambda: env.step(int(actions[0]), states[0])
+
+
+def bench_step_batch(n_walkers: int) -> Callable[[], Callable[[], Any]]:
+    def setup() -> Callable[[], Any]:
+        env = _env()
+        states, actions = _walker_states(env, n_walkers)
+        return lambda: env.step_batch(actions, states)
+
+    return setup
+
+
+def bench_discrete_masked_sample(n_walkers: int) -> Callable[[], Callable[[], Any]]:
+    def setup() -> Callable[[], Any]:
+        env = FragileMathyEnv(name="mathy_v0", problem=PROBLEM, max_steps=MAX_STEPS)
+        model = DiscreteMasked(env=env)
+        env_states = env.reset(batch_size=n_walkers)
+        model_states = model.create_new_states(batch_size=n_walkers)
+        return lambda: model.sample(
+            batch_size=n_walkers, model_states=model_states, env_states=env_states
+        )
+
+    return setup
+
+
+def bench_mathy_dist(n_walkers: int) -> Callable[[], Callable[[], Any]]:
+    def setup() -> Callable[[], Any]:
+        env = _env()
+        states, _ = _walker_states(env, n_walkers)
+        observs = np.stack([env.observe(env.to_env_state(s))[0] for s in states])
+        shuffled = observs[np.random.RandomState(1337).permutation(n_walkers)]
+        return lambda: mathy_dist(observs, shuffled)
+
+    return setup
+
+
+BENCHMARKS: Dict[str, Callable[[], Callable[[], Any]]] = {
+    "to_np": bench_to_np,
+    "from_np": bench_from_np,
+    "encode_state": bench_encode_state,
+    "decode_state": bench_decode_state,
+    "parse": bench_parse,
+    "parse_cached": bench_parse_cached,
+    "env_step": bench_env_step,
+}
+for _count in WALKER_COUNTS:
+    BENCHMARKS[f"step_batch[{_count}]"] = bench_step_batch(_count)
+    BENCHMARKS[f"discrete_masked_sample[{_count}]"] = bench_discrete_masked_sample(
+        _count
+    )
+    BENCHMARKS[f"mathy_dist[{_count}]"] = bench_mathy_dist(_count)
+
+
+def time_callable(
+    fn: Callable[[], Any], repeat: int = 5, number: Optional[int] = None
+) -> Dict[str, Any]:
+    """Time a callable and return the best and median time per call in
+    microseconds. If `number` (of calls per repeat) isn't given, it is picked so
+    that each repeat takes at least 0.2 seconds."""
+    timer = timeit.Timer(fn)
+    if number is None:
+        number, _ = timer.autorange()
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+    return {
+        "number": number,
+        "repeat": repeat,
+        "best_us": float(times.min()),
+        "median_us": float(np.median(times)),
+        "ops_per_second": float(1e6 / times.min()) if times.min() > 0 else 0.0,
+    }
+
+
+def run_benchmarks(
+    names: Optional[Sequence[str]] = None,
+    repeat: int = 5,
+    number: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Run the named benchmarks (or all of them) and return a JSON serializable
+    result for each one."""
+    if names is None:
+        names = list(BENCHMARKS.keys())
+    results: List[Dict[str, Any]] = []
+    for name in names:
+        if name not in BENCHMARKS:
+            raise KeyError(f"unknown benchmark: {name}")
+        fn = BENCHMARKS[name]()
+        results.append(dict(name=name, **time_callable(fn, repeat, number)))
+    return results
+
+
+def compare_benchmarks(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]]
+) -> Dict[str, float]:
+    """Return the slowdown of each benchmark relative to a baseline run, as the
+    ratio of their best times (e.g. 1.5 is 50% slower than the baseline)."""
+    base = {result["name"]: result["best_us"] for result in baseline}
+    return {
+        result["name"]: result["best_us"] / base[result["name"]]
+        for result in results
+        if base.get(result["name"], 0) > 0
+    }
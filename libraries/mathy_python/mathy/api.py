@@ -1,9 +1,25 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
-from fragile.core.swarm import Swarm
+from mathy_envs import MathyEnv
+from mathy_envs.envs import PolySimplify
+from wasabi import msg
 
-from .solver import SwarmConfig, swarm_solve
+from .cache import SolutionCache
+from .solver import (
+    SolveResult,
+    SwarmConfig,
+    SwarmSolver,
+    budget_deadline,
+    iter_swarm_solve,
+    replay_solution,
+    swarm_solve,
+    swarm_solve_many,
+)
 
 
 @dataclass
@@ -12,23 +28,303 @@ class MathyAPISwarmState:
 
 
 class Mathy:
-    """The standard interface for working with Mathy models and agents."""
+    """The standard interface for working with Mathy models and agents.
+
+    The swarms (and processes) used to solve problems are kept alive between
+    calls so that only the first solve pays their startup cost. Call `close`
+    (or use the instance as a context manager) to release them.
+
+    With a `max_concurrency` above 1 the swarms of concurrent solves
+    (`asimplify`) step their walkers in their own thread, rather than each
+    starting worker processes."""
 
     state: MathyAPISwarmState
+    max_concurrency: int
 
     def __init__(
         self,
         *,
         config: Optional[SwarmConfig] = None,
         silent: bool = False,
+        max_concurrency: Optional[int] = None,
     ):
         if config is None:
             config = SwarmConfig()
         if not isinstance(config, SwarmConfig):
             raise ValueError("config must be a SwarmConfig instance")
+        if max_concurrency is None:
+            max_concurrency = os.cpu_count() or 1
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
         self.state = MathyAPISwarmState(config=config)
+        self.silent = silent
+        self.max_concurrency = max_concurrency
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_workers = 0
+        # Each thread that solves problems gets its own swarm
+        self._solvers: List[SwarmSolver] = []
+        self._solvers_lock = threading.Lock()
+        self._thread_state = threading.local()
+        self._cache: Optional[SolutionCache] = None
+        # The env that cached solution traces are replayed in
+        self._replay_env: Optional[MathyEnv] = None
+        self._replay_lock = threading.Lock()
+        if config.solution_cache is not None:
+            self._cache = SolutionCache(
+                config.solution_cache, max_entries=config.solution_cache_size
+            )
+
+    def __enter__(self) -> "Mathy":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Shut down the executors, process pool and swarms that were started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        with self._solvers_lock:
+            for solver in self._solvers:
+                solver.close()
+            self._solvers = []
+            self._thread_state = threading.local()
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    def _get_solver(self, concurrent: bool = False) -> SwarmSolver:
+        solver: Optional[SwarmSolver] = getattr(self._thread_state, "solver", None)
+        if solver is None:
+            config = self.state.config
+            if concurrent and self.max_concurrency > 1:
+                # Swarms that run at the same time would each start worker
+                # processes for every CPU, so they step in their own thread
+                config = config.copy(update={"use_mp": False})
+            solver = SwarmSolver(config)
+            self._thread_state.solver = solver
+            with self._solvers_lock:
+                self._solvers.append(solver)
+        return solver
+
+    def _get_pool(self, workers: Optional[int]) -> ProcessPoolExecutor:
+        workers = workers if workers is not None else os.cpu_count() or 1
+        if self._pool is not None and self._pool_workers != workers:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=workers)
+            self._pool_workers = workers
+        return self._pool
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self._executor
 
-    def simplify(self, *, problem: str, max_steps: Optional[int] = None) -> Swarm:
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Semaphores belong to the event loop they are first used with
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def simplify(self, *, problem: str, max_steps: Optional[int] = None) -> SolveResult:
+        """Simplify a problem, or return its solution from the config's
+        `solution_cache` if it has been solved before."""
+        steps = 256 if max_steps is None else max_steps
+        cached = self._get_cached(problem, steps)
+        if cached is not None:
+            if not self.silent:
+                source = "replayed" if cached.replayed else "cached"
+                msg.good(f"Solved! ({source}) {problem} = {cached.solution}")
+            return cached
+        result: SolveResult = swarm_solve(  # type:ignore
+            problem,
+            self.state.config,
+            max_steps=steps,
+            silent=self.silent,
+            solver=self._get_solver(),
+        )
+        self._put_cached(result, steps)
+        return result
+
+    def _get_cached(self, problem: str, max_steps: int) -> Optional[SolveResult]:
+        """Return the cached solution of a problem, or the result of replaying
+        the cached solution of a problem with the same template if that solves
+        it, or None."""
+        if self._cache is None:
+            return None
+        config = self.state.config
+        cached = self._cache.get(problem, config, max_steps)
+        if cached is not None:
+            return cached
+        trace = self._cache.get_trace(problem, config, max_steps)
+        if trace is None:
+            return None
+        with self._replay_lock:
+            if self._replay_env is None:
+                self._replay_env = PolySimplify()
+            replayed = replay_solution(problem, trace, self._replay_env, max_steps)
+        if replayed is not None:
+            self._cache.put(replayed, config, max_steps)
+        return replayed
+
+    def _put_cached(self, result: SolveResult, max_steps: int) -> None:
+        if self._cache is not None:
+            self._cache.put(result, self.state.config, max_steps)
+
+    def simplify_many(
+        self,
+        *,
+        problems: List[str],
+        workers: Optional[int] = None,
+        max_steps: Optional[int] = None,
+        time_budget_ms: Optional[int] = None,
+    ) -> List[SolveResult]:
+        """Simplify many independent problems in parallel using a pool of
+        `workers` processes (defaults to the number of CPUs). If given,
+        `time_budget_ms` bounds the wall time of the whole batch."""
+        pool = self._get_pool(workers)
         if max_steps is not None:
-            return swarm_solve(problem, self.state.config, max_steps=max_steps)
-        return swarm_solve(problem, self.state.config)
+            return swarm_solve_many(
+                problems,
+                self.state.config,
+                max_steps=max_steps,
+                workers=workers,
+                time_budget_ms=time_budget_ms,
+                pool=pool,
+            )
+        return swarm_solve_many(
+            problems,
+            self.state.config,
+            workers=workers,
+            time_budget_ms=time_budget_ms,
+            pool=pool,
+        )
+
+    def iter_simplify(
+        self,
+        *,
+        problems: Iterable[str],
+        workers: Optional[int] = None,
+        max_steps: Optional[int] = None,
+        time_budget_ms: Optional[int] = None,
+    ) -> Iterator[Tuple[int, SolveResult]]:
+        """Simplify problems in parallel and yield (index, result) tuples in the
+        order that they finish, where index is the position of the problem in
+        the input. The input can be any iterable, and is consumed lazily. If
+        given, `time_budget_ms` bounds the wall time of the whole batch."""
+        pool = self._get_pool(workers)
+        if max_steps is not None:
+            return iter_swarm_solve(
+                problems,
+                self.state.config,
+                max_steps=max_steps,
+                workers=workers,
+                time_budget_ms=time_budget_ms,
+                pool=pool,
+            )
+        return iter_swarm_solve(
+            problems,
+            self.state.config,
+            workers=workers,
+            time_budget_ms=time_budget_ms,
+            pool=pool,
+        )
+
+    async def asimplify(
+        self,
+        *,
+        problem: str,
+        max_steps: Optional[int] = None,
+        time_budget_ms: Optional[int] = None,
+    ) -> SolveResult:
+        """Simplify a problem without blocking the event loop. At most
+        `max_concurrency` problems are solved at once, and the others wait
+        their turn. If the awaiting task is cancelled, the swarm stops before
+        its next iteration and its slot is released once it has stopped.
+
+        If given, `time_budget_ms` bounds the wall time of the call, including
+        the time spent waiting for a free slot."""
+        return await self._asimplify(
+            problem, max_steps, budget_deadline(time_budget_ms)
+        )
+
+    async def _asimplify(
+        self, problem: str, max_steps: Optional[int], deadline: Optional[float]
+    ) -> SolveResult:
+        steps = 256 if max_steps is None else max_steps
+        stop = threading.Event()
+        async with self._get_semaphore():
+            future = self._get_executor().submit(
+                self.solve_in_thread, problem, steps, stop.is_set, deadline
+            )
+            try:
+                return await asyncio.wrap_future(future)
+            except asyncio.CancelledError:
+                stop.set()
+                # Hold the slot until the swarm has actually stopped
+                if not future.cancel():
+                    try:
+                        await asyncio.wrap_future(future)
+                    except BaseException:
+                        pass
+                raise
+
+    def warm_up(self) -> None:
+        """Create the swarm that `solve_in_thread` uses in the calling thread,
+        so that the first problem it solves doesn't pay the startup cost."""
+        self._get_solver(concurrent=True)
+
+    def solve_in_thread(
+        self,
+        problem: str,
+        max_steps: int = 256,
+        should_stop: Optional[Callable[[], bool]] = None,
+        deadline: Optional[float] = None,
+    ) -> SolveResult:
+        """Simplify a problem with the swarm of the calling thread (or return
+        its cached solution), as one of up to `max_concurrency` threads that
+        solve problems at the same time. The search stops early when
+        `should_stop` returns True or at the `deadline` timestamp."""
+        cached = self._get_cached(problem, max_steps)
+        if cached is not None:
+            return cached
+        result = self._get_solver(concurrent=True).solve(
+            problem, max_steps, should_stop=should_stop, deadline=deadline
+        )
+        self._put_cached(result, max_steps)
+        return result
+
+    async def asimplify_many(
+        self,
+        *,
+        problems: Iterable[str],
+        max_steps: Optional[int] = None,
+        time_budget_ms: Optional[int] = None,
+    ) -> List[SolveResult]:
+        """Simplify many problems concurrently with `asimplify` and return
+        their results in input order. Cancelling the call stops all of the
+        swarms that are still running. If given, `time_budget_ms` bounds the
+        wall time of the whole batch."""
+        deadline = budget_deadline(time_budget_ms)
+        tasks = [
+            asyncio.ensure_future(self._asimplify(p, max_steps, deadline))
+            for p in problems
+        ]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
@@ -0,0 +1,174 @@
+"""End-to-end benchmarks that solve a fixed, seeded corpus of generated problems
+with the swarm solver and report solve rates, latencies and throughput."""
+import random
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .about import __version__
+from .solver import SolveResult, SwarmConfig, SwarmSolver
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type:ignore
+
+# The problem generators that benchmark corpora are drawn from by default
+BENCH_ENVIRONMENTS = ("poly", "binomial", "complex")
+
+# A corpus entry is the environment a problem came from and its text
+BenchProblem = Tuple[str, str]
+
+
+def bench_corpus(
+    environments: Tuple[str, ...] = BENCH_ENVIRONMENTS,
+    difficulty: str = "easy",
+    number: int = 20,
+    seed: int = 1337,
+) -> List[BenchProblem]:
+    """Generate `number` problems for each environment. Every environment is
+    seeded on its own, so the same seed always produces the same problems for
+    an environment no matter which others are in the corpus."""
+    import gym
+    from mathy_envs.gym import MathyGymEnv
+
+    corpus: List[BenchProblem] = []
+    for index, environment in enumerate(environments):
+        env: MathyGymEnv = gym.make(  # type:ignore
+            f"mathy-{environment}-{difficulty}-v0"
+        )
+        random.seed(seed + index)
+        np.random.seed(seed + index)
+        for _ in range(number):
+            _, problem = env.mathy.get_initial_state(
+                env.env_problem_args, print_problem=False
+            )
+            corpus.append((environment, problem.text))
+    return corpus
+
+
+def peak_rss_mb() -> Dict[str, Optional[float]]:
+    """Return the peak resident set size of this process and of its finished
+    child processes in megabytes, or None where it can't be measured."""
+    if resource is None:
+        return {"self": None, "children": None}
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+def summarize_results(results: List[SolveResult]) -> Dict[str, Any]:
+    """Return the solve rate, latency percentiles (in milliseconds), iteration
+    counts and env step throughput of a set of solves."""
+    latency = np.array([r.elapsed * 1000.0 for r in results], dtype=np.float64)
+    iterations = np.array([r.iterations for r in results], dtype=np.float64)
+    env_steps = sum(r.env_steps for r in results)
+    elapsed = sum(r.elapsed for r in results)
+    solved = sum(1 for r in results if r.solved)
+    return {
+        "problems": len(results),
+        "solved": solved,
+        "timed_out": sum(1 for r in results if r.timed_out),
+        "solve_rate": solved / max(len(results), 1),
+        "latency_ms": {
+            "mean": float(latency.mean()) if len(results) else 0.0,
+            "p50": float(np.percentile(latency, 50)) if len(results) else 0.0,
+            "p95": float(np.percentile(latency, 95)) if len(results) else 0.0,
+            "p99": float(np.percentile(latency, 99)) if len(results) else 0.0,
+        },
+        "iterations": {
+            "mean": float(iterations.mean()) if len(results) else 0.0,
+            "max": int(iterations.max()) if len(results) else 0,
+        },
+        "env_steps": env_steps,
+        "env_steps_per_second": env_steps / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def run_bench(
+    corpus: List[BenchProblem],
+    config: SwarmConfig,
+    max_steps: int = 20,
+    seed: int = 1337,
+) -> Dict[str, Any]:
+    """Solve each problem in a corpus one after another and return a JSON
+    serializable report of the results for each environment, and for the whole
+    corpus. The problems of each environment are solved by a swarm that uses
+    that environment's rules and win condition.
+
+    The swarms are created (and their worker processes started) before the
+    first solve, so startup time isn't counted in the latencies."""
+    from fragile.core.utils import random_state
+
+    solvers: Dict[str, SwarmSolver] = {}
+    by_env: Dict[str, List[SolveResult]] = {}
+    try:
+        for environment, _ in corpus:
+            if environment not in solvers:
+                env_config = config.copy(update={"environment": environment})
+                solvers[environment] = SwarmSolver(env_config)
+        random_state.seed(seed)
+        for environment, problem in corpus:
+            result = solvers[environment].solve(problem, max_steps)
+            by_env.setdefault(environment, []).append(result)
+    finally:
+        for solver in solvers.values():
+            solver.close()
+    return {
+        "version": __version__,
+        "config": {
+            "n_walkers": config.n_walkers,
+            "max_iters": config.max_iters,
+            "use_mp": config.use_mp,
+            "mp_backend": config.mp_backend,
+            "time_budget_ms": config.time_budget_ms,
+            "max_steps": max_steps,
+            "seed": seed,
+        },
+        "environments": {
+            environment: summarize_results(results)
+            for environment, results in by_env.items()
+        },
+        "total": summarize_results(
+            [result for results in by_env.values() for result in results]
+        ),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare_bench(
+    report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.1
+) -> List[str]:
+    """Compare a bench report with a baseline report and return a description
+    of each regression, or an empty list if there are none.
+
+    The solve rate regresses if it drops by more than `tolerance` (an absolute
+    fraction), and latencies or throughput regress if they get worse by more
+    than `tolerance` relative to the baseline."""
+    regressions: List[str] = []
+    groups = [("total", report["total"], baseline["total"])]
+    for environment, stats in report["environments"].items():
+        if environment in baseline["environments"]:
+            groups.append((environment, stats, baseline["environments"][environment]))
+    for name, current, base in groups:
+        if current["solve_rate"] < base["solve_rate"] - tolerance:
+            regressions.append(
+                f"{name}: solve rate fell from {base['solve_rate']:.2f} "
+                f"to {current['solve_rate']:.2f}"
+            )
+        for key in ("p50", "p95", "p99"):
+            now, then = current["latency_ms"][key], base["latency_ms"][key]
+            if then > 0 and now > then * (1.0 + tolerance):
+                regressions.append(
+                    f"{name}: {key} latency rose from {then:.1f}ms to {now:.1f}ms"
+                )
+        now, then = current["env_steps_per_second"], base["env_steps_per_second"]
+        if now < then * (1.0 - tolerance):
+            regressions.append(
+                f"{name}: env steps per second fell from {then:.0f} to {now:.0f}"
+            )
+    return regressions
@@ -0,0 +1,152 @@
+"""Solve a stream of problems, one per line, and write their results as JSON
+lines. Problems are read lazily and results are written as they finish, so
+memory use doesn't depend on the number of problems, and a job that stops part
+way through can be resumed from its output file."""
+import json
+import os
+import sys
+import time
+from dataclasses import asdict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+
+from .api import Mathy
+from .solver import SolveResult, SwarmConfig
+
+
+def iter_problems(
+    lines: Iterable[str], skip: Optional[Set[str]] = None
+) -> Iterator[Tuple[int, str]]:
+    """Yield a (line number, problem) tuple for each problem in lines of text,
+    leaving out blank lines, "#" comments and the problems in `skip`."""
+    for line_number, line in enumerate(lines, 1):
+        problem = line.strip()
+        if not problem or problem.startswith("#"):
+            continue
+        if skip is not None and problem in skip:
+            continue
+        yield line_number, problem
+
+
+def finished_problems(path: str) -> Set[str]:
+    """Return the problems that already have a result in a JSON lines file.
+
+    A job that was killed can leave a partly written last line, which is cut
+    off so that new results are appended on a line of their own."""
+    finished: Set[str] = set()
+    if not os.path.exists(path):
+        return finished
+    end = 0
+    with open(path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            end += len(line)
+            try:
+                finished.add(json.loads(line)["problem"])
+            except (ValueError, KeyError, TypeError):
+                continue
+    if end != os.path.getsize(path):
+        with open(path, "rb+") as file:
+            file.truncate(end)
+    return finished
+
+
+class ResultWriter:
+    """Write results to a text stream as JSON lines.
+
+    Lines are buffered and written together once `flush_every` results are
+    waiting or `flush_seconds` have passed since the last write, so a stopped
+    job loses at most that many results."""
+
+    def __init__(
+        self, stream: TextIO, flush_every: int = 64, flush_seconds: float = 1.0
+    ):
+        self.stream = stream
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self._lines: List[str] = []
+        self._last_flush = time.monotonic()
+
+    def write(self, result: SolveResult, line: Optional[int] = None) -> None:
+        row = asdict(result)
+        if line is not None:
+            row["line"] = line
+        self._lines.append(json.dumps(row) + "\n")
+        if (
+            len(self._lines) >= self.flush_every
+            or time.monotonic() - self._last_flush >= self.flush_seconds
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._lines:
+            self.stream.write("".join(self._lines))
+            self.written += len(self._lines)
+            self._lines = []
+        self.stream.flush()
+        self._last_flush = time.monotonic()
+
+
+def simplify_lines(
+    mathy: Mathy,
+    lines: Iterable[str],
+    writer: ResultWriter,
+    workers: Optional[int] = None,
+    max_steps: Optional[int] = None,
+    skip: Optional[Set[str]] = None,
+) -> Dict[str, int]:
+    """Solve the problems in lines of text across `workers` processes, write
+    each result (with the line its problem came from) as soon as it finishes,
+    and return the number of problems solved and unsolved.
+
+    Results are written in the order that they finish, not the input order."""
+    # The line numbers of the problems that have been handed to the workers,
+    # which are only kept until their results come back
+    pending: Dict[int, int] = {}
+
+    def problems() -> Iterator[str]:
+        for index, (line_number, problem) in enumerate(iter_problems(lines, skip)):
+            pending[index] = line_number
+            yield problem
+
+    counts = {"solved": 0, "unsolved": 0}
+    try:
+        for index, result in mathy.iter_simplify(
+            problems=problems(), workers=workers, max_steps=max_steps
+        ):
+            writer.write(result, pending.pop(index))
+            counts["solved" if result.solved else "unsolved"] += 1
+    finally:
+        writer.flush()
+    return counts
+
+
+def simplify_file(
+    config: SwarmConfig,
+    lines: Iterable[str],
+    output: Optional[str] = None,
+    workers: Optional[int] = None,
+    max_steps: Optional[int] = None,
+    resume: bool = False,
+) -> Dict[str, int]:
+    """Solve the problems in lines of text and append their results to the JSON
+    lines file at `output` (or write them to stdout if it is None or "-").
+
+    With `resume` the problems that already have results in `output` are
+    skipped. Returns the number of problems solved, unsolved and skipped."""
+    to_stdout = output is None or output == "-"
+    skip: Set[str] = set()
+    if resume and not to_stdout:
+        skip = finished_problems(output)  # type:ignore
+    stream = sys.stdout if to_stdout else open(output, "a", encoding="utf8")
+    try:
+        with Mathy(config=config, silent=True) as mathy:
+            counts = simplify_lines(
+                mathy, lines, ResultWriter(stream), workers, max_steps, skip
+            )
+    finally:
+        if not to_stdout:
+            stream.close()
+    counts["skipped"] = len(skip)
+    return counts
@@ -0,0 +1,265 @@
+"""A persistent cache of solved problems, so that repeated problems are answered
+without running a swarm.
+
+Besides exact problems the cache keeps the solution trace of each structural
+template, i.e. the problem with its variables renamed in order of appearance
+and its coefficients left out, so "4x + 2x" and "7y + 3y" share a template.
+Traces are replayed (and checked) on new problems of the same template before
+falling back to a search."""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from mathy_core import (
+    ConstantExpression,
+    MathExpression,
+    PowerExpression,
+    VariableExpression,
+)
+from mathy_core.parser import ExpressionParser
+
+from .about import __version__
+from .solver import SolveResult, SwarmConfig
+
+# The config fields that change which solution a swarm finds
+CACHE_CONFIG_FIELDS = ("n_walkers", "max_iters", "rule_weights")
+
+_parser = ExpressionParser()
+_parser_lock = threading.Lock()
+
+
+def normalize_problem(problem: str) -> str:
+    """Return the text of a problem as the parser prints it, so that problems
+    that only differ in whitespace share an entry. Problems that can't be
+    parsed are only stripped of extra whitespace."""
+    try:
+        with _parser_lock:
+            return str(_parser.parse(problem))
+    except Exception:
+        return " ".join(problem.split())
+
+
+def _template_tokens(
+    node: MathExpression, variables: Dict[str, str], out: List[str]
+) -> None:
+    if isinstance(node, VariableExpression):
+        name = variables.setdefault(node.identifier, f"v{len(variables)}")
+        out.append(name)
+        return
+    if isinstance(node, ConstantExpression):
+        out.append("#")
+        return
+    out.append(f"({type(node).__name__}")
+    for child in (node.left, node.right):
+        if child is None:
+            continue
+        if isinstance(node, PowerExpression) and child is node.right:
+            # Exponents decide which terms are alike, so they are kept
+            out.append(str(child))
+        else:
+            _template_tokens(child, variables, out)
+    out.append(")")
+
+
+def problem_template(problem: str) -> Optional[str]:
+    """Return the structural template of a problem, or None if it can't be
+    parsed. Variables are renamed in order of their first appearance, and
+    constants other than exponents are replaced with "#"."""
+    try:
+        with _parser_lock:
+            expression = _parser.parse(problem)
+    except Exception:
+        return None
+    out: List[str] = []
+    _template_tokens(expression, {}, out)
+    return " ".join(out)
+
+
+def _settings_key(text: str, config: SwarmConfig, max_steps: int) -> str:
+    settings: Dict[str, Any] = {
+        name: getattr(config, name) for name in CACHE_CONFIG_FIELDS
+    }
+    settings.update(max_steps=max_steps, version=__version__)
+    text = f"{text}\n{json.dumps(settings, sort_keys=True)}"
+    return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+
+def cache_key(problem: str, config: SwarmConfig, max_steps: int) -> str:
+    """Return the key of a problem solved with a config in `max_steps` moves."""
+    return _settings_key(normalize_problem(problem), config, max_steps)
+
+
+def template_key(problem: str, config: SwarmConfig, max_steps: int) -> Optional[str]:
+    """Return the key of a problem's template, or None if it has no template."""
+    template = problem_template(problem)
+    if template is None:
+        return None
+    return _settings_key(f"template:{template}", config, max_steps)
+
+
+class SolutionCache:
+    """Solved problems (and the traces of their templates) stored in a SQLite
+    database at `path`.
+
+    The database can be shared by many processes at once. Only solved results
+    are stored, and the least recently used problems (and templates) are
+    evicted once there are more than `max_entries` of them."""
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=30.0, isolation_level=None, check_same_thread=False
+        )
+        # WAL lets readers in other processes work while one process writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS solutions (
+                key TEXT PRIMARY KEY,
+                problem TEXT NOT NULL,
+                solution TEXT NOT NULL,
+                actions TEXT NOT NULL,
+                rules TEXT NOT NULL,
+                accessed REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS solutions_accessed ON solutions (accessed)"
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS templates (
+                key TEXT PRIMARY KEY,
+                template TEXT NOT NULL,
+                actions TEXT NOT NULL,
+                accessed REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS templates_accessed ON templates (accessed)"
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM solutions").fetchone()[0]
+
+    def get(
+        self, problem: str, config: SwarmConfig, max_steps: int = 256
+    ) -> Optional[SolveResult]:
+        """Return the cached result of a problem, or None if it isn't cached."""
+        start = time.perf_counter()
+        key = cache_key(problem, config, max_steps)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT solution, actions, rules FROM solutions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            try:
+                self._conn.execute(
+                    "UPDATE solutions SET accessed = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+            except sqlite3.OperationalError:
+                # Another process holds the write lock, the hit still counts
+                pass
+        solution, actions, rules = row
+        return SolveResult(
+            problem=problem,
+            solution=solution,
+            solved=True,
+            actions=[(rule, node) for rule, node in json.loads(actions)],
+            rules=json.loads(rules),
+            elapsed=time.perf_counter() - start,
+            cached=True,
+        )
+
+    def get_trace(
+        self, problem: str, config: SwarmConfig, max_steps: int = 256
+    ) -> Optional[List[Tuple[int, int]]]:
+        """Return the solution trace of a problem with the same template, or None
+        if the template isn't cached. The trace may not solve this problem, so
+        check it with `replay_solution`."""
+        key = template_key(problem, config, max_steps)
+        if key is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT actions FROM templates WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            try:
+                self._conn.execute(
+                    "UPDATE templates SET accessed = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+            except sqlite3.OperationalError:
+                pass
+        return [(rule, node) for rule, node in json.loads(row[0])]
+
+    def put(self, result: SolveResult, config: SwarmConfig, max_steps: int = 256):
+        """Store a result (and its trace for the problem's template) if it is
+        solved, and evict the least recently used entries if the cache is over
+        its size."""
+        if not result.solved or result.cached:
+            return
+        key = cache_key(result.problem, config, max_steps)
+        template = problem_template(result.problem)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if template is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?)",
+                        (
+                            template_key(result.problem, config, max_steps),
+                            template,
+                            json.dumps(result.actions),
+                            time.time(),
+                        ),
+                    )
+                    self._conn.execute(
+                        """DELETE FROM templates WHERE key IN (
+                            SELECT key FROM templates ORDER BY accessed DESC
+                            LIMIT -1 OFFSET ?
+                        )""",
+                        (self.max_entries,),
+                    )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO solutions VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        normalize_problem(result.problem),
+                        result.solution,
+                        json.dumps(result.actions),
+                        json.dumps(result.rules),
+                        time.time(),
+                    ),
+                )
+                self._conn.execute(
+                    """DELETE FROM solutions WHERE key IN (
+                        SELECT key FROM solutions ORDER BY accessed DESC
+                        LIMIT -1 OFFSET ?
+                    )""",
+                    (self.max_entries,),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM solutions")
+            self._conn.execute("DELETE FROM templates")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -5,6 +5,9 @@ Command line application for interacting with Mathy agents and environments.
 """
 
 import os
+import sys
+from typing import Optional, TextIO, Tuple
+
 import click
 from wasabi import msg
 
@@ -48,19 +51,481 @@ def cli_contribute():
     default=512,
     help="The max number of steps before the episode is over",
 )
-@click.argument("problem", type=str)
-def cli_simplify(problem: str, max_steps: int, single_process: bool, num_walkers: int):
-    """Simplify an input polynomial expression."""
+@click.option(
+    "mp_backend",
+    "--mp-backend",
+    default="pipe",
+    type=click.Choice(["pipe", "shared_memory"]),
+    help="How multiprocess swarms send walker data to their worker processes",
+)
+@click.option(
+    "profile",
+    "--profile",
+    is_flag=True,
+    help="Print the time spent in each phase of the swarm iterations",
+)
+@click.option(
+    "profile_trace",
+    "--profile-trace",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the swarm iteration phases to this Chrome trace-event JSON file",
+)
+@click.option(
+    "metrics_file",
+    "--metrics-file",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the solver metrics to this file in the Prometheus text format",
+)
+@click.option(
+    "cache",
+    "--cache",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="A SQLite file of solved problems to check (and add to) before solving",
+)
+@click.option(
+    "input_file",
+    "--input",
+    default=None,
+    type=click.File("r"),
+    help="Solve the problems in this file (one per line, or - for stdin)",
+)
+@click.option(
+    "output",
+    "--output",
+    default=None,
+    type=click.Path(dir_okay=False, allow_dash=True),
+    help="Write the results of --input problems to this JSON lines file",
+)
+@click.option(
+    "resume",
+    "--resume",
+    is_flag=True,
+    help="Skip the --input problems that already have results in --output",
+)
+@click.option(
+    "workers",
+    "--workers",
+    default=None,
+    type=int,
+    help="The number of processes solving --input problems (defaults to CPUs)",
+)
+@click.option(
+    "time_budget_ms",
+    "--time-budget-ms",
+    default=None,
+    type=int,
+    help="The max wall time in milliseconds to spend on each problem",
+)
+@click.argument("problem", type=str, required=False)
+def cli_simplify(
+    problem: Optional[str],
+    max_steps: int,
+    single_process: bool,
+    num_walkers: int,
+    mp_backend: str,
+    profile: bool,
+    profile_trace: Optional[str],
+    metrics_file: Optional[str],
+    cache: Optional[str],
+    input_file: Optional[TextIO],
+    output: Optional[str],
+    resume: bool,
+    workers: Optional[int],
+    time_budget_ms: Optional[int],
+):
+    """Simplify an input polynomial expression.
+
+    With --input the problems in a file are solved across a pool of processes
+    instead, and their results are written to --output (or stdout) as JSON
+    lines in the order that they finish. The solves happen in the pool's
+    processes, so --cache, --metrics-file and the profiling options can't be
+    used with --input."""
 
     from .api import Mathy
+    from .metrics import REGISTRY
+    from .solver import SwarmConfig
+
+    if (problem is None) == (input_file is None):
+        raise click.UsageError("Pass either a PROBLEM or an --input file")
+    if output is not None and input_file is None:
+        raise click.UsageError("--output requires an --input file")
+    if resume and output in (None, "-"):
+        raise click.UsageError("--resume requires an --output file")
+    if input_file is not None:
+        single_only = {
+            "--cache": cache,
+            "--metrics-file": metrics_file,
+            "--profile": profile,
+            "--profile-trace": profile_trace,
+        }
+        used = [name for name, value in single_only.items() if value]
+        if used:
+            raise click.UsageError(f"{', '.join(used)} can't be used with --input")
+    config = SwarmConfig(
+        use_mp=not single_process,
+        n_walkers=num_walkers,
+        verbose=True,
+        mp_backend=mp_backend,
+        profile=profile,
+        profile_trace=profile_trace,
+        solution_cache=cache,
+        time_budget_ms=time_budget_ms,
+        metrics=metrics_file is not None,
+    )
+    if input_file is not None:
+        from .bulk import simplify_file
+
+        counts = simplify_file(
+            config, input_file, output, workers, max_steps, resume=resume
+        )
+        if output not in (None, "-"):
+            if counts["skipped"]:
+                msg.info(f"Skipped {counts['skipped']} problems solved before")
+            msg.good(
+                f"Solved {counts['solved']}/{counts['solved'] + counts['unsolved']} "
+                f"problems, wrote results to {output}"
+            )
+    else:
+        with Mathy(config=config) as mt:
+            mt.simplify(problem=problem, max_steps=max_steps)
+    if profile_trace is not None:
+        msg.good(f"Wrote trace to {profile_trace}")
+    if metrics_file is not None:
+        REGISTRY.write_prometheus(metrics_file)
+        msg.good(f"Wrote metrics to {metrics_file}")
+
+
+@cli.command("bench")
+@click.option(
+    "environments",
+    "--env",
+    multiple=True,
+    default=["poly", "binomial", "complex"],
+    help="An environment to generate problems from (can be given more than once)",
+)
+@click.option(
+    "difficulty",
+    "--difficulty",
+    default="easy",
+    help="One of 'easy', 'normal', or 'hard'",
+)
+@click.option(
+    "number", "--number", default=20, help="The number of problems per environment"
+)
+@click.option("seed", "--seed", default=1337, help="The seed for the problem corpus")
+@click.option(
+    "single_process",
+    "--single-process",
+    default=os.name == "nt",
+    is_flag=True,
+    help="Use single-process execution with the swarm solver",
+)
+@click.option(
+    "max_steps",
+    "--max-steps",
+    default=20,
+    help="The max number of steps before the episode is over",
+)
+@click.option(
+    "num_walkers", "--num-walkers", default=512, help="The number of swarm walkers"
+)
+@click.option(
+    "mp_backend",
+    "--mp-backend",
+    default="pipe",
+    type=click.Choice(["pipe", "shared_memory"]),
+    help="How multiprocess swarms send walker data to their worker processes",
+)
+@click.option(
+    "time_budget_ms",
+    "--time-budget-ms",
+    default=None,
+    type=int,
+    help="The max wall time in milliseconds to spend on each problem",
+)
+@click.option(
+    "output",
+    "--output",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write the JSON report to this file instead of stdout",
+)
+@click.option(
+    "baseline",
+    "--baseline",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="A saved JSON report to compare the results with",
+)
+@click.option(
+    "tolerance",
+    "--tolerance",
+    default=0.1,
+    help="How much worse than the baseline a result can be before it fails",
+)
+def cli_bench(
+    environments: Tuple[str, ...],
+    difficulty: str,
+    number: int,
+    seed: int,
+    single_process: bool,
+    max_steps: int,
+    num_walkers: int,
+    mp_backend: str,
+    time_budget_ms: Optional[int],
+    output: Optional[str],
+    baseline: Optional[str],
+    tolerance: float,
+):
+    """Benchmark the swarm solver on a seeded corpus of generated problems.
+
+    Prints (or writes) a JSON report of the solve rate, latency percentiles,
+    iterations, env steps per second and peak memory use. With a baseline
+    report the command fails if any result regressed past the tolerance."""
+    import srsly
+
+    from .bench import bench_corpus, compare_bench, run_bench
+    from .solver import SwarmConfig
+
+    config = SwarmConfig(
+        use_mp=not single_process,
+        n_walkers=num_walkers,
+        mp_backend=mp_backend,
+        time_budget_ms=time_budget_ms,
+    )
+    corpus = bench_corpus(tuple(environments), difficulty, number, seed)
+    with msg.loading(f"Solving {len(corpus)} problems..."):
+        report = run_bench(corpus, config, max_steps=max_steps, seed=seed)
+    total = report["total"]
+    msg.info(
+        f"Solved {total['solved']}/{total['problems']} problems, "
+        f"p50 {total['latency_ms']['p50']:.1f}ms, "
+        f"p95 {total['latency_ms']['p95']:.1f}ms, "
+        f"{total['env_steps_per_second']:.0f} env steps/s",
+    )
+    if output is not None:
+        srsly.write_json(output, report)
+        msg.good(f"Wrote report to {output}")
+    else:
+        print(srsly.json_dumps(report, indent=2))
+    if baseline is not None:
+        regressions = compare_bench(report, srsly.read_json(baseline), tolerance)
+        if regressions:
+            for regression in regressions:
+                msg.fail(regression)
+            sys.exit(1)
+        msg.good("No regressions compared with the baseline")
+
+
+@cli.command("serve")
+@click.option("host", "--host", default="127.0.0.1", help="The address to listen on")
+@click.option("port", "--port", default=8080, help="The port to listen on")
+@click.option(
+    "workers", "--workers", default=1, help="The number of warm swarms solving problems"
+)
+@click.option(
+    "queue_size",
+    "--queue-size",
+    default=64,
+    help="The max number of queued requests before new ones are rejected",
+)
+@click.option(
+    "time_budget_ms",
+    "--time-budget-ms",
+    default=5000,
+    help="The default wall time budget for a request, including time queued",
+)
+@click.option(
+    "max_time_budget_ms",
+    "--max-time-budget-ms",
+    default=60000,
+    help="The max wall time budget that a request can ask for",
+)
+@click.option(
+    "single_process",
+    "--single-process",
+    default=os.name == "nt",
+    is_flag=True,
+    help="Use single-process execution with the swarm solver",
+)
+@click.option(
+    "max_steps",
+    "--max-steps",
+    default=20,
+    help="The default max number of steps before the episode is over",
+)
+@click.option(
+    "num_walkers", "--num-walkers", default=512, help="The number of swarm walkers"
+)
+@click.option(
+    "mp_backend",
+    "--mp-backend",
+    default="pipe",
+    type=click.Choice(["pipe", "shared_memory"]),
+    help="How multiprocess swarms send walker data to their worker processes",
+)
+@click.option(
+    "cache",
+    "--cache",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="A SQLite file of solved problems to check (and add to) before solving",
+)
+def cli_serve(
+    host: str,
+    port: int,
+    workers: int,
+    queue_size: int,
+    time_budget_ms: int,
+    max_time_budget_ms: int,
+    single_process: bool,
+    max_steps: int,
+    num_walkers: int,
+    mp_backend: str,
+    cache: Optional[str],
+):
+    """Serve a local HTTP/JSON API that solves problems with warm swarms.
+
+    POST {"problem": "4x + 2x"} to /simplify to solve a problem, optionally with
+    "max_steps" and "time_budget_ms". GET /health for the queue status, and
+    /metrics for the solver metrics in the Prometheus text format."""
+    from .server import SolverServer
+    from .solver import SwarmConfig
+
+    config = SwarmConfig(
+        use_mp=not single_process,
+        n_walkers=num_walkers,
+        mp_backend=mp_backend,
+        solution_cache=cache,
+    )
+    with msg.loading(f"Starting {workers} solver workers..."):
+        server = SolverServer(
+            config,
+            host=host,
+            port=port,
+            workers=workers,
+            queue_size=queue_size,
+            time_budget_ms=time_budget_ms,
+            max_time_budget_ms=max_time_budget_ms,
+            max_steps=max_steps,
+        )
+        server.start()
+    msg.good(f"Serving on http://{host}:{server.address[1]} (Ctrl+C to stop)")
+    server.serve_forever()
+
+
+@cli.command("generate")
+@click.argument("output", type=click.Path(file_okay=False))
+@click.option(
+    "environments",
+    "--env",
+    multiple=True,
+    default=["poly"],
+    help="An environment to generate problems from (can be given more than once)",
+)
+@click.option(
+    "difficulty",
+    "--difficulty",
+    default="easy",
+    help="One of 'easy', 'normal', or 'hard'",
+)
+@click.option(
+    "max_samples",
+    "--max-samples",
+    default=100000,
+    help="Stop once this many unique samples are written",
+)
+@click.option(
+    "max_seconds",
+    "--max-seconds",
+    default=None,
+    type=float,
+    help="Stop starting new problems after this many seconds",
+)
+@click.option(
+    "max_problems",
+    "--max-problems",
+    default=None,
+    type=int,
+    help="Stop after solving this many problems",
+)
+@click.option(
+    "shard_size", "--shard-size", default=100000, help="The number of samples per shard"
+)
+@click.option(
+    "shard_format",
+    "--format",
+    default="npz",
+    type=click.Choice(["npz", "npy"]),
+    help="Compressed .npz shards, or folders of .npy files that can be memory mapped",
+)
+@click.option(
+    "workers",
+    "--workers",
+    default=None,
+    type=int,
+    help="The number of processes running swarms (defaults to CPUs)",
+)
+@click.option(
+    "max_steps",
+    "--max-steps",
+    default=20,
+    help="The max number of steps before the episode is over",
+)
+@click.option(
+    "num_walkers", "--num-walkers", default=512, help="The number of swarm walkers"
+)
+@click.option(
+    "max_iters", "--max-iters", default=100, help="The max swarm iterations per problem"
+)
+@click.option("seed", "--seed", default=1337, help="The seed for generating problems")
+def cli_generate(
+    output: str,
+    environments: Tuple[str, ...],
+    difficulty: str,
+    max_samples: int,
+    max_seconds: Optional[float],
+    max_problems: Optional[int],
+    shard_size: int,
+    shard_format: str,
+    workers: Optional[int],
+    max_steps: int,
+    num_walkers: int,
+    max_iters: int,
+    seed: int,
+):
+    """Generate (state, action, reward) training samples from swarm searches.
+
+    Swarms solve generated problems across a pool of processes, and the unique
+    transitions their walkers take are written to numbered shards in the OUTPUT
+    folder as they are found, along with an index.json of the shards."""
+    from .generate import generate_samples
     from .solver import SwarmConfig
 
-    mt = Mathy(
-        config=SwarmConfig(
-            use_mp=not single_process, n_walkers=num_walkers, verbose=True
+    config = SwarmConfig(n_walkers=num_walkers, max_iters=max_iters)
+    with msg.loading(f"Generating up to {max_samples} samples..."):
+        index = generate_samples(
+            output,
+            config,
+            environments=tuple(environments),
+            difficulty=difficulty,
+            max_samples=max_samples,
+            max_seconds=max_seconds,
+            max_problems=max_problems,
+            shard_size=shard_size,
+            shard_format=shard_format,
+            workers=workers,
+            max_steps=max_steps,
+            seed=seed,
         )
+    msg.good(
+        f"Wrote {index['samples']} samples from {index['problems']} problems "
+        f"({index['duplicates']} duplicates skipped) to {len(index['shards'])} "
+        f"shards in {output}"
     )
-    mt.simplify(problem=problem, max_steps=max_steps)
 
 
 @cli.command("problems")
@@ -0,0 +1,80 @@
+"""Compact structural embeddings of mathy states, used as walker observations so
+that the swarm measures distances between states by their expression trees."""
+import zlib
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+from mathy_core import MathExpression, MathTypeKeys
+from mathy_core.util import get_term_ex, get_terms
+from mathy_envs import MathyEnvState
+
+# Operator types have the smallest ids and all variable types share one bucket
+STRUCTURE_TYPES = MathTypeKeys["abs"] + 1
+TYPE_FEATURES = STRUCTURE_TYPES + 1
+# depth, nodes, terms, like terms, distinct variables, constants, moves remaining
+SCALAR_FEATURES = 7
+# Internal nodes are counted in buckets by a hash of the shape of their subtree
+SUBTREE_BUCKETS = 32
+EMBEDDING_SIZE = TYPE_FEATURES + SCALAR_FEATURES + SUBTREE_BUCKETS
+# The index of the fraction of moves remaining, the only feature of a state's
+# embedding that doesn't come from its expression
+MOVES_FEATURE = TYPE_FEATURES + SCALAR_FEATURES - 1
+
+
+def _type_bucket(type_id: int) -> int:
+    return type_id if type_id < STRUCTURE_TYPES else STRUCTURE_TYPES
+
+
+def _embed_subtree(
+    node: MathExpression,
+    depth: int,
+    out: np.ndarray,
+    stats: Dict[str, int],
+    variables: Set[int],
+) -> int:
+    """Add the nodes of a subtree to the embedding and return the hash of its
+    shape. Constant values are left out of the hash, so "2x" and "3x" match."""
+    type_id = node.type_id
+    out[_type_bucket(type_id)] += 1
+    stats["depth"] = max(stats["depth"], depth)
+    if type_id >= STRUCTURE_TYPES:
+        variables.add(type_id)
+    if type_id == MathTypeKeys["constant"]:
+        stats["constants"] += 1
+    children = [child for child in (node.left, node.right) if child is not None]
+    if not children:
+        return zlib.crc32(str(type_id).encode())
+    hashes = [_embed_subtree(c, depth + 1, out, stats, variables) for c in children]
+    signature = zlib.crc32(f"{type_id}:{':'.join(map(str, hashes))}".encode())
+    out[TYPE_FEATURES + SCALAR_FEATURES + signature % SUBTREE_BUCKETS] += 1
+    return signature
+
+
+def embed_state(expression: MathExpression, env_state: MathyEnvState) -> np.ndarray:
+    """Return a fixed length float32 embedding of a state from its (parsed)
+    expression. It holds a histogram of node types, the depth of the tree, the
+    number of nodes, terms, like terms, distinct variables and constants, the
+    fraction of moves remaining, and counts of hashed subtree shapes."""
+    out = np.zeros(EMBEDDING_SIZE, dtype=np.float32)
+    stats = {"depth": 0, "constants": 0}
+    variables: Set[int] = set()
+    _embed_subtree(expression, 1, out, stats, variables)
+    terms = get_terms(expression)
+    signatures: List[Tuple[str, str]] = []
+    for term in terms:
+        term_ex = get_term_ex(term)
+        if term_ex is None:
+            signatures.append((str(term), ""))
+        else:
+            signatures.append((str(term_ex.variable), str(term_ex.exponent)))
+    agent = env_state.agent
+    out[TYPE_FEATURES : TYPE_FEATURES + SCALAR_FEATURES] = (
+        stats["depth"],
+        out[:TYPE_FEATURES].sum(),
+        len(terms),
+        len(signatures) - len(set(signatures)),
+        len(variables),
+        stats["constants"],
+        agent.moves_remaining / max(env_state.max_moves, 1),
+    )
+    return out
@@ -0,0 +1,390 @@
+"""Generate training data from swarm searches.
+
+Many swarms solve generated problems across a pool of processes, and the
+(state, action, reward) transitions their walkers take are streamed to shards on
+disk, with an index of the shards. Samples are deduplicated as they stream, with
+a fixed size Bloom filter, so neither the samples nor the swarm trees that
+produced them are held in memory."""
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from fragile.core.swarm import Swarm
+
+from .about import __version__
+from .solver import SwarmConfig, SwarmSolver
+
+# The arrays stored in each shard, one row per sample
+SAMPLE_FIELDS = ("states", "actions", "rewards")
+
+# The shard formats, either one compressed .npz file per shard or a folder of
+# .npy files per shard that can be loaded with `mmap_mode`
+SHARD_FORMATS = ("npz", "npy")
+
+# The serialized env states, actions and rewards of a batch of samples
+SampleBatch = Tuple[List[str], np.ndarray, np.ndarray]
+
+
+def state_text(row: np.ndarray) -> str:
+    """Return the serialized env state (see `MathyEnvState.to_string`) of an
+    encoded walker state row."""
+    return row.astype(np.uint32).tobytes().decode("utf-32-le").rstrip(" ")
+
+
+class SampleRecorder:
+    """Record the unique (state, action, reward) transitions that the walkers
+    of a swarm take, where the reward is that of the state the action leads to.
+
+    Walkers that had already finished before a step are left out."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self._texts: Dict[bytes, str] = {}
+        self._rewards: Dict[Tuple[bytes, int], float] = {}
+
+    def __len__(self) -> int:
+        return len(self._rewards)
+
+    def instrument(self, swarm: Swarm) -> None:
+        """Wrap the step of a swarm's env to record the transitions it makes."""
+        step = swarm.env.step
+
+        def recorded_step(model_states, env_states):
+            new_states = step(model_states=model_states, env_states=env_states)
+            self.record(
+                env_states.states,
+                model_states.actions,
+                new_states.rewards,
+                getattr(env_states, "terminals", None),
+            )
+            return new_states
+
+        swarm.env.step = recorded_step
+
+    def record(
+        self,
+        states: np.ndarray,
+        actions: np.ndarray,
+        rewards: np.ndarray,
+        terminals: Optional[np.ndarray] = None,
+    ) -> None:
+        for i in range(len(actions)):
+            if terminals is not None and terminals[i]:
+                continue
+            key = hashlib.blake2b(states[i].tobytes(), digest_size=16).digest()
+            if key not in self._texts:
+                self._texts[key] = state_text(states[i])
+            self._rewards.setdefault((key, int(actions[i])), float(rewards[i]))
+
+    def samples(self) -> SampleBatch:
+        texts = [self._texts[key] for key, _ in self._rewards]
+        actions = np.array([action for _, action in self._rewards], dtype=np.int32)
+        rewards = np.array(list(self._rewards.values()), dtype=np.float32)
+        return texts, actions, rewards
+
+
+class ProblemSampler:
+    """Generate problems from an environment and record the transitions of a
+    swarm solving them."""
+
+    def __init__(self, environment: str, difficulty: str, config: SwarmConfig):
+        import gym
+        from mathy_envs.gym import MathyGymEnv
+
+        self.env: MathyGymEnv = gym.make(  # type:ignore
+            f"mathy-{environment}-{difficulty}-v0"
+        )
+        # Search with the rules and win condition of the problems' environment
+        self.solver = SwarmSolver(config.copy(update={"environment": environment}))
+        self.recorder = SampleRecorder()
+        self.recorder.instrument(self.solver.swarm)
+
+    def sample(self, seed: int, max_steps: int) -> SampleBatch:
+        """Solve the problem generated with `seed` and return its samples."""
+        from fragile.core.utils import random_state
+
+        random.seed(seed)
+        np.random.seed(seed)
+        random_state.seed(seed)
+        _, problem = self.env.mathy.get_initial_state(
+            self.env.env_problem_args, print_problem=False
+        )
+        self.recorder.reset()
+        self.solver.solve(problem.text, max_steps)
+        return self.recorder.samples()
+
+
+# Samplers kept alive in pool worker processes by `sample_problem`
+_samplers: Dict[str, ProblemSampler] = {}
+
+
+def sample_problem(
+    environment: str,
+    difficulty: str,
+    seed: int,
+    config: SwarmConfig,
+    max_steps: int = 20,
+) -> SampleBatch:
+    """Solve a generated problem with a sampler that stays alive in the current
+    process, and return the transitions its walkers took. This is meant for
+    pool worker processes."""
+    key = json.dumps([environment, difficulty, config.json()])
+    sampler = _samplers.get(key)
+    if sampler is None:
+        sampler = _samplers[key] = ProblemSampler(environment, difficulty, config)
+    return sampler.sample(seed, max_steps)
+
+
+class SeenFilter:
+    """A Bloom filter of the keys that have been seen, sized to hold `capacity`
+    keys with a false positive rate of about `error_rate`.
+
+    Its memory use is fixed (about 1.8 bytes per key at the default rate), at
+    the cost of treating a few unseen keys as seen."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if not 0.0 < error_rate < 1.0:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.n_bits = max(
+            8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        )
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+
+    def add(self, key: bytes) -> bool:
+        """Add a key, and return True if it hadn't been seen before."""
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        new = False
+        for i in range(self.n_hashes):
+            bit = (first + i * second) % self.n_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                new = True
+        return new
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    # Replace the file atomically so readers never see a partial index
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".index-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf8") as file:
+            json.dump(data, file, indent=2)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ShardWriter:
+    """Write samples to numbered shards of `shard_size` samples in a folder,
+    along with an "index.json" of the shards.
+
+    The index is rewritten after each shard, so it always describes complete
+    shards, even if the writer is stopped part way through."""
+
+    def __init__(
+        self,
+        path: str,
+        shard_size: int = 100000,
+        shard_format: str = "npz",
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1")
+        if shard_format not in SHARD_FORMATS:
+            raise ValueError(f"shard_format must be one of {SHARD_FORMATS}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.shard_format = shard_format
+        self.metadata = metadata or {}
+        self.shards: List[Dict[str, Any]] = []
+        self.samples = 0
+        self._texts: List[str] = []
+        self._actions: List[int] = []
+        self._rewards: List[float] = []
+
+    def add(self, state: str, action: int, reward: float) -> None:
+        self._texts.append(state)
+        self._actions.append(action)
+        self._rewards.append(reward)
+        self.samples += 1
+        if len(self._texts) >= self.shard_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered samples as a shard, if there are any."""
+        if not self._texts:
+            return
+        arrays = {
+            "states": np.array([text.encode("utf8") for text in self._texts]),
+            "actions": np.array(self._actions, dtype=np.int32),
+            "rewards": np.array(self._rewards, dtype=np.float32),
+        }
+        name = f"shard-{len(self.shards):05d}"
+        if self.shard_format == "npz":
+            name += ".npz"
+            tmp_path = os.path.join(self.path, f".{name}")
+            with open(tmp_path, "wb") as file:
+                np.savez_compressed(file, **arrays)
+            os.replace(tmp_path, os.path.join(self.path, name))
+        else:
+            tmp_path = os.path.join(self.path, f".{name}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            for field, array in arrays.items():
+                np.save(os.path.join(tmp_path, f"{field}.npy"), array)
+            os.replace(tmp_path, os.path.join(self.path, name))
+        self.shards.append({"path": name, "samples": len(self._texts)})
+        self._texts, self._actions, self._rewards = [], [], []
+        self.write_index()
+
+    def write_index(self) -> None:
+        _write_json(
+            os.path.join(self.path, "index.json"),
+            {
+                "version": __version__,
+                "format": self.shard_format,
+                "fields": list(SAMPLE_FIELDS),
+                "samples": sum(shard["samples"] for shard in self.shards),
+                "shards": self.shards,
+                **self.metadata,
+            },
+        )
+
+    def close(self) -> None:
+        self.flush()
+        self.write_index()
+
+
+def read_index(path: str) -> Dict[str, Any]:
+    """Read the index of a folder of generated shards."""
+    with open(os.path.join(path, "index.json"), encoding="utf8") as file:
+        return json.load(file)
+
+
+def load_shard(
+    path: str, shard: Dict[str, Any], mmap_mode: Optional[str] = None
+) -> Dict[str, np.ndarray]:
+    """Load the arrays of a shard listed in the index of a folder. States are
+    utf8 encoded `MathyEnvState.to_string` texts. Shards in the "npy" format
+    can be memory-mapped by passing an `mmap_mode` like "r"."""
+    shard_path = os.path.join(path, shard["path"])
+    if shard_path.endswith(".npz"):
+        with np.load(shard_path) as arrays:
+            return {field: arrays[field] for field in SAMPLE_FIELDS}
+    return {
+        field: np.load(os.path.join(shard_path, f"{field}.npy"), mmap_mode=mmap_mode)
+        for field in SAMPLE_FIELDS
+    }
+
+
+def generate_samples(
+    path: str,
+    config: SwarmConfig,
+    environments: Sequence[str] = ("poly",),
+    difficulty: str = "easy",
+    max_samples: int = 100000,
+    max_seconds: Optional[float] = None,
+    max_problems: Optional[int] = None,
+    shard_size: int = 100000,
+    shard_format: str = "npz",
+    workers: Optional[int] = None,
+    max_steps: int = 20,
+    seed: int = 1337,
+    error_rate: float = 0.001,
+) -> Dict[str, Any]:
+    """Solve generated problems across a pool of `workers` processes and write
+    the unique samples of their swarms to shards in the folder at `path`.
+
+    Problems are drawn from the environments in turn, and the problem with
+    index `i` is generated (and solved) with the seed `seed + i`. Generation
+    stops once `max_samples` unique samples are written, `max_seconds` have
+    passed or `max_problems` problems are solved, whichever comes first.
+    Returns the index of the written shards, along with generation counts."""
+    if not environments:
+        raise ValueError("no environments to generate problems from")
+    workers = workers if workers is not None else os.cpu_count() or 1
+    worker_config = config.copy(
+        update={"use_mp": False, "history": False, "metrics": False}
+    )
+    deadline = None if max_seconds is None else time.time() + max_seconds
+    seen = SeenFilter(max_samples, error_rate)
+    writer = ShardWriter(
+        path,
+        shard_size,
+        shard_format,
+        metadata={
+            "environments": list(environments),
+            "difficulty": difficulty,
+            "seed": seed,
+            "max_steps": max_steps,
+            "n_walkers": config.n_walkers,
+            "max_iters": config.max_iters,
+        },
+    )
+    counts = {"problems": 0, "generated": 0, "duplicates": 0}
+    pending: Set[Future] = set()
+    submitted = 0
+
+    def done() -> bool:
+        return (
+            writer.samples >= max_samples
+            or (deadline is not None and time.time() >= deadline)
+            or (max_problems is not None and submitted >= max_problems)
+        )
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while True:
+                while len(pending) < workers * 2 and not done():
+                    environment = environments[submitted % len(environments)]
+                    pending.add(
+                        pool.submit(
+                            sample_problem,
+                            environment,
+                            difficulty,
+                            seed + submitted,
+                            worker_config,
+                            max_steps,
+                        )
+                    )
+                    submitted += 1
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    texts, actions, rewards = future.result()
+                    counts["problems"] += 1
+                    counts["generated"] += len(texts)
+                    for text, action, reward in zip(texts, actions, rewards):
+                        if writer.samples >= max_samples:
+                            break
+                        if not seen.add(f"{action}:{text}".encode("utf8")):
+                            counts["duplicates"] += 1
+                            continue
+                        writer.add(text, int(action), float(reward))
+                if writer.samples >= max_samples:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            writer.metadata.update(counts)
+            writer.close()
+    return read_index(path)
@@ -0,0 +1,258 @@
+"""A swarm history tree that keeps its node data within a fixed memory budget.
+
+`HistoryTree` stores the data of every node (e.g. 2048 wide state rows) as
+attributes of a networkx graph, so long searches can use a lot of memory. The
+`SpillingHistoryTree` only keeps the shape of the tree in the graph, and stores
+node data in a `SpillStore` that moves the data of the coldest (least recently
+added) nodes to memory-mapped files once its in-memory budget is used up."""
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from fragile.core.tree import HistoryTree, NamesData, NodeData, NodeId
+
+
+def reduced_dtype(dtype: np.dtype) -> np.dtype:
+    """Return the dtype that a field is stored with when it isn't kept at full
+    precision: floats are stored as float16 and integers as int32."""
+    if dtype.kind == "f":
+        return np.dtype(np.float16)
+    if dtype.kind in "iu" and dtype.itemsize > 4:
+        return np.dtype(np.int32)
+    return dtype
+
+
+class _SpillField:
+    """A growable memory-mapped array of the spilled values of one field."""
+
+    def __init__(self, path: str, shape: Tuple[int, ...], dtype: np.dtype):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.capacity = 0
+        self.array: Optional[np.memmap] = None
+
+    def grow(self, capacity: int) -> None:
+        row_bytes = int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+        with open(self.path, "ab") as file:
+            file.truncate(max(capacity * row_bytes, 1))
+        self.array = np.memmap(
+            self.path, dtype=self.dtype, mode="r+", shape=(capacity, *self.shape)
+        )
+        self.capacity = capacity
+
+    def close(self) -> None:
+        self.array = None
+
+
+class SpillStore:
+    """Store the data of tree nodes in slots, keeping at most `memory_budget_mb`
+    of it in memory and spilling the rest to memory-mapped files in a temporary
+    folder inside `spill_dir` (or the system temp folder).
+
+    The values of the fields in `full_precision` are stored as they are, and
+    other fields are stored with a `reduced_dtype`. If `full_precision` is None
+    every field is kept at full precision."""
+
+    def __init__(
+        self,
+        memory_budget_mb: float = 256.0,
+        spill_dir: Optional[str] = None,
+        full_precision: Optional[Iterable[str]] = None,
+    ):
+        if memory_budget_mb < 0:
+            raise ValueError("memory_budget_mb must not be negative")
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.full_precision = None if full_precision is None else set(full_precision)
+        self.path = tempfile.mkdtemp(prefix="mathy-history-", dir=spill_dir)
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.path, ignore_errors=True
+        )
+        # The dtype that each field's values are returned with, and stored with
+        self._dtypes: Dict[str, Tuple[np.dtype, np.dtype]] = {}
+        self._fields: Dict[str, _SpillField] = {}
+        # In memory slots, ordered from the least to the most recently added
+        self._hot: "OrderedDict[int, Dict[str, np.ndarray]]" = OrderedDict()
+        # The memory-mapped row (and field names) of each spilled slot
+        self._spilled: Dict[int, Tuple[int, Tuple[str, ...]]] = {}
+        self._free_rows: List[int] = []
+        self._n_rows = 0
+        self._next_slot = 0
+        self.hot_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._hot) + len(self._spilled)
+
+    def __contains__(self, slot: int) -> bool:
+        return slot in self._hot or slot in self._spilled
+
+    @property
+    def spilled(self) -> int:
+        """The number of slots whose data is on disk."""
+        return len(self._spilled)
+
+    def put(self, data: Dict[str, Any]) -> int:
+        """Store the data of a node and return its slot."""
+        values = {name: self._to_stored(name, value) for name, value in data.items()}
+        slot = self._next_slot
+        self._next_slot += 1
+        self._hot[slot] = values
+        self.hot_bytes += sum(value.nbytes for value in values.values())
+        while self.hot_bytes > self.memory_budget and self._hot:
+            self._spill_oldest()
+        return slot
+
+    def get(self, slot: int, names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """Return the data of a slot, or only its fields in `names`."""
+        values = self._hot.get(slot)
+        if values is None:
+            row, fields = self._spilled[slot]
+            values = {
+                name: self._fields[name].array[row]  # type:ignore
+                for name in fields
+            }
+        if names is None:
+            names = values.keys()
+        return {name: self._from_stored(name, values[name]) for name in names}
+
+    def release(self, slot: int) -> None:
+        """Free the memory (or disk rows) used by a slot."""
+        values = self._hot.pop(slot, None)
+        if values is not None:
+            self.hot_bytes -= sum(value.nbytes for value in values.values())
+            return
+        spilled = self._spilled.pop(slot, None)
+        if spilled is not None:
+            self._free_rows.append(spilled[0])
+
+    def clear(self) -> None:
+        """Release every slot, keeping the spill files around for reuse."""
+        self._hot.clear()
+        self._spilled.clear()
+        self._free_rows = list(range(self._n_rows))
+        self.hot_bytes = 0
+
+    def close(self) -> None:
+        """Release every slot and delete the spill files."""
+        self.clear()
+        for field in self._fields.values():
+            field.close()
+        self._fields = {}
+        self._free_rows = []
+        self._n_rows = 0
+        self._finalizer()
+
+    def _to_stored(self, name: str, value: Any) -> np.ndarray:
+        value = np.asarray(value)
+        dtypes = self._dtypes.get(name)
+        if dtypes is None:
+            if value.dtype.kind == "O":
+                raise TypeError(f"can't store object values of field: {name}")
+            stored = value.dtype
+            if self.full_precision is not None and name not in self.full_precision:
+                stored = reduced_dtype(value.dtype)
+            dtypes = self._dtypes[name] = (value.dtype, stored)
+        return np.array(value, dtype=dtypes[1])
+
+    def _from_stored(self, name: str, value: np.ndarray) -> Any:
+        dtype = self._dtypes[name][0]
+        if value.ndim == 0:
+            return value.astype(dtype)[()]
+        return np.array(value, dtype=dtype)
+
+    def _spill_oldest(self) -> None:
+        slot, values = self._hot.popitem(last=False)
+        self.hot_bytes -= sum(value.nbytes for value in values.values())
+        if self._free_rows:
+            row = self._free_rows.pop()
+        else:
+            row = self._n_rows
+            self._n_rows += 1
+        for name, value in values.items():
+            field = self._fields.get(name)
+            if field is None:
+                path = os.path.join(self.path, f"{name}.bin")
+                field = self._fields[name] = _SpillField(path, value.shape, value.dtype)
+            if row >= field.capacity:
+                field.grow(max(1024, field.capacity * 2, row + 1))
+            field.array[row] = value  # type:ignore
+        self._spilled[slot] = (row, tuple(values))
+
+
+class SpillingHistoryTree(HistoryTree):
+    """A `HistoryTree` that stores node and edge data in a `SpillStore`, so that
+    at most `memory_budget_mb` of it is kept in memory.
+
+    The graph only holds the slot of each node, and the data of an edge is kept
+    with the node that it leads to. Pruned nodes free their slots for reuse.
+    Call `close` to delete the spill files once the tree is no longer needed,
+    otherwise they are deleted when the tree is garbage collected."""
+
+    def __init__(
+        self,
+        names: NamesData = None,
+        prune: bool = False,
+        root_id: NodeId = 0,
+        memory_budget_mb: float = 256.0,
+        spill_dir: Optional[str] = None,
+        full_precision: Optional[Iterable[str]] = None,
+        **kwargs,
+    ):
+        super(SpillingHistoryTree, self).__init__(
+            names=names, prune=prune, root_id=root_id, **kwargs
+        )
+        self.store = SpillStore(memory_budget_mb, spill_dir, full_precision)
+
+    def reset_graph(
+        self, node_data: Dict[str, Any], root_id: NodeId = None, epoch: int = -1
+    ) -> None:
+        self.store.clear()
+        slot = self.store.put(node_data)
+        super(SpillingHistoryTree, self).reset_graph(
+            node_data={"slot": slot}, root_id=root_id, epoch=epoch
+        )
+
+    def append_leaf(
+        self,
+        leaf_id: NodeId,
+        parent_id: NodeId,
+        node_data: Dict[str, Any],
+        edge_data: Dict[str, Any],
+        epoch: int = -1,
+    ) -> None:
+        # Leaves that are already in the graph are skipped by HistoryTree
+        if leaf_id in self.data.nodes:
+            return
+        slot = self.store.put({**node_data, **edge_data})
+        super(SpillingHistoryTree, self).append_leaf(
+            leaf_id, parent_id, node_data={"slot": slot}, edge_data={}, epoch=epoch
+        )
+
+    def prune_branch(self, leaf_id: NodeId, alive_nodes: set) -> None:
+        slot = self.data.nodes[leaf_id]["slot"] if leaf_id in self.data else None
+        super(SpillingHistoryTree, self).prune_branch(leaf_id, alive_nodes)
+        if slot is not None and leaf_id not in self.data:
+            self.store.release(slot)
+
+    def get_node_data(self, node_id: NodeId) -> Dict[str, Any]:
+        """Return the stored node data (and incoming edge data) of a node."""
+        return self.store.get(self.data.nodes[node_id]["slot"])
+
+    def close(self) -> None:
+        """Delete the spill files of the tree."""
+        self.store.close()
+
+    def _one_node_tuples(self, node, next_node, return_children) -> NodeData:
+        next_slot = self.data.nodes[next_node]["slot"]
+        node_data = self.store.get(self.data.nodes[node]["slot"], self.node_names)
+        edge_data = self.store.get(next_slot, self.edge_names)
+        if return_children:
+            return node_data, edge_data, self.store.get(next_slot, self.node_names)
+        return node_data, edge_data
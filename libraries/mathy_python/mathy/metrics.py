@@ -0,0 +1,396 @@
+"""Counters and histograms of solver operations that can be exported in the
+Prometheus text format, either to a file (e.g. for node_exporter's textfile
+collector) or from a local HTTP endpoint.
+
+Metrics are kept per process. The swarm records them in the process that runs
+it, so solves that happen in a process pool (`swarm_solve_many`) are counted in
+the pool's worker processes rather than the caller."""
+import math
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fragile.core.swarm import Swarm
+
+from .parallel import SharedMemoryParallelEnv
+
+try:
+    from http.server import ThreadingHTTPServer
+except ImportError:  # Python < 3.7
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):  # type:ignore
+        daemon_threads = True
+
+
+# The values of a metric's labels, in the order of its label names
+LabelValues = Tuple[str, ...]
+
+# The default buckets of solve latency histograms, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """A named metric with a value for each combination of its labels."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values = {}
+
+    def samples(self) -> List[Tuple[str, LabelValues, float]]:
+        """Return the (suffix, label values, value) of each exported sample."""
+        with self._lock:
+            return [("", key, value) for key, value in sorted(self._values.items())]
+
+    def to_prometheus(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, value in self.samples():
+            names = self.labelnames
+            if len(key) > len(names):
+                names = names + ("le",)
+            labels = _format_labels(names, key)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of env steps taken."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        if amount < 0:
+            raise ValueError("counters can only be increased")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. the number of busy workers."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+
+class Histogram(Metric):
+    """Counts of observed values in cumulative buckets, e.g. solve latencies."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            index = int(np.searchsorted(self.buckets, value, side="left"))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels: Any) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def samples(self) -> List[Tuple[str, LabelValues, float]]:
+        samples: List[Tuple[str, LabelValues, float]] = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = np.cumsum(counts)
+                for bound, count in zip(self.buckets, cumulative):
+                    le = "+Inf" if math.isinf(bound) else repr(bound)
+                    samples.append(("_bucket", key + (le,), float(count)))
+                samples.append(("_sum", key, total))
+                samples.append(("_count", key, float(cumulative[-1])))
+        return samples
+
+
+class MetricsRegistry:
+    """A set of metrics that are exported together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def _get_or_create(self, cls: type, name: str, *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets)
+
+    def clear(self) -> None:
+        """Reset the values of every metric (but keep them registered)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+    def to_prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """Write the metrics to a file, replacing it atomically so that readers
+        never see a partial file."""
+        folder = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf8") as file:
+                file.write(self.to_prometheus())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+# The registry that the solver records its metrics in
+REGISTRY = MetricsRegistry()
+
+ENV_STEPS = REGISTRY.counter(
+    "mathy_env_steps_total", "Walker steps taken in swarm environments"
+)
+ENV_STEP_SECONDS = REGISTRY.counter(
+    "mathy_env_step_seconds_total", "Wall time spent stepping swarm environments"
+)
+ENV_ACTIONS = REGISTRY.counter(
+    "mathy_env_actions_total", "Actions taken by walkers, by rule", ("rule",)
+)
+ENV_INVALID_ACTIONS = REGISTRY.counter(
+    "mathy_env_invalid_actions_total",
+    "Actions taken by walkers that left them out of bounds, by rule",
+    ("rule",),
+)
+ENV_TERMINALS = REGISTRY.counter(
+    "mathy_env_terminal_steps_total", "Walker steps that ended an episode"
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "mathy_cache_requests_total", "Env cache lookups, by cache", ("cache", "result")
+)
+WORKER_BUSY_SECONDS = REGISTRY.counter(
+    "mathy_worker_busy_seconds_total",
+    "Time each shared memory env worker spent stepping walkers",
+    ("worker",),
+)
+SOLVES = REGISTRY.counter(
+    "mathy_solves_total", "Problems solved by swarms, by outcome", ("outcome",)
+)
+SOLVE_SECONDS = REGISTRY.histogram(
+    "mathy_solve_seconds", "Wall time spent solving each problem"
+)
+
+
+def moving_walkers(n_walkers: int, finished: Optional[np.ndarray]) -> np.ndarray:
+    """Return a mask of the walkers that an env step moves. Walkers that had
+    `finished` their episode before the step are stepped, but don't move."""
+    if finished is None:
+        return np.ones(n_walkers, dtype=np.bool_)
+    return np.logical_not(np.asarray(finished, dtype=np.bool_))
+
+
+class SwarmMetrics:
+    """Record the metrics of a swarm's env steps and solves in `REGISTRY`."""
+
+    def __init__(self, rule_names: List[str]):
+        self.rule_names = rule_names
+        self._cache_stats: Dict[str, Dict[str, int]] = {}
+
+    def instrument(self, swarm: Swarm) -> None:
+        """Wrap the step of a swarm's env to count the steps it takes."""
+        env = swarm.env
+        step = env.step
+        n_actions = swarm.model.n_actions
+
+        def counted_step(model_states, env_states):
+            start = time.perf_counter()
+            new_states = step(model_states=model_states, env_states=env_states)
+            self.record_step(
+                model_states.actions,
+                new_states.oobs,
+                new_states.terminals,
+                n_actions,
+                time.perf_counter() - start,
+                getattr(env_states, "terminals", None),
+                env,
+            )
+            return new_states
+
+        env.step = counted_step
+
+    def record_step(
+        self,
+        actions: np.ndarray,
+        oobs: np.ndarray,
+        terminals: np.ndarray,
+        n_actions: int,
+        seconds: float,
+        finished: Optional[np.ndarray] = None,
+        env: Any = None,
+    ) -> None:
+        """Count an env step that took `seconds`, given the actions (out of
+        `n_actions`) of each walker and the out of bounds and terminal flags of
+        its next state. Walkers that had `finished` before the step are stepped,
+        but don't move, so their actions aren't counted."""
+        n_rules = len(self.rule_names)
+        ENV_STEP_SECONDS.inc(seconds)
+        rules = np.asarray(actions, dtype=np.int64) // (n_actions // n_rules)
+        moving = moving_walkers(len(rules), finished)
+        rules, oobs = rules[moving], np.asarray(oobs, dtype=np.bool_)[moving]
+        rules = np.clip(rules, 0, n_rules - 1)
+        taken = np.bincount(rules, minlength=n_rules)
+        invalid = np.bincount(rules[oobs], minlength=n_rules)
+        for name, count, bad in zip(self.rule_names, taken, invalid):
+            if count:
+                ENV_ACTIONS.inc(float(count), rule=name)
+            if bad:
+                ENV_INVALID_ACTIONS.inc(float(bad), rule=name)
+        ENV_STEPS.inc(float(len(rules)))
+        ENV_TERMINALS.inc(float(np.count_nonzero(terminals)))
+        if isinstance(env, SharedMemoryParallelEnv):
+            for worker, busy in enumerate(env.worker_times):
+                WORKER_BUSY_SECONDS.inc(busy, worker=worker)
+
+    def record_solve(self, elapsed: float, solved: bool, timed_out: bool) -> None:
+        outcome = "timed_out" if timed_out else "solved" if solved else "unsolved"
+        SOLVES.inc(outcome=outcome)
+        SOLVE_SECONDS.observe(elapsed)
+
+    def record_cache_stats(self, stats: List[Dict[str, Dict[str, int]]]) -> None:
+        """Count the cache hits and misses of a swarm's envs since the last call,
+        given the cumulative `cache_stats` of each env."""
+        totals: Dict[str, Dict[str, int]] = {}
+        for env_stats in stats:
+            for cache, counts in env_stats.items():
+                total = totals.setdefault(cache, {"hits": 0, "misses": 0})
+                total["hits"] += counts.get("hits", 0)
+                total["misses"] += counts.get("misses", 0)
+        for cache, total in totals.items():
+            last = self._cache_stats.get(cache, {"hits": 0, "misses": 0})
+            for key, result in (("hits", "hit"), ("misses", "miss")):
+                delta = total[key] - last[key]
+                if delta > 0:
+                    CACHE_REQUESTS.inc(float(delta), cache=cache, result=result)
+        self._cache_stats = totals
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.to_prometheus().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def serve_metrics(
+    port: int = 9464,
+    host: str = "127.0.0.1",
+    registry: Optional[MetricsRegistry] = None,
+) -> ThreadingHTTPServer:
+    """Serve the metrics at http://host:port/metrics from a background thread.
+    Call `shutdown` on the returned server to stop it."""
+    handler: Callable[..., Any] = type(
+        "MetricsHandler",
+        (_MetricsHandler,),
+        {"registry": registry if registry is not None else REGISTRY},
+    )
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,290 @@
+"""A parallel swarm environment that steps walkers in worker processes using
+shared memory buffers instead of pickling walker arrays through pipes."""
+import multiprocessing
+import time
+import traceback
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from fragile.core.env import Environment
+from fragile.core.states import StatesEnv
+from fragile.core.wrappers import EnvWrapper
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    resource_tracker = shared_memory = None  # type:ignore
+
+# The shape and dtype of each shared array
+ArrayLayout = Dict[str, Tuple[Tuple[int, ...], str]]
+
+# The walker arrays that workers read from. They write every array returned by
+# the make_transitions of their env.
+INPUT_ARRAYS = ("states", "actions", "dt")
+
+
+def shared_memory_available() -> bool:
+    """Return True if `multiprocessing.shared_memory` is available (Python 3.8+)"""
+    return shared_memory is not None
+
+
+class SharedArrays:
+    """A set of numpy arrays backed by shared memory blocks that other processes
+    can attach to by name."""
+
+    layout: ArrayLayout
+    arrays: Dict[str, np.ndarray]
+
+    def __init__(self, layout: ArrayLayout, names: Optional[Dict[str, str]] = None):
+        assert shared_memory is not None, "shared memory requires Python 3.8+"
+        self.layout = layout
+        self._blocks: Dict[str, Any] = {}
+        self.arrays = {}
+        self._owner = names is None
+        for key, (shape, dtype) in layout.items():
+            if names is None:
+                size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                block = shared_memory.SharedMemory(create=True, size=size)
+            else:
+                block = shared_memory.SharedMemory(name=names[key])
+            self._blocks[key] = block
+            self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.arrays[key]
+
+    @property
+    def names(self) -> Dict[str, str]:
+        """The names that other processes use to attach to the blocks."""
+        return {key: block.name for key, block in self._blocks.items()}
+
+    def close(self) -> None:
+        """Detach from the blocks, and free them if this process created them."""
+        self.arrays = {}
+        for block in self._blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # Arrays handed out to callers still view the block, so its
+                # mapping is released when they are garbage collected
+                pass
+            if self._owner:
+                block.unlink()
+        self._blocks = {}
+
+
+def _shared_memory_worker(env_callable: Callable[[], Environment], conn: Connection):
+    """Step slices of the shared walker arrays in place as the main process asks."""
+    env = env_callable()
+    inputs: Optional[SharedArrays] = None
+    outputs: Optional[SharedArrays] = None
+    while True:
+        try:
+            command, payload = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if command == "close":
+            break
+        try:
+            result = None
+            if command == "attach":
+                for arrays in (inputs, outputs):
+                    if arrays is not None:
+                        arrays.close()
+                inputs = SharedArrays(*payload[0])
+                outputs = SharedArrays(*payload[1])
+            elif command == "step":
+                assert inputs is not None and outputs is not None
+                start, end = payload
+                started = time.perf_counter()
+                data = env.make_transitions(
+                    **{key: inputs[key][start:end] for key in INPUT_ARRAYS}
+                )
+                for key, value in data.items():
+                    outputs[key][start:end] = value
+                # Reply with the time spent stepping, so the main process can
+                # tell it apart from the time spent communicating
+                result = time.perf_counter() - started
+            elif command == "call":
+                name, args = payload
+                result = getattr(env, name)(*args)
+            else:
+                raise KeyError(f"unknown worker command: {command}")
+            conn.send((True, result))
+        except Exception:  # pylint: disable=broad-except
+            conn.send((False, traceback.format_exc()))
+    for arrays in (inputs, outputs):
+        if arrays is not None:
+            arrays.close()
+    conn.close()
+
+
+class SharedMemoryWorker:
+    """A process that steps an env on slices of shared walker arrays."""
+
+    def __init__(self, env_callable: Callable[[], Environment]):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_shared_memory_worker, args=(env_callable, child_conn), daemon=True
+        )
+        self._process.start()
+        child_conn.close()
+
+    def send(self, command: str, payload: Any = None) -> None:
+        self._conn.send((command, payload))
+
+    def receive(self) -> Any:
+        ok, result = self._conn.recv()
+        if not ok:
+            raise RuntimeError(f"env worker failed with:\n{result}")
+        return result
+
+    def call(self, name: str, *args: Any) -> Callable[[], Any]:
+        """Call a method of the worker's env, and return a promise that blocks
+        until the result is available when called."""
+        self.send("call", (name, args))
+        return self.receive
+
+    def close(self) -> None:
+        try:
+            self.send("close")
+            self._conn.close()
+        except (IOError, OSError):
+            pass
+        self._process.join(timeout=5)
+
+
+class SharedMemoryParallelEnv(EnvWrapper):
+    """Make the transitions of an :class:`Environment` in parallel worker
+    processes that read and write walker arrays in shared memory.
+
+    Only slice bounds and completion signals are sent through the pipes to the
+    workers, rather than pickled copies of the states and observations. Resets
+    happen in the local env, because stepping doesn't depend on the state of
+    the worker envs."""
+
+    workers: List[SharedMemoryWorker]
+    # The time each worker spent stepping in the last make_transitions
+    worker_times: List[float]
+
+    def __init__(self, env_callable: Callable[[], Environment], n_workers: int = 8):
+        if not shared_memory_available():
+            raise ValueError("shared memory environments require Python 3.8+")
+        self.n_workers = n_workers
+        # Workers must share the resource tracker of this process, otherwise
+        # each one starts its own and frees the blocks when it exits
+        resource_tracker.ensure_running()
+        self.workers = [SharedMemoryWorker(env_callable) for _ in range(n_workers)]
+        self._inputs: Optional[SharedArrays] = None
+        self._outputs: Optional[SharedArrays] = None
+        self.worker_times = [0.0] * n_workers
+        super(SharedMemoryParallelEnv, self).__init__(env_callable(), name="_local_env")
+
+    def __getattr__(self, item):
+        return self._local_env.__getattribute__(item)
+
+    def close(self) -> None:
+        """Stop the worker processes and free the shared memory."""
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+        for arrays in (self._inputs, self._outputs):
+            if arrays is not None:
+                arrays.close()
+        self._inputs = self._outputs = None
+
+    @property
+    def worker_seconds(self) -> float:
+        """The time the slowest worker spent stepping in the last make_transitions"""
+        return max(self.worker_times, default=0.0)
+
+    def call_workers(self, name: str, *args: Any) -> List[Any]:
+        """Call a method of every worker's env and return the results."""
+        promises = [worker.call(name, *args) for worker in self.workers]
+        return [promise() for promise in promises]
+
+    def step(self, model_states, env_states: StatesEnv) -> StatesEnv:
+        return self._local_env.__class__.step(
+            self, model_states=model_states, env_states=env_states
+        )
+
+    def states_to_data(self, model_states, env_states: StatesEnv):
+        return self._local_env.states_to_data(
+            model_states=model_states, env_states=env_states
+        )
+
+    def states_from_data(self, batch_size: int, *args, **kwargs) -> StatesEnv:
+        return self._local_env.states_from_data(batch_size, *args, **kwargs)
+
+    def reset(
+        self, batch_size: int = 1, env_states: StatesEnv = None, **kwargs
+    ) -> StatesEnv:
+        return self._local_env.reset(
+            batch_size=batch_size, env_states=env_states, **kwargs
+        )
+
+    def make_transitions(
+        self, states: np.ndarray, actions: np.ndarray, dt: Union[np.ndarray, int] = 1
+    ) -> Dict[str, np.ndarray]:
+        """Step the walkers in the workers and return arrays of their new states,
+        observations, rewards, out-of-bounds flags and terminal flags.
+
+        The returned arrays view shared memory that is reused by the next call,
+        so copy them if you need to keep them around."""
+        batch_size = len(actions)
+        inputs, outputs = self._get_arrays(states, actions, dt)
+        inputs["states"][:] = states
+        inputs["actions"][:] = actions
+        inputs["dt"][:] = dt
+        bounds = np.linspace(0, batch_size, len(self.workers) + 1).astype(int)
+        # Only step the workers that have a non-empty slice of the batch
+        active = [
+            (index, int(start), int(end))
+            for index, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+            if end > start
+        ]
+        for index, start, end in active:
+            self.workers[index].send("step", (start, end))
+        self.worker_times = [0.0] * len(self.workers)
+        for index, _, _ in active:
+            self.worker_times[index] = self.workers[index].receive()
+        return dict(outputs.arrays)
+
+    def _get_arrays(
+        self, states: np.ndarray, actions: np.ndarray, dt: Union[np.ndarray, int]
+    ) -> Tuple[SharedArrays, SharedArrays]:
+        """Return the shared input and output arrays for a batch, creating them
+        (and attaching the workers to them) when the batch shape changes."""
+        batch_size = len(actions)
+        if self._inputs is not None and self._outputs is not None:
+            if self._inputs["states"].shape == states.shape:
+                return self._inputs, self._outputs
+            self._inputs.close()
+            self._outputs.close()
+        # Step the first walker locally to learn the shapes of the outputs
+        sample = self._local_env.make_transitions(
+            states=states[:1], actions=actions[:1], dt=dt
+        )
+        input_layout: ArrayLayout = {
+            "states": (states.shape, states.dtype.str),
+            "actions": ((batch_size,), np.dtype(np.int64).str),
+            "dt": ((batch_size,), np.dtype(np.int64).str),
+        }
+        output_layout: ArrayLayout = {
+            key: ((batch_size,) + value.shape[1:], value.dtype.str)
+            for key, value in sample.items()
+        }
+        self._inputs = SharedArrays(input_layout)
+        self._outputs = SharedArrays(output_layout)
+        for worker in self.workers:
+            worker.send(
+                "attach",
+                (
+                    (input_layout, self._inputs.names),
+                    (output_layout, self._outputs.names),
+                ),
+            )
+        for worker in self.workers:
+            worker.receive()
+        return self._inputs, self._outputs
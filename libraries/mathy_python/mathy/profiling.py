@@ -0,0 +1,154 @@
+"""Time the phases of each swarm iteration (sampling actions, stepping the env,
+distances, cloning, ...) and export them as Chrome trace events that can be
+opened in chrome://tracing or https://ui.perfetto.dev"""
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import srsly
+from fragile.core.swarm import Swarm
+
+from .parallel import SharedMemoryParallelEnv
+
+# The phases of a swarm iteration, in the order they happen
+SWARM_PHASES = (
+    "best",
+    "sample",
+    "env_step",
+    "ipc",
+    "tree",
+    "distance",
+    "virtual_reward",
+    "clone",
+)
+
+
+@dataclass
+class PhaseEvent:
+    """The time spent in one phase of a swarm iteration."""
+
+    # The name of the phase, one of SWARM_PHASES (or "solve")
+    phase: str
+    # The swarm iteration (epoch) that the phase ran in
+    iteration: int
+    # The `time.perf_counter()` at which the phase started, in seconds
+    start: float
+    # The wall time spent in the phase, in seconds
+    duration: float
+
+
+# Called with each phase event as it finishes
+PhaseCallback = Callable[[PhaseEvent], None]
+
+
+class SwarmProfiler:
+    """Record how long each phase of a swarm's iterations takes.
+
+    Use `instrument` to time the phases of a swarm, then `add_callback` to be
+    called with each `PhaseEvent`, or read `totals` for the time spent in each
+    phase since the last `reset`. If `keep_events` is True the events are kept
+    so that `write_trace` can export them."""
+
+    events: List[PhaseEvent]
+    totals: Dict[str, float]
+
+    def __init__(self, keep_events: bool = False):
+        self.keep_events = keep_events
+        self.callbacks: List[PhaseCallback] = []
+        self.events = []
+        self.totals = {}
+        self._swarm: Optional[Swarm] = None
+
+    def add_callback(self, callback: PhaseCallback) -> None:
+        self.callbacks.append(callback)
+
+    def reset(self) -> None:
+        """Clear the recorded events and totals."""
+        self.events = []
+        self.totals = {}
+
+    def record(self, phase: str, start: float, duration: float) -> None:
+        iteration = self._swarm.epoch if self._swarm is not None else 0
+        event = PhaseEvent(phase, iteration, start, duration)
+        self.totals[phase] = self.totals.get(phase, 0.0) + duration
+        if self.keep_events:
+            self.events.append(event)
+        for callback in self.callbacks:
+            callback(event)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the code in a with block as a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def timed(self, name: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Wrap a function so that each call is timed as a phase."""
+
+        def timed_fn(*args, **kwargs):
+            with self.phase(name):
+                return fn(*args, **kwargs)
+
+        return timed_fn
+
+    def instrument(self, swarm: Swarm) -> None:
+        """Time the phases of a swarm by wrapping the methods of its walkers,
+        model and env that each iteration calls."""
+        self._swarm = swarm
+        walkers = swarm.walkers
+        for name, phase in (
+            ("update_best", "best"),
+            ("fix_best", "best"),
+            ("calculate_distances", "distance"),
+            ("calculate_virtual_reward", "virtual_reward"),
+            ("update_clone_probs", "virtual_reward"),
+            ("clone_walkers", "clone"),
+        ):
+            setattr(walkers, name, self.timed(phase, getattr(walkers, name)))
+        swarm.update_tree = self.timed("tree", swarm.update_tree)
+        swarm.prune_tree = self.timed("tree", swarm.prune_tree)
+        swarm.model.predict = self.timed("sample", swarm.model.predict)
+        swarm.env.step = self._timed_env_step(swarm.env)
+
+    def _timed_env_step(self, env: Any) -> Callable[..., Any]:
+        step = env.step
+        if not isinstance(env, SharedMemoryParallelEnv):
+            # The IPC of pipe based parallel envs happens inside fragile, so it is
+            # counted as part of env_step
+            return self.timed("env_step", step)
+
+        def timed_step(*args, **kwargs):
+            start = time.perf_counter()
+            result = step(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            # Time spent outside of the slowest worker's stepping is overhead
+            # from copying arrays and signalling the workers
+            stepping = min(env.worker_seconds, elapsed)
+            self.record("env_step", start, stepping)
+            self.record("ipc", start + stepping, elapsed - stepping)
+            return result
+
+        return timed_step
+
+    def write_trace(self, path: str) -> None:
+        """Write the kept events as a Chrome trace-event JSON file."""
+        pid = os.getpid()
+        trace_events = [
+            {
+                "name": event.phase,
+                "cat": "swarm",
+                "ph": "X",
+                "ts": event.start * 1e6,
+                "dur": event.duration * 1e6,
+                "pid": pid,
+                "tid": 0 if event.phase == "solve" else 1,
+                "args": {"iteration": event.iteration},
+            }
+            for event in self.events
+        ]
+        srsly.write_json(path, {"traceEvents": trace_events, "displayTimeUnit": "ms"})
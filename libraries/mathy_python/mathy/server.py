@@ -0,0 +1,275 @@
+"""A local HTTP/JSON server that solves problems with warm swarms.
+
+Requests are queued for a fixed set of worker threads that each keep a swarm
+(and its worker processes) alive between problems. The queue is bounded, and
+requests that arrive when it is full are rejected with a 503 so that callers
+can back off, rather than piling up behind a backlog they will time out on."""
+import json
+import queue
+import threading
+import time
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler
+from typing import Any, Dict, List, Optional, Tuple
+
+from .api import Mathy
+from .metrics import REGISTRY, ThreadingHTTPServer
+from .solver import SolveResult, SwarmConfig
+
+SERVER_REQUESTS = REGISTRY.counter(
+    "mathy_server_requests_total", "HTTP requests handled, by status", ("status",)
+)
+SERVER_QUEUE_DEPTH = REGISTRY.gauge(
+    "mathy_server_queue_depth", "Requests waiting for a solver worker"
+)
+SERVER_BUSY_WORKERS = REGISTRY.gauge(
+    "mathy_server_busy_workers", "Solver workers that are solving a problem"
+)
+
+
+class SolveJob:
+    """A problem waiting for (or being solved by) a worker."""
+
+    def __init__(self, problem: str, max_steps: int, deadline: float):
+        self.problem = problem
+        self.max_steps = max_steps
+        self.deadline = deadline
+        self.result: Optional[SolveResult] = None
+        self.error: Optional[str] = None
+        # Set by the request handler if it stops waiting for the result
+        self.abandoned = False
+        self.done = threading.Event()
+
+
+class SolverServer:
+    """Solve problems posted to http://host:port/simplify with `workers` warm
+    swarms, queueing at most `queue_size` requests.
+
+    Each request is solved within its `time_budget_ms` (or the server's
+    default), which counts from when the request arrives, so time spent in the
+    queue is part of it. Budgets are capped at `max_time_budget_ms`."""
+
+    def __init__(
+        self,
+        config: Optional[SwarmConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        workers: int = 1,
+        queue_size: int = 64,
+        time_budget_ms: int = 5000,
+        max_time_budget_ms: int = 60000,
+        max_steps: int = 20,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1")
+        # The solver metrics are served from /metrics
+        config = (config or SwarmConfig()).copy(update={"metrics": True})
+        self.mathy = Mathy(config=config, silent=True, max_concurrency=workers)
+        self.n_workers = workers
+        self.time_budget_ms = time_budget_ms
+        self.max_time_budget_ms = max_time_budget_ms
+        self.max_steps = max_steps
+        self.jobs: "queue.Queue[Optional[SolveJob]]" = queue.Queue(queue_size)
+        self._threads: List[threading.Thread] = []
+        self._ready = threading.Barrier(workers + 1)
+        # The error of a worker that failed to create its swarm
+        self._error: Optional[BaseException] = None
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        host, port = self.httpd.server_address[:2]
+        return str(host), int(port)
+
+    def start(self) -> None:
+        """Start the workers, wait for their swarms to be created, and then serve
+        requests from a background thread."""
+        for index in range(self.n_workers):
+            thread = threading.Thread(
+                target=self._work, name=f"mathy-solver-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        try:
+            self._ready.wait()
+        except threading.BrokenBarrierError:
+            # A worker couldn't create its swarm, and the others have stopped
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self.httpd.server_close()
+            self.mathy.close()
+            assert self._error is not None
+            raise self._error
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def serve_forever(self) -> None:
+        """Start the workers and serve requests until interrupted."""
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop serving, let the workers finish the problems they are solving,
+        and release their swarms."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        # Fail the requests that are still queued
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job.error = "server is shutting down"
+                job.done.set()
+        for _ in range(self.n_workers):
+            self.jobs.put(None)
+        for thread in self._threads:
+            thread.join(timeout=30)
+        self._threads = []
+        self.mathy.close()
+
+    def submit(self, problem: str, max_steps: int, time_budget_ms: int) -> SolveJob:
+        """Queue a problem, or raise queue.Full if the queue is full."""
+        budget = min(time_budget_ms, self.max_time_budget_ms)
+        job = SolveJob(problem, max_steps, time.time() + budget / 1000.0)
+        self.jobs.put_nowait(job)
+        SERVER_QUEUE_DEPTH.set(self.jobs.qsize())
+        return job
+
+    def _work(self) -> None:
+        # Create the swarm of this thread before taking requests
+        try:
+            self.mathy.warm_up()
+        except BaseException as error:
+            self._error = error
+            self._ready.abort()
+            return
+        try:
+            self._ready.wait()
+        except threading.BrokenBarrierError:
+            return
+        while True:
+            job = self.jobs.get()
+            SERVER_QUEUE_DEPTH.set(self.jobs.qsize())
+            if job is None:
+                break
+            if job.abandoned:
+                continue
+            SERVER_BUSY_WORKERS.inc()
+            try:
+                job.result = self.mathy.solve_in_thread(
+                    job.problem,
+                    job.max_steps,
+                    lambda: job.abandoned,
+                    job.deadline,
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                job.error = str(error)
+            finally:
+                SERVER_BUSY_WORKERS.inc(-1)
+                job.done.set()
+
+    def _handler_class(self) -> type:
+        server = self
+
+        class Handler(SolverRequestHandler):
+            solver_server = server
+
+        return Handler
+
+
+class SolverRequestHandler(BaseHTTPRequestHandler):
+    solver_server: SolverServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send_json(
+        self,
+        status: int,
+        body: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        data = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        SERVER_REQUESTS.inc(status=status)
+
+    def do_GET(self) -> None:
+        server = self.solver_server
+        path = self.path.split("?")[0]
+        if path == "/health":
+            self._send_json(
+                200,
+                {
+                    "status": "ok",
+                    "workers": server.n_workers,
+                    "queue_depth": server.jobs.qsize(),
+                    "queue_size": server.jobs.maxsize,
+                },
+            )
+        elif path == "/metrics":
+            data = REGISTRY.to_prometheus().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            SERVER_REQUESTS.inc(status=200)
+        else:
+            self._send_json(404, {"error": f"unknown path: {path}"})
+
+    def do_POST(self) -> None:
+        server = self.solver_server
+        if self.path.split("?")[0] != "/simplify":
+            self._send_json(404, {"error": f"unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            problem = request["problem"]
+            max_steps = int(request.get("max_steps", server.max_steps))
+            budget = int(request.get("time_budget_ms", server.time_budget_ms))
+            if not isinstance(problem, str) or max_steps < 1 or budget < 1:
+                raise ValueError()
+        except (KeyError, TypeError, ValueError):
+            self._send_json(
+                400,
+                {
+                    "error": 'expected a JSON object with a "problem" string and '
+                    'optional positive "max_steps" and "time_budget_ms" integers'
+                },
+            )
+            return
+        try:
+            job = server.submit(problem, max_steps, budget)
+        except queue.Full:
+            self._send_json(
+                503, {"error": "too many queued requests"}, {"Retry-After": "1"}
+            )
+            return
+        # The swarm stops at the deadline, give it a moment to report back
+        if not job.done.wait(timeout=max(job.deadline - time.time(), 0) + 5.0):
+            job.abandoned = True
+            self._send_json(504, {"error": "timed out waiting for a solver"})
+        elif job.result is None:
+            self._send_json(500, {"error": job.error or "solve failed"})
+        else:
+            self._send_json(200, asdict(job.result))
@@ -1,6 +1,23 @@
 """Use Fractal Monte Carlo search in order to solve mathy problems without a
 trained neural network."""
-from typing import Any, Dict, List, Optional, Union
+import copy
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 from fragile.core.env import DiscreteEnv
@@ -8,12 +25,44 @@ from fragile.core.models import DiscreteModel
 from fragile.core.states import StatesEnv, StatesModel, StatesWalkers
 from fragile.core.swarm import Swarm
 from fragile.core.tree import HistoryTree
+from fragile.core.walkers import Walkers
 from fragile.distributed.env import ParallelEnv
-from mathy_core import MathTypeKeysMax
+from mathy_core import MathExpression
+from mathy_core.parser import ExpressionParser
 from mathy_envs import EnvRewards, MathyEnv, MathyEnvState
-from pydantic import BaseModel
+from mathy_envs.time_step import is_terminal_transition, termination
+from pydantic import BaseModel, root_validator, validator
 from wasabi import msg
 
+from .embedding import EMBEDDING_SIZE, MOVES_FEATURE, embed_state
+from .history import SpillingHistoryTree
+from .parallel import SharedMemoryParallelEnv, shared_memory_available
+from .metrics import SwarmMetrics, moving_walkers
+from .profiling import SwarmProfiler
+
+
+# The fixed width of the encoded walker states
+MATHY_STATE_SIZE = 2048
+
+
+def encode_state(state: MathyEnvState, pad_to: int = MATHY_STATE_SIZE) -> np.ndarray:
+    """Encode a state into a padded array of character codes.
+
+    Produces the same array as `MathyEnvState.to_np` without building it one
+    character at a time."""
+    text = state.to_string()
+    assert pad_to >= len(text), "input is larger than pad size!"
+    codes = np.full(pad_to, ord(" "), dtype=np.int64)
+    codes[: len(text)] = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    return codes
+
+
+def decode_state(codes: np.ndarray) -> MathyEnvState:
+    """Decode an array of character codes produced by `encode_state` (or
+    `MathyEnvState.to_np`) back into a state."""
+    text = codes.astype(np.uint32).tobytes().decode("utf-32-le")
+    return MathyEnvState.from_string(text)
+
 
 class SwarmConfig(BaseModel):
     use_mp: bool = True
@@ -23,13 +72,136 @@ class SwarmConfig(BaseModel):
     verbose: bool = False
     n_walkers: int = 512
     max_iters: int = 100
+    # The mathy environment (e.g. "poly" or "binomial") whose rules and win
+    # condition the swarm searches with
+    environment: str = "poly"
+    # Walkers carry integer handles into a shared store of unique states rather
+    # than full encoded state rows. Handles are local to a process, so this
+    # requires use_mp to be False.
+    intern_states: bool = False
+    # Memoize env transitions by (state, action) with an LRU bounded cache
+    transition_cache: bool = False
+    transition_cache_size: int = 1024
+    # Max number of parsed expression trees (and action masks) kept per env
+    parse_cache_size: int = 4096
+    # Stop searching for a problem after this many milliseconds of wall time and
+    # return the best state found so far (marked unsolved)
+    time_budget_ms: Optional[int] = None
+    # How use_mp envs exchange walker data with their worker processes, either
+    # "pipe" (pickled through pipes) or "shared_memory" (requires Python 3.8+)
+    mp_backend: str = "pipe"
+    # Relative weights for sampling the actions of each rule (in the order of
+    # the env's rules), or None to sample uniformly from the valid actions
+    rule_weights: Optional[List[float]] = None
+    # Time the phases of each swarm iteration and report the totals for each
+    # problem in `SolveResult.phase_times`
+    profile: bool = False
+    # Write the phases of each solve to this path as a Chrome trace-event JSON
+    # file (implies profile). The file is rewritten by every solve.
+    profile_trace: Optional[str] = None
+    # Record env step, cache and solve metrics in `mathy.metrics.REGISTRY`
+    metrics: bool = False
+    # The path of a SQLite database of solved problems that `Mathy` checks
+    # before starting a swarm, and the max number of problems it keeps
+    solution_cache: Optional[str] = None
+    solution_cache_size: int = 100000
+    # With history, keep at most this many megabytes of tree node data in memory
+    # and spill the data of the oldest nodes to memory-mapped files in
+    # history_spill_dir (or the system temp folder). None keeps it all in memory.
+    history_memory_mb: Optional[float] = None
+    history_spill_dir: Optional[str] = None
+    # The history_names that a spilling tree stores at full precision, or None
+    # for all of them. Others are stored as float16 (floats) or int32 (integers).
+    history_full_precision: Optional[List[str]] = None
+
+    @validator("mp_backend")
+    def check_mp_backend(cls, value: str) -> str:
+        if value not in ("pipe", "shared_memory"):
+            raise ValueError("mp_backend must be 'pipe' or 'shared_memory'")
+        if value == "shared_memory" and not shared_memory_available():
+            raise ValueError("the shared_memory mp_backend requires Python 3.8+")
+        return value
+
+    @validator("rule_weights")
+    def check_rule_weights(cls, value: Optional[List[float]]) -> Optional[List[float]]:
+        if value is not None and any(weight < 0 for weight in value):
+            raise ValueError("rule_weights must not be negative")
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def check_intern_states(cls, values: Dict[str, Any]) -> Dict[str, Any]:
+        if values["intern_states"] and values["use_mp"]:
+            raise ValueError("intern_states requires use_mp to be False")
+        return values
 
 
 def mathy_dist(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     return np.linalg.norm(x - y, axis=1)
 
 
+def sample_masked(
+    masks: np.ndarray,
+    random_state: np.random.RandomState,
+    weights: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Sample one action per row of a batch of 0/1 action masks, with a chance
+    proportional to the weight of each valid action (uniform if None).
+
+    Only the valid entries of the masks are visited, so the cost depends on the
+    number of valid actions rather than the size of the masks. Rows where every
+    valid action has zero weight are sampled uniformly, and rows without valid
+    actions get action 0, which the env treats as an invalid (terminal) move."""
+    batch_size = len(masks)
+    draws = random_state.rand(batch_size)
+    actions = np.zeros(batch_size, dtype=np.int64)
+    rows, cols = np.nonzero(masks)
+    if len(rows) == 0:
+        return actions
+    counts = np.bincount(rows, minlength=batch_size)
+    row_weights = np.ones(len(cols)) if weights is None else weights[cols]
+    totals = np.bincount(rows, weights=row_weights, minlength=batch_size)
+    unweighted = (totals <= 0) & (counts > 0)
+    if unweighted.any():
+        row_weights = np.where(unweighted[rows], 1.0, row_weights)
+        totals = np.bincount(rows, weights=row_weights, minlength=batch_size)
+    # Find each draw in the running sum of the weights of its row's entries
+    cumulative = np.cumsum(row_weights)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    offsets = np.concatenate(([0.0], cumulative))[starts]
+    picks = np.searchsorted(cumulative, offsets + draws * totals, side="right")
+    live = counts > 0
+    picks = np.minimum(picks, ends - 1)[live]
+    actions[live] = cols[picks]
+    return actions
+
+
 class DiscreteMasked(DiscreteModel):
+    """Sample actions from the valid actions of each walker, optionally weighted
+    by a prior over the rules, e.g. heuristic rule preferences or rule
+    frequencies learned from solved problems."""
+
+    action_weights: Optional[np.ndarray]
+
+    def __init__(
+        self,
+        env: Optional[DiscreteEnv] = None,
+        rule_weights: Optional[List[float]] = None,
+        **kwargs,
+    ):
+        super(DiscreteMasked, self).__init__(env=env, **kwargs)
+        self.action_weights = None
+        if rule_weights is not None:
+            assert env is not None, "rule_weights require an env"
+            weights = np.asarray(rule_weights, dtype=np.float64)
+            if len(weights) != env.n_rules:
+                raise ValueError(
+                    f"expected one weight for each of the {env.n_rules} rules, "
+                    f"but got {len(weights)} weights"
+                )
+            # Actions are laid out as rule * max_seq_len + node
+            self.action_weights = np.repeat(weights, self.n_actions // env.n_rules)
+
     def sample(
         self,
         batch_size: int,
@@ -38,19 +210,10 @@ class DiscreteMasked(DiscreteModel):
         walkers_states: StatesWalkers = None,
         **kwargs,
     ) -> StatesModel:
-        def random_choice_prob_index(a, axis=1):
-            """Select random actions with probabilities across a batch.
-            
-            Source: https://stackoverflow.com/a/47722393/287335"""
-            r = np.expand_dims(self.random_state.rand(a.shape[1 - axis]), axis=axis)
-            return (a.cumsum(axis=axis) > r).argmax(axis=axis)
-
         if env_states is not None:
-            # Each state is a vstack([node_ids, mask]) and we only want the mask.
-            #
-            # Swap columns and slice the last element to get it.
-            masks = env_states.observs[:, -self.n_actions :]
-            actions = random_choice_prob_index(masks)
+            actions = sample_masked(
+                env_states.masks, self.random_state, self.action_weights
+            )
         else:
             actions = self.random_state.randint(0, self.n_actions, size=batch_size)
         return self.update_states_with_critic(
@@ -58,6 +221,39 @@ class DiscreteMasked(DiscreteModel):
         )
 
 
+class MaskedWalkers(Walkers):
+    """Walkers that keep the valid action mask of the best state they found, so
+    that the walker `fix_best` moves to the best state gets its mask too."""
+
+    def reset(
+        self,
+        env_states: StatesEnv = None,
+        model_states: StatesModel = None,
+        walkers_states: StatesWalkers = None,
+    ):
+        super(MaskedWalkers, self).reset(
+            env_states=env_states,
+            model_states=model_states,
+            walkers_states=walkers_states,
+        )
+        rewards = self.env_states.rewards
+        best_ix = rewards.argmin() if self.minimize else rewards.argmax()
+        self.states.update(best_mask=self.env_states.masks[best_ix].copy())
+
+    def update_best(self):
+        best_reward = self.states.best_reward
+        super(MaskedWalkers, self).update_best()
+        # The best state is only replaced by a strictly better one
+        if self.states.best_reward != best_reward:
+            best_mask = self.env_states.masks[self.get_best_index()].copy()
+            self.states.update(best_mask=best_mask)
+
+    def fix_best(self):
+        super(MaskedWalkers, self).fix_best()
+        if self.states.best_reward is not None:
+            self.env_states.masks[-1] = self.states.best_mask
+
+
 class FragileMathyEnv(DiscreteEnv):
     """The DiscreteEnv acts as an interface with `plangym` discrete actions.
 
@@ -88,9 +284,43 @@ class FragileMathyEnv(DiscreteEnv):
             observs_shape=self._env.observation_space.shape,
         )
 
+    @property
+    def n_rules(self) -> int:
+        """The number of rules that actions can apply. This is a property rather
+        than left to `__getattr__`, because the parallel envs look attributes up
+        on their local env with `__getattribute__`."""
+        return self._env.n_rules
+
+    def get_params_dict(self) -> Dict[str, Dict[str, Any]]:
+        """Add the valid action masks of walkers to the default env params."""
+        params = super(FragileMathyEnv, self).get_params_dict()
+        params["masks"] = {"size": (self._n_actions,), "dtype": np.uint8}
+        return params
+
+    def reset(self, batch_size: int = 1, **kwargs) -> StatesEnv:
+        """Reset the env and return `batch_size` copies of its initial state."""
+        state, observ = self._env.reset()
+        _, mask = self._env.observe()
+        return self.states_from_data(
+            batch_size=batch_size,
+            states=np.repeat(state[np.newaxis], batch_size, axis=0),
+            observs=np.repeat(observ[np.newaxis], batch_size, axis=0),
+            rewards=np.zeros(batch_size, dtype=np.float32),
+            oobs=np.zeros(batch_size, dtype=np.bool_),
+            masks=np.repeat(mask[np.newaxis], batch_size, axis=0),
+        )
+
     def __getattr__(self, item):
         return getattr(self._env, item)
 
+    def to_env_state(self, state: np.ndarray) -> MathyEnvState:
+        """Convert a walker state row back into an env state."""
+        return self._env.to_env_state(state)
+
+    def set_problem(self, problem: str, max_steps: Optional[int] = None) -> None:
+        """Set the problem that the env starts from when it is reset."""
+        self._env.set_problem(problem, max_steps)
+
     def make_transitions(
         self, states: np.ndarray, actions: np.ndarray, dt: Union[np.ndarray, int]
     ) -> Dict[str, np.ndarray]:
@@ -98,24 +328,212 @@ class FragileMathyEnv(DiscreteEnv):
         Step the underlying :class:`plangym.Environment` using the ``step_batch`` \
         method of the ``plangym`` interface.
         """
-        new_states, observs, rewards, oobs, infos = self._env.step_batch(
+        new_states, observs, rewards, oobs, terminals, masks = self._env.step_batch(
             actions=actions, states=states
         )
-        terminals = [inf.get("done", False) for inf in infos]
         data = {
-            "states": np.array(new_states),
-            "observs": np.array(observs),
-            "rewards": np.array(rewards),
-            "oobs": np.array(oobs),
-            "terminals": np.array(terminals),
+            "states": new_states,
+            "observs": observs,
+            "rewards": rewards,
+            "oobs": oobs,
+            "terminals": terminals,
+            "masks": masks,
         }
         return data
 
 
+class StateStore:
+    """Interned storage for walker states.
+
+    Each unique state is kept once and identified by a small integer handle, so
+    walkers that share a state (which is most of them after cloning) share a
+    single copy of it. The reference count of a handle is the number of walkers
+    that held it in the most recent batch, and handles that drop to zero are
+    released."""
+
+    _handles: Dict[str, int]
+    _keys: Dict[int, str]
+    _states: Dict[int, MathyEnvState]
+    _refs: Dict[int, int]
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def clear(self) -> None:
+        self._handles = {}
+        self._keys = {}
+        self._states = {}
+        self._refs = {}
+        self._next_handle = 0
+
+    def intern(self, state: MathyEnvState) -> int:
+        """Return the handle for a state, adding it to the store if needed."""
+        key = state.to_string()
+        handle = self._handles.get(key)
+        if handle is None:
+            handle = self._next_handle
+            self._next_handle += 1
+            self._handles[key] = handle
+            self._keys[handle] = key
+            self._states[handle] = state
+            self._refs[handle] = 0
+        return handle
+
+    def get(self, handle: int) -> MathyEnvState:
+        """Return the state for a handle. The state is shared, so don't mutate it."""
+        return self._states[handle]
+
+    def refs(self, handle: int) -> int:
+        return self._refs[handle]
+
+    def update_refs(self, *handles: np.ndarray, release: bool = True) -> None:
+        """Set the reference counts from the handles that are held by walkers and
+        optionally release every state that is no longer referenced."""
+        live, counts = np.unique(np.concatenate(handles), return_counts=True)
+        self._refs = dict.fromkeys(self._states, 0)
+        self._refs.update(zip(live.tolist(), counts.tolist()))
+        if not release:
+            return
+        for handle, count in list(self._refs.items()):
+            if count == 0:
+                del self._handles[self._keys.pop(handle)]
+                del self._states[handle]
+                del self._refs[handle]
+
+
+class LRUCache(OrderedDict):
+    """A dictionary that holds at most `max_size` items by evicting the least
+    recently used ones."""
+
+    def __init__(self, max_size: int):
+        assert max_size > 0, "cache size must be positive"
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key: Any) -> Any:
+        value = super(LRUCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        super(LRUCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class BoundedExpressionParser(ExpressionParser):
+    """Expression parser that caches at most `max_size` token lists and parsed
+    trees, keyed by their input text.
+
+    Parsed trees are shared by everyone that parses the same text, so callers
+    must only mutate a copy made with `clone_from_root` (as MathyEnv does before
+    applying rules)."""
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        super(BoundedExpressionParser, self).__init__()
+
+    def clear_cache(self) -> None:
+        self._tokens_cache = LRUCache(self.max_size)
+        self._parse_cache = LRUCache(self.max_size)
+
+    def parse(self, input_text: str) -> MathExpression:
+        if input_text in self._parse_cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return super(BoundedExpressionParser, self).parse(input_text)
+
+    def stats(self) -> Dict[str, int]:
+        size = len(self._parse_cache)
+        return {"hits": self.hits, "misses": self.misses, "size": size}
+
+
+def bound_env_caches(mathy: MathyEnv, max_size: int) -> None:
+    """Replace the unbounded text keyed caches of an env with LRU caches so that
+    long running solvers don't grow without limit.
+
+    `MathyEnv.get_initial_state` replaces the valid move caches with dicts each
+    time it generates a problem, so call this again after resetting the env.
+    Caches that are already bounded are kept."""
+    if not isinstance(mathy.parser, BoundedExpressionParser):
+        mathy.parser = BoundedExpressionParser(max_size)
+    if not isinstance(mathy.valid_actions_mask_cache, LRUCache):
+        mathy.valid_actions_mask_cache = LRUCache(max_size)
+    if not isinstance(mathy.valid_rules_cache, LRUCache):
+        mathy.valid_rules_cache = LRUCache(max_size)
+
+
+# A transition's (next state, observation, valid action mask, reward, info)
+TransitionType = Tuple[MathyEnvState, np.ndarray, np.ndarray, float, Dict[str, Any]]
+# A walker's (state row, observation, reward, oob, terminal, valid action mask)
+BatchTransition = Tuple[np.ndarray, np.ndarray, float, bool, bool, np.ndarray]
+# The arrays of a batch of walker transitions, in the same order
+BatchBuffers = Tuple[
+    np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray
+]
+
+
+# A cached transition's key of (expression, action)
+TransitionKey = Tuple[str, int]
+# A cached transition's (next expression or None if invalid, observation, mask)
+CachedTransition = Tuple[Optional[str], np.ndarray, np.ndarray]
+
+
+class TransitionCache:
+    """LRU cache of env transitions keyed by (expression, action).
+
+    Cloning makes walkers converge on the same expressions, so the swarm applies
+    the same actions to them over and over, often from states with different
+    histories and moves remaining. Applying a rule is deterministic, so the next
+    expression and its observation and mask only need to be computed once.
+    Cached values are shared between hits, so don't mutate them."""
+
+    _entries: LRUCache
+
+    def __init__(self, max_size: int = 1024):
+        self._entries = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def max_size(self) -> int:
+        return self._entries.max_size
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get(self, key: TransitionKey) -> Optional[CachedTransition]:
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._entries[key]
+
+    def put(self, key: TransitionKey, value: CachedTransition) -> None:
+        self._entries[key] = value
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
 class FragileEnvironment:
     """Fragile Environment for solving Mathy problems."""
 
     problem: Optional[str]
+    store: Optional[StateStore]
+    _batch_buffers: Optional[BatchBuffers]
 
     def __init__(
         self,
@@ -124,6 +542,10 @@ class FragileEnvironment:
         difficulty: str = "normal",
         problem: Optional[str] = None,
         max_steps: int = 64,
+        intern_states: bool = False,
+        keep_interned: bool = False,
+        transition_cache_size: int = 0,
+        parse_cache_size: int = 0,
         **kwargs,
     ):
         import gym
@@ -134,78 +556,603 @@ class FragileEnvironment:
             f"mathy-{environment}-{difficulty}-v0",
             invalid_action_response="terminal",
             env_problem=problem,
-            mask_as_probabilities=True,
+            mask_as_probabilities=False,
             **kwargs,
         )
         self.observation_space = spaces.Box(
-            low=0, high=MathTypeKeysMax, shape=(256, 256, 1), dtype=np.uint8,
+            low=0, high=np.inf, shape=(EMBEDDING_SIZE,), dtype=np.float32
         )
         self.action_space = spaces.Discrete(self._env.action_size)
+        self.n_rules = len(self._env.mathy.rules)
+        self.parse_cache_size = parse_cache_size
+        if parse_cache_size > 0:
+            bound_env_caches(self._env.mathy, parse_cache_size)
         self.problem = problem
         self.max_steps = max_steps
-        self._env.reset()
+        # Keep interned states that walkers no longer reference, e.g. because
+        # they are still referenced by a history tree
+        self.keep_interned = keep_interned
+        self.store = StateStore() if intern_states else None
+        self.transition_cache: Optional[TransitionCache] = None
+        if transition_cache_size > 0:
+            self.transition_cache = TransitionCache(transition_cache_size)
+        self._batch_buffers = None
+        if problem is not None:
+            self.set_problem(problem, max_steps)
+        self.reset()
+
+    @property
+    def state_size(self) -> int:
+        """The width of the walker state rows."""
+        return 1 if self.store is not None else MATHY_STATE_SIZE
+
+    def to_state_row(self, env_state: MathyEnvState) -> np.ndarray:
+        """Convert an env state into the walker state row used by the swarm."""
+        if self.store is not None:
+            return np.array([self.store.intern(env_state)], dtype=np.int64)
+        return encode_state(env_state)
+
+    def to_env_state(self, state: np.ndarray) -> MathyEnvState:
+        """Convert a walker state row back into an env state."""
+        if self.store is not None:
+            return self.store.get(int(state[0]))
+        return decode_state(state)
+
+    def set_problem(self, problem: str, max_steps: Optional[int] = None) -> None:
+        """Set the problem (and the max number of moves to solve it in) that the
+        env starts from when it is reset."""
+        if max_steps is not None:
+            self.max_steps = max_steps
+        self.problem = problem
+        self._env._challenge = MathyEnvState(problem=problem, max_moves=self.max_steps)
+        self._env.repeat_problem = True
 
     def get_state(self) -> np.ndarray:
         assert self._env.state is not None, "env required to get_state"
-        return self._env.state.to_np(2048)
+        return self.to_state_row(self._env.state)
 
     def set_state(self, state: np.ndarray):
         assert self._env is not None, "env required to set_state"
-        self._env.state = MathyEnvState.from_np(state)
+        self._env.state = self.to_env_state(state)
         return state
 
+    def observe(
+        self, env_state: Optional[MathyEnvState] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the structural embedding and valid action mask of a state (or
+        of the current state if None). The mask is kept separate so that it
+        isn't part of walker distances."""
+        if env_state is None:
+            env_state = self._env.state
+        mathy = self._env.mathy
+        expression = mathy.parser.parse(env_state.agent.problem)
+        # Rows of valid moves are only as long as the expression's node list
+        mask = np.zeros((len(mathy.rules), mathy.max_seq_len), dtype=np.uint8)
+        for rule_index, nodes in enumerate(mathy.get_valid_moves(env_state)):
+            nodes = nodes[: mathy.max_seq_len]
+            mask[rule_index, : len(nodes)] = nodes
+        return embed_state(expression, env_state), mask.reshape(-1)
+
     def step(self, action: int, state: np.ndarray = None) -> tuple:
+        """Step from a state and return its next state, observation, reward,
+        out-of-bounds flag and info. The info includes the valid action mask of
+        the next state as "mask"."""
         assert self._env is not None, "env required to step"
         assert state is not None, "only works with state stepping"
-        self.set_state(state)
-        obs, reward, _, info = self._env.step(action)
+        next_state, obs, mask, reward, info = self._next_state(
+            self.to_env_state(state), int(action)
+        )
         oob = not info.get("valid", False)
-        new_state = self.get_state()
-        return new_state, obs, reward, oob, info
+        info = dict(info, mask=mask)
+        return self.to_state_row(next_state), obs, reward, oob, info
 
     def step_batch(
-        self, actions, states:Optional[Any]=None, n_repeat_action: Optional[Union[int, np.ndarray]] = None
-    ) -> tuple:
-        data = [self.step(action, state) for action, state in zip(actions, states)]
-        new_states, observs, rewards, terminals, infos = [], [], [], [], []
-        for d in data:
-            new_state, obs, _reward, end, info = d
-            new_states.append(new_state)
-            observs.append(obs)
-            rewards.append(_reward)
-            terminals.append(end)
-            infos.append(info)
-        return new_states, observs, rewards, terminals, infos
+        self,
+        actions: np.ndarray,
+        states: Optional[np.ndarray] = None,
+        n_repeat_action: Optional[Union[int, np.ndarray]] = None,
+    ) -> BatchBuffers:
+        """Step a batch of walkers and return arrays of their new states,
+        observations, rewards, out-of-bounds flags, terminal flags and valid
+        action masks.
+
+        Walkers that share a state are decoded once, walkers that share both a
+        state and an action are stepped once, and walkers whose state has no
+        moves remaining are not stepped at all. The returned arrays are reused
+        by the next call, so copy them if you need to keep them around."""
+        assert self._env is not None, "env required to step"
+        assert states is not None, "only works with state stepping"
+        batch_size = len(actions)
+        buffers = self._get_batch_buffers(batch_size, states.dtype)
+        out_states, out_observs, out_rewards, out_oobs, out_terminals, out_masks = (
+            buffers
+        )
+        # Index of the unique (state, action) transition each walker maps to
+        walker_transitions = np.empty(batch_size, dtype=np.int64)
+        state_indices: Dict[bytes, int] = {}
+        env_states: List[MathyEnvState] = []
+        transition_indices: Dict[Tuple[int, int], int] = {}
+        transitions: List[BatchTransition] = []
+        for i in range(batch_size):
+            key = states[i].tobytes()
+            state_index = state_indices.get(key)
+            if state_index is None:
+                state_index = len(env_states)
+                state_indices[key] = state_index
+                env_states.append(self.to_env_state(states[i]))
+            env_state = env_states[state_index]
+            # Walkers that are out of moves (including those that took an invalid
+            # action) can't go anywhere, so they share one transition per state
+            action = -1 if env_state.agent.moves_remaining <= 0 else int(actions[i])
+            transition_key = (state_index, action)
+            transition_index = transition_indices.get(transition_key)
+            if transition_index is None:
+                transition_index = len(transitions)
+                transition_indices[transition_key] = transition_index
+                if action == -1:
+                    transitions.append(self._terminal_transition(states[i], env_state))
+                else:
+                    transitions.append(self._transition(env_state, action))
+            walker_transitions[i] = transition_index
+
+        new_states, observs, rewards, oobs, terminals, masks = zip(*transitions)
+        np.take(np.stack(new_states), walker_transitions, axis=0, out=out_states)
+        np.take(np.stack(observs), walker_transitions, axis=0, out=out_observs)
+        np.take(np.stack(masks), walker_transitions, axis=0, out=out_masks)
+        np.take(rewards, walker_transitions, out=out_rewards)
+        np.take(oobs, walker_transitions, out=out_oobs)
+        np.take(terminals, walker_transitions, out=out_terminals)
+        if self.store is not None:
+            self.store.update_refs(
+                states[:, 0], out_states[:, 0], release=not self.keep_interned
+            )
+        return buffers
+
+    def transition_cache_stats(self) -> Dict[str, int]:
+        """Return the hit/miss counters of the transition cache, if enabled."""
+        if self.transition_cache is None:
+            return {}
+        return self.transition_cache.stats()
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Return the hit/miss counters of each enabled cache, by cache name."""
+        stats: Dict[str, Dict[str, int]] = {}
+        if self.transition_cache is not None:
+            stats["transition"] = self.transition_cache.stats()
+        parser = self._env.mathy.parser
+        if isinstance(parser, BoundedExpressionParser):
+            stats["parse"] = parser.stats()
+        return stats
+
+    def _next_state(self, env_state: MathyEnvState, action: int) -> TransitionType:
+        if self.transition_cache is None:
+            return self._step_env(env_state, action)
+        # The next expression (and its observation and mask) only depend on the
+        # expression and the action, so walkers that reach the same expression
+        # along different paths (or at different depths) share cache entries
+        key = (env_state.agent.problem, action)
+        cached = self.transition_cache.get(key)
+        if cached is None:
+            result = self._step_env(env_state, action)
+            next_state, obs, mask, _, info = result
+            next_problem = next_state.agent.problem if info["valid"] else None
+            self.transition_cache.put(key, (next_problem, obs, mask))
+            return result
+        return self._cached_transition(env_state, action, *cached)
+
+    def _cached_transition(
+        self,
+        env_state: MathyEnvState,
+        action: int,
+        next_problem: Optional[str],
+        obs: np.ndarray,
+        mask: np.ndarray,
+    ) -> TransitionType:
+        """Rebuild a transition from its cached next expression. The history of
+        the next state, its moves remaining and the reward (e.g. revisit
+        penalties) depend on the path taken to a state, so they are computed
+        again."""
+        mathy = self._env.mathy
+        move = mathy.to_action(action)
+        if next_problem is None:
+            # The env is created with invalid_action_response="terminal"
+            next_state = env_state.get_out_state(
+                problem=env_state.agent.problem, action=move, moves_remaining=0
+            )
+            features = next_state.to_observation(
+                mathy.get_valid_moves(next_state), parser=mathy.parser
+            )
+            transition = termination(features, mathy.get_lose_signal(env_state))
+        else:
+            next_state = env_state.get_out_state(
+                problem=next_problem,
+                action=move,
+                moves_remaining=env_state.agent.moves_remaining - 1,
+            )
+            transition = mathy.get_state_transition(next_state)
+        self._env.state = next_state
+        obs = obs.copy()
+        obs[MOVES_FEATURE] = next_state.agent.moves_remaining / max(
+            next_state.max_moves, 1
+        )
+        done = is_terminal_transition(transition)
+        valid = next_problem is not None
+        info = {"transition": transition, "done": done, "valid": valid}
+        if done:
+            info["win"] = transition.reward > 0.0
+        return next_state, obs, mask, transition.reward, info
+
+    def _step_env(self, env_state: MathyEnvState, action: int) -> TransitionType:
+        """Step like the gym env does, but observe the next state with `observe`
+        rather than building the (unused) gym observation."""
+        next_state, transition, change = self._env.mathy.get_next_state(
+            env_state, action
+        )
+        self._env.state = next_state
+        done = is_terminal_transition(transition)
+        valid = change.result is not None
+        info = {"transition": transition, "done": done, "valid": valid}
+        if done:
+            info["win"] = transition.reward > 0.0
+        obs, mask = self.observe(next_state)
+        return next_state, obs, mask, transition.reward, info
+
+    def _transition(self, env_state: MathyEnvState, action: int) -> BatchTransition:
+        next_state, obs, mask, reward, info = self._next_state(env_state, action)
+        oob = not info.get("valid", False)
+        row = self.to_state_row(next_state)
+        return row, obs, reward, oob, info["done"], mask
+
+    def _terminal_transition(
+        self, state: np.ndarray, env_state: MathyEnvState
+    ) -> BatchTransition:
+        features, mask = self.observe(env_state)
+        reward = self._env.mathy.get_lose_signal(env_state)
+        return state, features, reward, True, True, mask
+
+    def _get_batch_buffers(
+        self, batch_size: int, states_dtype: np.dtype
+    ) -> BatchBuffers:
+        buffers = self._batch_buffers
+        if (
+            buffers is None
+            or len(buffers[0]) != batch_size
+            or buffers[0].dtype != states_dtype
+        ):
+            n_actions = self.action_space.n
+            obs_size = self.observation_space.shape[0]
+            buffers = (
+                np.zeros((batch_size, self.state_size), dtype=states_dtype),
+                np.zeros((batch_size, obs_size), dtype=np.float32),
+                np.zeros(batch_size, dtype=np.float32),
+                np.zeros(batch_size, dtype=np.bool_),
+                np.zeros(batch_size, dtype=np.bool_),
+                np.zeros((batch_size, n_actions), dtype=np.uint8),
+            )
+            self._batch_buffers = buffers
+        return buffers
 
     def reset(self, batch_size: int = 1):
         assert self._env is not None, "env required to reset"
-        obs = self._env.reset()
+        self._env.reset()
+        if self.parse_cache_size > 0:
+            bound_env_caches(self._env.mathy, self.parse_cache_size)
+        if self.store is not None:
+            self.store.clear()
+        obs, _ = self.observe()
         return self.get_state(), obs
 
 
-def mathy_swarm(config: SwarmConfig, env_callable=None) -> Swarm:
+def call_worker_envs(swarm: Swarm, name: str, *args: Any) -> List[Any]:
+    """Call a method of the envs running in a swarm's worker processes, or of
+    the swarm's own env if it doesn't use a ParallelEnv, and return the results."""
+    if isinstance(swarm.env, SharedMemoryParallelEnv):
+        return swarm.env.call_workers(name, *args)
+    if isinstance(swarm.env, ParallelEnv):
+        workers = swarm.env.parallel_env._batch_env._envs
+        # Send every call before waiting on any of the results
+        promises = [worker.call(name, *args) for worker in workers]
+        return [promise() for promise in promises]
+    return [getattr(swarm.env, name)(*args)]
+
+
+def get_transition_cache_stats(swarm: Swarm) -> Dict[str, int]:
+    """Sum the transition cache counters of a swarm's env, including the envs
+    running in worker processes when the swarm uses a ParallelEnv."""
+    results = call_worker_envs(swarm, "transition_cache_stats")
+    totals: Dict[str, int] = {}
+    for result in results:
+        for key, value in result.items():
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def swarm_env_kwargs(config: SwarmConfig) -> Dict[str, Any]:
+    """Return the FragileMathyEnv keyword arguments for a swarm config."""
+    return dict(
+        environment=config.environment,
+        intern_states=config.intern_states,
+        keep_interned=config.history,
+        transition_cache_size=config.transition_cache_size
+        if config.transition_cache
+        else 0,
+        parse_cache_size=config.parse_cache_size,
+    )
+
+
+def mathy_swarm_env(
+    config: SwarmConfig, env_callable: Optional[Callable[[], Any]] = None
+) -> Callable[[], Any]:
+    """Return the callable that creates the env of a swarm for a config, which
+    steps its walkers in worker processes if `config.use_mp` is True."""
+
+    def default_env() -> FragileMathyEnv:
+        return FragileMathyEnv(
+            name="mathy_v0",
+            repeat_problem=config.single_problem,
+            **swarm_env_kwargs(config),
+        )
+
     if env_callable is None:
-        env_callable = lambda: FragileMathyEnv(
-            name="mathy_v0", repeat_problem=config.single_problem
+        env_callable = default_env
+    if not config.use_mp:
+        return env_callable
+    if config.mp_backend == "shared_memory":
+        parallel_env = SharedMemoryParallelEnv(env_callable=env_callable)
+    else:
+        parallel_env = ParallelEnv(env_callable=env_callable)
+
+    # Calling a ParallelEnv returns its unwrapped local env, which would leave
+    # the worker processes idle, so hand it to the swarm as is.
+    def parallel_env_callable() -> Any:
+        return parallel_env
+
+    return parallel_env_callable
+
+
+def build_swarm(
+    config: SwarmConfig, env_callable: Callable[[], Any], n_walkers: int
+) -> Swarm:
+    """Create a swarm of `n_walkers` for a config around an env callable (as
+    returned by `mathy_swarm_env`)."""
+
+    def history_tree() -> HistoryTree:
+        if config.history_memory_mb is None:
+            return HistoryTree(prune=True, names=config.history_names)
+        return SpillingHistoryTree(
+            prune=True,
+            names=config.history_names,
+            memory_budget_mb=config.history_memory_mb,
+            spill_dir=config.history_spill_dir,
+            full_precision=config.history_full_precision,
         )
-    if config.use_mp:
-        env_callable = ParallelEnv(env_callable=env_callable)
-    tree_callable = None
-    if config.history:
-        tree_callable = lambda: HistoryTree(prune=True, names=config.history_names)
-    swarm = Swarm(
-        model=lambda env: DiscreteMasked(env=env),
+
+    return Swarm(
+        model=lambda env: DiscreteMasked(env=env, rule_weights=config.rule_weights),
         env=env_callable,
-        tree=tree_callable,
+        walkers=MaskedWalkers,
+        tree=history_tree if config.history else None,
         reward_limit=EnvRewards.WIN,
-        n_walkers=config.n_walkers,
+        n_walkers=n_walkers,
         max_epochs=config.max_iters,
         reward_scale=1,
         distance_scale=3,
         distance_function=mathy_dist,
         show_pbar=False,
     )
-    return swarm
+
+
+def mathy_swarm(config: SwarmConfig, env_callable=None) -> Swarm:
+    return build_swarm(config, mathy_swarm_env(config, env_callable), config.n_walkers)
+
+
+@dataclass
+class SolveResult:
+    """The outcome of solving one problem with a swarm.
+
+    Unlike the swarm itself, this is small and cheap to pickle, so it can be
+    kept around in bulk or sent between processes."""
+
+    # The input problem text
+    problem: str
+    # The best expression that the swarm found
+    solution: str
+    # True if the solution is in a simplified form
+    solved: bool
+    # The (rule, node) action pairs that transform the problem into the solution
+    actions: List[Tuple[int, int]] = field(default_factory=list)
+    # The names of the rules applied by each action
+    rules: List[str] = field(default_factory=list)
+    # The number of swarm iterations that were run
+    iterations: int = 0
+    # Wall time spent searching, in seconds
+    elapsed: float = 0.0
+    # The number of walker steps taken in the environment, leaving out walkers
+    # that had already finished their episode
+    env_steps: int = 0
+    # True if the search was stopped because it ran out of time
+    timed_out: bool = False
+    # The seconds spent in each phase of the swarm iterations, if profiled
+    phase_times: Dict[str, float] = field(default_factory=dict)
+    # True if the result came from a solution cache rather than a search
+    cached: bool = False
+    # True if the result came from replaying the solution of a similar problem
+    replayed: bool = False
+
+
+def budget_deadline(time_budget_ms: Optional[int]) -> Optional[float]:
+    """Return the `time.time()` timestamp at which a budget that starts now
+    runs out, or None if there is no budget."""
+    if time_budget_ms is None:
+        return None
+    return time.time() + time_budget_ms / 1000.0
+
+
+def problem_deadline(
+    config: SwarmConfig, deadline: Optional[float] = None
+) -> Optional[float]:
+    """Return the deadline for a problem that starts now, which is the earlier of
+    its own time budget and the given (batch) deadline."""
+    budget = budget_deadline(config.time_budget_ms)
+    deadlines = [d for d in (budget, deadline) if d is not None]
+    return min(deadlines) if deadlines else None
+
+
+class SearchDeadline:
+    """A `should_stop` callback for `run_swarm` that stops the search once the
+    deadline passes, or when the wrapped `should_stop` callback returns True."""
+
+    timed_out: bool
+
+    def __init__(
+        self,
+        deadline: Optional[float],
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        self.deadline = deadline
+        self.should_stop = should_stop
+        self.timed_out = False
+
+    def __call__(self) -> bool:
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.timed_out = True
+            return True
+        return self.should_stop is not None and self.should_stop()
+
+
+def run_swarm(swarm: Swarm, should_stop: Optional[Callable[[], bool]] = None) -> None:
+    """Run a new search process with a swarm, like `Swarm.run`, but call
+    `should_stop` between iterations and stop the search when it returns True."""
+    swarm.reset()
+    for _ in swarm.get_run_loop():
+        if swarm.calculate_end_condition():
+            break
+        if should_stop is not None and should_stop():
+            break
+        swarm.run_step()
+        swarm.increment_epoch()
+
+
+class SwarmSolver:
+    """A swarm that is kept alive to solve many problems one after another.
+
+    Building a swarm creates its envs (and with `use_mp` starts their worker
+    processes), so reusing one saves that startup cost for every problem after
+    the first. Each problem is sent to all of the envs before the swarm is
+    reset. Call `close` to stop any worker processes when you're done."""
+
+    config: SwarmConfig
+    swarm: Swarm
+    mathy_env: MathyEnv
+    profiler: Optional[SwarmProfiler]
+    metrics: Optional[SwarmMetrics]
+
+    def __init__(self, config: SwarmConfig):
+        self.config = config
+        self.swarm = mathy_swarm(
+            config,
+            lambda: FragileMathyEnv(
+                name="mathy_v0", repeat_problem=True, **swarm_env_kwargs(config)
+            ),
+        )
+        self.mathy_env = self.swarm.env._env._env.mathy
+        self.env_steps = 0
+        self._count_env_steps()
+        self.profiler = None
+        if config.profile or config.profile_trace is not None:
+            self.profiler = SwarmProfiler(keep_events=config.profile_trace is not None)
+            self.profiler.instrument(self.swarm)
+        self.metrics = None
+        if config.metrics:
+            self.metrics = SwarmMetrics([rule.name for rule in self.mathy_env.rules])
+            self.metrics.instrument(self.swarm)
+
+    def _count_env_steps(self) -> None:
+        """Wrap the step of the swarm's env to count the walkers it moves."""
+        step = self.swarm.env.step
+
+        def counted_step(model_states, env_states):
+            finished = getattr(env_states, "terminals", None)
+            moving = moving_walkers(len(model_states.actions), finished)
+            self.env_steps += int(np.count_nonzero(moving))
+            return step(model_states=model_states, env_states=env_states)
+
+        self.swarm.env.step = counted_step
+
+    def set_problem(self, problem: str, max_steps: int = 256) -> None:
+        """Set the problem that the swarm starts from when it is reset."""
+        if isinstance(self.swarm.env, (ParallelEnv, SharedMemoryParallelEnv)):
+            self.swarm.env.set_problem(problem, max_steps)
+        call_worker_envs(self.swarm, "set_problem", problem, max_steps)
+
+    def solve(
+        self,
+        problem: str,
+        max_steps: int = 256,
+        silent: bool = True,
+        should_stop: Optional[Callable[[], bool]] = None,
+        deadline: Optional[float] = None,
+    ) -> SolveResult:
+        """Solve a problem in at most `max_steps` moves. See `swarm_solve` for
+        how the search is stopped early."""
+        swarm = self.swarm
+        self.set_problem(problem, max_steps)
+        if self.profiler is not None:
+            self.profiler.reset()
+        self.env_steps = 0
+        start = time.perf_counter()
+        stop_search = SearchDeadline(
+            problem_deadline(self.config, deadline), should_stop
+        )
+        if not silent:
+            with msg.loading(f"Solving {problem} ..."):
+                run_swarm(swarm, stop_search)
+        else:
+            run_swarm(swarm, stop_search)
+        elapsed = time.perf_counter() - start
+        result = get_solve_result(
+            problem,
+            swarm,
+            self.mathy_env,
+            elapsed,
+            stop_search.timed_out,
+            self.env_steps,
+        )
+        if self.metrics is not None:
+            self.metrics.record_solve(elapsed, result.solved, result.timed_out)
+            self.metrics.record_cache_stats(call_worker_envs(swarm, "cache_stats"))
+        if self.profiler is not None:
+            result.phase_times = dict(self.profiler.totals)
+            self.profiler.record("solve", start, elapsed)
+            if self.config.profile_trace is not None:
+                self.profiler.write_trace(self.config.profile_trace)
+        if not silent:
+            if result.solved:
+                last_state = swarm.env.to_env_state(swarm.walkers.states.best_state)
+                msg.good(f"Solved! {problem} = {result.solution}")
+                self.mathy_env.print_history(last_state)
+            elif result.timed_out:
+                msg.fail(f"Ran out of time, best found: {result.solution}")
+            else:
+                msg.fail(f"Failed to find a solution :(")
+            if self.config.verbose and self.config.transition_cache:
+                stats = get_transition_cache_stats(swarm)
+                msg.info(
+                    f"Transition cache: {stats['hits']} hits, "
+                    f"{stats['misses']} misses, {stats['size']} entries"
+                )
+            if self.config.verbose and result.phase_times:
+                rows = [
+                    (phase, f"{seconds * 1000:.1f}ms")
+                    for phase, seconds in result.phase_times.items()
+                ]
+                msg.table(rows, header=("Phase", "Time"), divider=True)
+        return result
+
+    def close(self) -> None:
+        """Stop the worker processes of the swarm's env, if it has any."""
+        if isinstance(self.swarm.env, (ParallelEnv, SharedMemoryParallelEnv)):
+            self.swarm.env.close()
 
 
 def swarm_solve(
@@ -213,47 +1160,438 @@ def swarm_solve(
     config: SwarmConfig,
     max_steps: Union[List[int], int] = 256,
     silent: bool = False,
-) -> Swarm:
+    should_stop: Optional[Callable[[], bool]] = None,
+    deadline: Optional[float] = None,
+    solver: Optional[SwarmSolver] = None,
+) -> Union[SolveResult, List[SolveResult]]:
+    """Solve one or more problems with a swarm and return a `SolveResult` for
+    each of them (or a single result if `problems` is a string).
+
+    Each problem is searched for at most `config.time_budget_ms`, and no search
+    continues past `deadline` (a `time.time()` timestamp). A problem that runs
+    out of time returns the best state found so far, marked unsolved.
+
+    If `solver` is given its swarm (and config) is used and left running for
+    more solves, otherwise a swarm is created for the call and released
+    (including any worker processes it started) once the problems are solved."""
     single_problem: bool = isinstance(problems, str)
     if single_problem:
         problems = [problems]
     if isinstance(max_steps, int):
-        max_steps = [max_steps] if single_problem else [max_steps] * len(problems)
+        max_steps = [max_steps] * len(problems)
     assert len(problems) > 0, "no problems to solve"
     assert len(problems) == len(max_steps)
-    assert isinstance(problems, list)
-    current_problem: str = problems.pop(0)
-    current_max_moves: int = max_steps.pop(0)
+    owns_solver = solver is None
+    if solver is None:
+        solver = SwarmSolver(config)
+    results: List[SolveResult] = []
+    try:
+        for problem, problem_max_steps in zip(problems, max_steps):
+            result = solver.solve(
+                problem,
+                problem_max_steps,
+                silent=silent,
+                should_stop=should_stop,
+                deadline=deadline,
+            )
+            results.append(result)
+    finally:
+        if owns_solver:
+            solver.close()
+    return results[0] if single_problem else results
 
-    def env_callable():
-        nonlocal current_problem, current_max_moves
-        return FragileMathyEnv(
-            name="mathy_v0",
-            problem=current_problem,
-            repeat_problem=True,
-            max_steps=current_max_moves,
+
+def replay_solution(
+    problem: str,
+    actions: List[Tuple[int, int]],
+    mathy_env: MathyEnv,
+    max_steps: int = 256,
+) -> Optional[SolveResult]:
+    """Apply a trace of (rule, node) actions to a problem, checking that each
+    one is a valid move, and return the result if the trace solves the problem
+    in at most `max_steps` moves, or None if it doesn't."""
+    start = time.perf_counter()
+    if len(actions) > max_steps:
+        return None
+    try:
+        env_state = MathyEnvState(problem=problem, max_moves=max_steps)
+        for step, (rule, node) in enumerate(actions):
+            valid_moves = mathy_env.get_valid_moves(env_state)
+            if rule >= len(valid_moves) or not 0 <= node < len(valid_moves[rule]):
+                return None
+            if not valid_moves[rule][node]:
+                return None
+            env_state, transition, _ = mathy_env.get_next_state(
+                env_state, (rule, node)
+            )
+            if is_terminal_transition(transition):
+                # Only the last move of the trace may end the episode, with a win
+                if step != len(actions) - 1 or transition.reward <= 0.0:
+                    return None
+                return SolveResult(
+                    problem=problem,
+                    solution=env_state.agent.problem,
+                    solved=True,
+                    actions=[(int(rule), int(node)) for rule, node in actions],
+                    rules=[mathy_env.rules[rule].name for rule, _ in actions],
+                    elapsed=time.perf_counter() - start,
+                    env_steps=len(actions),
+                    replayed=True,
+                )
+    except Exception:
+        # Traces from other problems can hit rule edge cases, treat them as misses
+        return None
+    return None
+
+
+def get_solve_result(
+    problem: str,
+    swarm: Swarm,
+    mathy_env: MathyEnv,
+    elapsed: float = 0.0,
+    timed_out: bool = False,
+    env_steps: int = 0,
+) -> SolveResult:
+    """Summarize the best state a swarm found for a problem."""
+    best_state = swarm.env.to_env_state(swarm.walkers.states.best_state)
+    # The first history entry is the initial problem, with no action
+    actions = [
+        (int(rule), int(node)) for _, (rule, node) in best_state.agent.history[1:]
+    ]
+    return SolveResult(
+        problem=problem,
+        solution=best_state.agent.problem,
+        solved=not timed_out and bool(swarm.walkers.best_reward > EnvRewards.WIN),
+        actions=actions,
+        rules=[mathy_env.rules[rule].name for rule, _ in actions],
+        iterations=swarm.epoch,
+        elapsed=elapsed,
+        env_steps=env_steps,
+        timed_out=timed_out,
+    )
+
+
+# Solvers kept alive in the current process by `solve_problem_cached`, keyed by
+# the JSON of their config
+_cached_solvers: Dict[str, SwarmSolver] = {}
+
+
+def solve_problem_cached(
+    problem: str,
+    config: SwarmConfig,
+    max_steps: int = 256,
+    deadline: Optional[float] = None,
+) -> SolveResult:
+    """Solve a single problem silently with a solver that stays alive in the
+    current process, so later calls with the same config skip creating a swarm.
+    This is meant for pool worker processes, which solve one problem at a time."""
+    key = config.json()
+    solver = _cached_solvers.get(key)
+    if solver is None:
+        solver = _cached_solvers[key] = SwarmSolver(config)
+    return solver.solve(problem, max_steps, deadline=deadline)
+
+
+def iter_swarm_solve(
+    problems: Iterable[str],
+    config: SwarmConfig,
+    max_steps: int = 256,
+    workers: Optional[int] = None,
+    time_budget_ms: Optional[int] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+) -> Iterator[Tuple[int, SolveResult]]:
+    """Solve independent problems across a pool of processes and yield an
+    (index, result) tuple for each one as soon as it finishes.
+
+    `time_budget_ms` bounds the wall time of the whole batch. Problems still
+    being solved when it runs out return their best state so far, and problems
+    that haven't started yet return their initial state, all marked unsolved.
+
+    Results are yielded in completion order, and `index` is the position of the
+    problem in the input. Problems are pulled from the input lazily and only a
+    few per worker are in flight at once, so memory use doesn't depend on the
+    number of problems.
+
+    Pass a `pool` to reuse its processes (and the swarms they keep alive) across
+    calls, otherwise a pool of `workers` processes is created for the call."""
+    workers = workers if workers is not None else os.cpu_count() or 1
+    worker_config = config.copy(update={"use_mp": False})
+    deadline = budget_deadline(time_budget_ms)
+    max_pending = workers * 2
+    pending: Dict[Future, int] = {}
+    inputs = iter(enumerate(problems))
+    owns_pool = pool is None
+    if pool is None:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for index, problem in inputs:
+                future = pool.submit(
+                    solve_problem_cached, problem, worker_config, max_steps, deadline
+                )
+                pending[future] = index
+                if len(pending) >= max_pending:
+                    break
+            if len(pending) == 0:
+                break
+            done: Set[Future]
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        # Drop the queued solves if the caller stopped early, so that only the
+        # ones that already started have to finish
+        for future in pending:
+            future.cancel()
+        if owns_pool:
+            pool.shutdown(wait=True)
+
+
+def swarm_solve_many(
+    problems: List[str],
+    config: SwarmConfig,
+    max_steps: int = 256,
+    workers: Optional[int] = None,
+    time_budget_ms: Optional[int] = None,
+    pool: Optional[ProcessPoolExecutor] = None,
+) -> List[SolveResult]:
+    """Solve independent problems across a pool of processes.
+
+    Each worker process runs one single-process swarm at a time, so the pool
+    (rather than each swarm) is what spreads the work over the available cores.
+    Results are returned in the same order as the input problems, and
+    `time_budget_ms` bounds the wall time of the whole batch."""
+    results: List[Optional[SolveResult]] = [None] * len(problems)
+    for index, result in iter_swarm_solve(
+        problems, config, max_steps, workers, time_budget_ms, pool
+    ):
+        results[index] = result
+    return results  # type:ignore
+
+
+class _Partition:
+    """A slice of a batched swarm's walkers and the problem it is solving."""
+
+    def __init__(self, swarm: Swarm):
+        self.swarm = swarm
+        self.index: Optional[int] = None
+        self.problem: Optional[str] = None
+        self.start = 0.0
+        self.env_steps = 0
+        self.stop_search = SearchDeadline(None)
+
+
+class BatchedSwarmSolver:
+    """Solve several problems at once with one batch of walkers.
+
+    The `config.n_walkers` walkers are split into `partitions` swarms that each
+    solve their own problem, with their own rewards, cloning and end condition,
+    but the walkers of every partition are stepped together in a single call to
+    one (possibly parallel) env. The fixed costs of an iteration, like sending a
+    batch to the worker processes, are shared by all of the problems, which
+    makes this faster than `SwarmSolver` for many small problems.
+
+    When a partition's problem ends, the partition starts on the next problem
+    right away. Walker states carry their problem, so only resetting a
+    partition needs to know which problem it is solving."""
+
+    config: SwarmConfig
+    swarms: List[Swarm]
+    mathy_env: MathyEnv
+    metrics: Optional[SwarmMetrics]
+
+    def __init__(self, config: SwarmConfig, partitions: int = 4):
+        if partitions < 1:
+            raise ValueError("partitions must be at least 1")
+        if config.n_walkers // partitions < 2:
+            raise ValueError("each partition needs at least 2 walkers")
+        if config.intern_states:
+            # Resetting a partition would clear the handles of the others
+            raise ValueError("intern_states isn't supported by batched swarms")
+        if config.profile or config.profile_trace is not None:
+            # The phases of the partitions' iterations are interleaved
+            raise ValueError("profiling isn't supported by batched swarms")
+        self.config = config
+        env_callable = mathy_swarm_env(
+            config,
+            lambda: FragileMathyEnv(
+                name="mathy_v0", repeat_problem=True, **swarm_env_kwargs(config)
+            ),
         )
+        self.env = env_callable()
+        n_walkers = config.n_walkers // partitions
+        self.swarms = [
+            build_swarm(config, lambda: self.env, n_walkers) for _ in range(partitions)
+        ]
+        # Partitions are reset in this process, even if they step in workers
+        self.reset_env: FragileMathyEnv = getattr(self.env, "_local_env", self.env)
+        self.mathy_env = self.reset_env._env._env.mathy
+        self.metrics = None
+        if config.metrics:
+            self.metrics = SwarmMetrics([rule.name for rule in self.mathy_env.rules])
 
-    mathy_env: MathyEnv = env_callable()._env._env.mathy
-    swarm: Swarm = mathy_swarm(config, env_callable)
-    while True:
-        if not silent:
-            with msg.loading(f"Solving {current_problem} ..."):
-                swarm.run()
-        else:
-            swarm.run()
+    def solve(
+        self,
+        problems: Iterable[str],
+        max_steps: int = 256,
+        should_stop: Optional[Callable[[], bool]] = None,
+        deadline: Optional[float] = None,
+    ) -> Iterator[Tuple[int, SolveResult]]:
+        """Solve problems and yield an (index, result) tuple for each one as soon
+        as it finishes, where `index` is its position in the input.
 
-        if not silent:
-            if swarm.walkers.best_reward > EnvRewards.WIN:
-                last_state = MathyEnvState.from_np(swarm.walkers.states.best_state)
-                msg.good(f"Solved! {current_problem} = {last_state.agent.problem}")
-                mathy_env.print_history(last_state)
-            else:
-                msg.fail(f"Failed to find a solution :(")
+        Each problem is searched for at most `config.time_budget_ms` and no
+        search continues past `deadline`, as with `swarm_solve`. Problems are
+        pulled from the input lazily as partitions become free."""
+        inputs = iter(enumerate(problems))
+        parts = [_Partition(swarm) for swarm in self.swarms]
+        for part in parts:
+            self._start_next(part, inputs, max_steps, should_stop, deadline)
+        while True:
+            for part in parts:
+                while part.problem is not None and self._is_done(part):
+                    yield self._finish(part)
+                    self._start_next(part, inputs, max_steps, should_stop, deadline)
+            stepping = [part for part in parts if part.problem is not None]
+            if len(stepping) == 0:
+                break
+            self._step_partitions(stepping)
+        if self.metrics is not None:
+            stats = call_worker_envs(self.swarms[0], "cache_stats")
+            self.metrics.record_cache_stats(stats)
 
-        if len(max_steps) > 0:
-            current_max_moves = max_steps.pop(0)
-            current_problem = problems.pop(0)
-        else:
-            break
-    return swarm
+    def close(self) -> None:
+        """Stop the worker processes of the shared env, if it has any."""
+        if isinstance(self.env, (ParallelEnv, SharedMemoryParallelEnv)):
+            self.env.close()
+
+    def _start_next(
+        self,
+        part: _Partition,
+        inputs: Iterator[Tuple[int, str]],
+        max_steps: int,
+        should_stop: Optional[Callable[[], bool]],
+        deadline: Optional[float],
+    ) -> None:
+        next_input = next(inputs, None)
+        if next_input is None:
+            part.index = part.problem = None
+            return
+        part.index, part.problem = next_input
+        self.reset_env.set_problem(part.problem, max_steps)
+        swarm = part.swarm
+        swarm.reset(env_states=self.reset_env.reset(batch_size=swarm.walkers.n))
+        part.start = time.perf_counter()
+        part.env_steps = 0
+        part.stop_search = SearchDeadline(
+            problem_deadline(self.config, deadline), should_stop
+        )
+
+    def _is_done(self, part: _Partition) -> bool:
+        return part.swarm.calculate_end_condition() or part.stop_search()
+
+    def _finish(self, part: _Partition) -> Tuple[int, SolveResult]:
+        assert part.index is not None and part.problem is not None
+        elapsed = time.perf_counter() - part.start
+        result = get_solve_result(
+            part.problem,
+            part.swarm,
+            self.mathy_env,
+            elapsed,
+            part.stop_search.timed_out,
+            part.env_steps,
+        )
+        if self.metrics is not None:
+            self.metrics.record_solve(elapsed, result.solved, result.timed_out)
+        return part.index, result
+
+    def _step_partitions(self, parts: List[_Partition]) -> None:
+        """Run one iteration of each partition, like `Swarm.run_step`, with a
+        single env transition for all of their walkers."""
+        model_states: List[StatesModel] = []
+        parent_ids: List[Any] = []
+        batch: Dict[str, List[np.ndarray]] = {"states": [], "actions": [], "dt": []}
+        finished: List[np.ndarray] = []
+        for part in parts:
+            swarm = part.swarm
+            walkers = swarm.walkers
+            walkers.update_best()
+            walkers.fix_best()
+            parent_ids.append(
+                copy.deepcopy(walkers.states.id_walkers)
+                if swarm.tree is not None
+                else None
+            )
+            part_model_states = swarm.model.predict(
+                env_states=walkers.env_states,
+                model_states=walkers.model_states,
+                walkers_states=walkers.states,
+            )
+            model_states.append(part_model_states)
+            data = self.env.states_to_data(part_model_states, walkers.env_states)
+            batch["states"].append(data["states"])
+            batch["actions"].append(data["actions"])
+            batch["dt"].append(np.broadcast_to(data["dt"], (walkers.n,)))
+            terminals = getattr(walkers.env_states, "terminals", None)
+            moving = moving_walkers(walkers.n, terminals)
+            part.env_steps += int(np.count_nonzero(moving))
+            finished.append(np.logical_not(moving))
+        inputs = {name: np.concatenate(values) for name, values in batch.items()}
+        step_start = time.perf_counter()
+        transitions = self.env.make_transitions(**inputs)
+        if self.metrics is not None:
+            self.metrics.record_step(
+                inputs["actions"],
+                transitions["oobs"],
+                transitions["terminals"],
+                self.swarms[0].model.n_actions,
+                time.perf_counter() - step_start,
+                np.concatenate(finished),
+                self.env,
+            )
+        start = 0
+        for part, part_model_states, parents in zip(parts, model_states, parent_ids):
+            swarm = part.swarm
+            end = start + swarm.walkers.n
+            # The transition arrays are reused by the next step, so copy slices
+            env_states = self.env.states_from_data(
+                swarm.walkers.n,
+                **{
+                    name: np.array(values[start:end])
+                    for name, values in transitions.items()
+                },
+            )
+            start = end
+            swarm.walkers.update_states(
+                env_states=env_states, model_states=part_model_states
+            )
+            swarm.update_tree(parents)
+            swarm.balance_and_prune()
+            swarm.walkers.fix_best()
+            swarm.increment_epoch()
+
+
+def swarm_solve_batched(
+    problems: List[str],
+    config: SwarmConfig,
+    max_steps: int = 256,
+    partitions: int = 4,
+    deadline: Optional[float] = None,
+    solver: Optional[BatchedSwarmSolver] = None,
+) -> List[SolveResult]:
+    """Solve problems `partitions` at a time with one batched swarm (see
+    `BatchedSwarmSolver`) and return their results in the input order.
+
+    If `solver` is given it is used (and left running), otherwise one is created
+    for the call and closed once the problems are solved."""
+    owns_solver = solver is None
+    if solver is None:
+        solver = BatchedSwarmSolver(config, partitions)
+    results: List[Optional[SolveResult]] = [None] * len(problems)
+    try:
+        for index, result in solver.solve(problems, max_steps, deadline=deadline):
+            results[index] = result
+    finally:
+        if owns_solver:
+            solver.close()
+    return results  # type:ignore
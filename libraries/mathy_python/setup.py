@@ -40,7 +40,7 @@ def setup_package():
         long_description_content_type="text/markdown",
         keywords="math",
         install_requires=REQUIRED_MODULES,
-        packages=find_packages(),
+        packages=find_packages(exclude=("benchmarks", "benchmarks.*")),
         extras_require=extras,
         package_data={"mathy": ["tests/api/*.json", "tests/rules/*.json"]},
         entry_points="""
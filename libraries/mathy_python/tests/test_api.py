@@ -1,5 +1,9 @@
+import asyncio
+import time
+
 import pytest
 from mathy.api import Mathy, MathyAPISwarmState
+from mathy.solver import SolveResult, SwarmConfig
 
 
 def test_api_mathy_constructor():
@@ -9,3 +13,92 @@ def test_api_mathy_constructor():
     # Config must be a known pydantic config
     with pytest.raises(ValueError):
         Mathy(config={})  # type:ignore
+
+
+def test_api_mathy_simplify_many():
+    mathy = Mathy(config=SwarmConfig(max_iters=10))
+    problems = ["4x + 2x", "2y + 3y", "7z - 2z"]
+    results = mathy.simplify_many(problems=problems, workers=2)
+    assert [r.problem for r in results] == problems
+    assert all(isinstance(r, SolveResult) for r in results)
+    assert results[0].solution == "6x"
+
+
+def test_api_mathy_iter_simplify():
+    mathy = Mathy(config=SwarmConfig(max_iters=10))
+    problems = ["4x + 2x", "2y + 3y", "7z - 2z"]
+    results = dict(mathy.iter_simplify(problems=iter(problems), workers=2))
+    assert sorted(results.keys()) == [0, 1, 2]
+    for index, result in results.items():
+        assert result.problem == problems[index]
+
+
+def test_api_mathy_asimplify():
+    mathy = Mathy(config=SwarmConfig(max_iters=10, use_mp=False), max_concurrency=2)
+    problems = ["4x + 2x", "2y + 3y", "7z - 2z"]
+
+    async def run():
+        single = await mathy.asimplify(problem="4x + 2x")
+        many = await mathy.asimplify_many(problems=problems)
+        return single, many
+
+    try:
+        single, many = asyncio.run(run())
+    finally:
+        mathy.close()
+    assert single.solution == "6x"
+    assert [r.problem for r in many] == problems
+
+
+def test_api_mathy_concurrent_solvers_run_in_process():
+    with Mathy(config=SwarmConfig(max_iters=10), max_concurrency=2) as mathy:
+        problems = ["4x + 2x", "2y + 3y"]
+        results = asyncio.run(mathy.asimplify_many(problems=problems))
+        assert [r.solution for r in results] == ["6x", "5y"]
+        assert len(mathy._solvers) > 0
+        assert not any(solver.config.use_mp for solver in mathy._solvers)
+
+
+def test_api_mathy_asimplify_cancel():
+    mathy = Mathy(config=SwarmConfig(max_iters=10000, use_mp=False), max_concurrency=1)
+
+    async def run():
+        problem = "4x + 2y + 3x^2 + 7z - 2x + 6y^2 + 2z + 3x + 8x^2"
+        task = asyncio.ensure_future(mathy.asimplify(problem=problem))
+        await asyncio.sleep(0.5)
+        start = time.time()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The swarm stopped and released its slot, so another solve can run
+        result = await mathy.asimplify(problem="4x + 2x", max_steps=32)
+        return time.time() - start, result
+
+    try:
+        elapsed, result = asyncio.run(run())
+    finally:
+        mathy.close()
+    assert result.problem == "4x + 2x"
+    assert elapsed < 30.0
+
+
+def test_api_mathy_simplify_many_time_budget():
+    mathy = Mathy(config=SwarmConfig(max_iters=10000))
+    problems = ["4x + 2y + 3x^2 + 7z - 2x + 6y^2 + 2z + 3x + 8x^2"] * 3
+    start = time.time()
+    results = mathy.simplify_many(problems=problems, workers=1, time_budget_ms=1000)
+    assert time.time() - start < 30.0
+    assert all(r.timed_out and not r.solved for r in results)
+
+
+def test_api_mathy_reuses_solvers():
+    with Mathy(config=SwarmConfig(max_iters=10, use_mp=False)) as mathy:
+        assert mathy.simplify(problem="4x + 2x").solution == "6x"
+        solver = mathy._get_solver()
+        assert mathy.simplify(problem="2y + 3y").solution == "5y"
+        assert mathy._get_solver() is solver
+        mathy.simplify_many(problems=["4x + 2x"], workers=1)
+        pool = mathy._pool
+        mathy.simplify_many(problems=["2y + 3y"], workers=1)
+        assert pool is not None and mathy._pool is pool
+    assert mathy._pool is None and mathy._solvers == []
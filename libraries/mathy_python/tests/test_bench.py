@@ -0,0 +1,54 @@
+import copy
+
+from mathy.bench import bench_corpus, compare_bench, run_bench, summarize_results
+from mathy.solver import SolveResult, SwarmConfig
+
+
+def test_bench_corpus_is_seeded():
+    corpus = bench_corpus(("poly", "binomial"), number=3, seed=7)
+    assert len(corpus) == 6
+    assert [env for env, _ in corpus] == ["poly"] * 3 + ["binomial"] * 3
+    assert corpus == bench_corpus(("poly", "binomial"), number=3, seed=7)
+    # Each environment's problems don't depend on the others in the corpus
+    assert bench_corpus(("binomial",), number=3, seed=8) == corpus[3:]
+
+
+def test_bench_summarize_results():
+    results = [
+        SolveResult("4x + 2x", "6x", True, iterations=2, elapsed=0.1, env_steps=100),
+        SolveResult("y + y", "y + y", False, iterations=4, elapsed=0.3, env_steps=300),
+    ]
+    stats = summarize_results(results)
+    assert stats["problems"] == 2
+    assert stats["solved"] == 1
+    assert stats["solve_rate"] == 0.5
+    assert stats["iterations"]["max"] == 4
+    assert stats["env_steps"] == 400
+    assert abs(stats["env_steps_per_second"] - 1000.0) < 1e-6
+    assert abs(stats["latency_ms"]["p50"] - 200.0) < 1e-6
+
+
+def test_bench_run_and_compare():
+    corpus = bench_corpus(("poly",), number=2)
+    config = SwarmConfig(use_mp=False, n_walkers=64, max_iters=20)
+    report = run_bench(corpus, config, max_steps=20)
+    assert report["total"]["problems"] == 2
+    assert set(report["environments"].keys()) == {"poly"}
+    assert compare_bench(report, report) == []
+
+    better = copy.deepcopy(report)
+    better["total"]["solve_rate"] = report["total"]["solve_rate"] + 0.5
+    better["total"]["env_steps_per_second"] *= 2
+    regressions = compare_bench(report, better)
+    assert len(regressions) == 2
+    assert any("solve rate" in r for r in regressions)
+    assert any("env steps per second" in r for r in regressions)
+
+
+def test_bench_solves_each_environment_with_its_rules():
+    corpus = bench_corpus(("binomial", "complex"), number=2)
+    config = SwarmConfig(use_mp=False, n_walkers=64, max_iters=20)
+    report = run_bench(corpus, config, max_steps=20)
+    assert set(report["environments"].keys()) == {"binomial", "complex"}
+    for stats in report["environments"].values():
+        assert stats["solve_rate"] == 1.0
@@ -0,0 +1,21 @@
+from benchmarks import BENCHMARKS, compare_benchmarks, run_benchmarks
+
+
+def test_benchmarks_run():
+    names = ["to_np", "parse", "env_step", "step_batch[16]", "mathy_dist[16]"]
+    results = run_benchmarks(names, repeat=1, number=1)
+    assert [result["name"] for result in results] == names
+    for result in results:
+        assert result["best_us"] > 0
+        assert result["ops_per_second"] > 0
+
+
+def test_benchmarks_all_set_up():
+    for name, setup in BENCHMARKS.items():
+        assert callable(setup()), name
+
+
+def test_benchmarks_compare():
+    baseline = [{"name": "parse", "best_us": 100.0}, {"name": "gone", "best_us": 1}]
+    results = [{"name": "parse", "best_us": 150.0}, {"name": "new", "best_us": 1}]
+    assert compare_benchmarks(results, baseline) == {"parse": 1.5}
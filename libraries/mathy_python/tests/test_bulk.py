@@ -0,0 +1,54 @@
+import io
+import json
+
+from mathy.bulk import ResultWriter, finished_problems, iter_problems, simplify_file
+from mathy.solver import SolveResult, SwarmConfig
+
+
+def test_bulk_iter_problems():
+    lines = ["4x + 2x\n", "\n", "# a comment\n", "  2y + 3y  \n", "7k + k"]
+    assert list(iter_problems(lines)) == [(1, "4x + 2x"), (4, "2y + 3y"), (5, "7k + k")]
+    assert list(iter_problems(lines, skip={"2y + 3y"})) == [
+        (1, "4x + 2x"),
+        (5, "7k + k"),
+    ]
+
+
+def test_bulk_result_writer_buffers():
+    stream = io.StringIO()
+    writer = ResultWriter(stream, flush_every=2, flush_seconds=3600)
+    writer.write(SolveResult("4x + 2x", "6x", True), line=1)
+    assert stream.getvalue() == ""
+    writer.write(SolveResult("2y + 3y", "5y", True), line=2)
+    rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(row["problem"], row["line"]) for row in rows] == [
+        ("4x + 2x", 1),
+        ("2y + 3y", 2),
+    ]
+    assert writer.written == 2
+
+
+def test_bulk_finished_problems_truncates_partial_line(tmpdir):
+    path = str(tmpdir / "results.jsonl")
+    assert finished_problems(path) == set()
+    with open(path, "w") as file:
+        file.write(json.dumps({"problem": "4x + 2x"}) + "\n")
+        file.write("not json\n")
+        file.write('{"problem": "2y')
+    assert finished_problems(path) == {"4x + 2x"}
+    with open(path) as file:
+        assert file.read().endswith("not json\n")
+
+
+def test_bulk_simplify_file_resume(tmpdir):
+    path = str(tmpdir / "results.jsonl")
+    config = SwarmConfig(use_mp=False, n_walkers=64, max_iters=20)
+    counts = simplify_file(config, ["4x + 2x\n", "2y + 3y\n"], path, workers=1)
+    assert counts == {"solved": 2, "unsolved": 0, "skipped": 0}
+    lines = ["4x + 2x\n", "2y + 3y\n", "7k + k\n"]
+    counts = simplify_file(config, lines, path, workers=1, resume=True)
+    assert counts == {"solved": 1, "unsolved": 0, "skipped": 2}
+    with open(path) as file:
+        rows = [json.loads(line) for line in file]
+    assert sorted(row["problem"] for row in rows) == ["2y + 3y", "4x + 2x", "7k + k"]
+    assert {row["problem"]: row["line"] for row in rows}["7k + k"] == 3
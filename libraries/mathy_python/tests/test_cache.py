@@ -0,0 +1,156 @@
+import multiprocessing
+
+from fragile.core.utils import random_state
+from mathy.api import Mathy
+from mathy.cache import (
+    SolutionCache,
+    cache_key,
+    normalize_problem,
+    problem_template,
+    template_key,
+)
+from mathy.solver import SolveResult, SwarmConfig
+
+
+def solved(problem: str, solution: str = "6x") -> SolveResult:
+    return SolveResult(problem, solution, True, actions=[(3, 1)], rules=["Factor"])
+
+
+def test_cache_normalize_problem():
+    assert normalize_problem("4x+2x") == normalize_problem("4x + 2x")
+    assert normalize_problem("4x  +   ") == "4x +"
+    config = SwarmConfig()
+    assert cache_key("4x+2x", config, 20) == cache_key("4x + 2x", config, 20)
+    assert cache_key("4x+2x", config, 20) != cache_key("4x + 2x", config, 21)
+    other = SwarmConfig(n_walkers=64)
+    assert cache_key("4x+2x", config, 20) != cache_key("4x+2x", other, 20)
+    # Options that don't change the search share entries
+    same = SwarmConfig(use_mp=False, verbose=True)
+    assert cache_key("4x+2x", config, 20) == cache_key("4x+2x", same, 20)
+
+
+def test_cache_put_get(tmpdir):
+    config = SwarmConfig()
+    cache = SolutionCache(str(tmpdir / "cache.db"))
+    try:
+        assert cache.get("4x + 2x", config) is None
+        cache.put(solved("4x + 2x"), config)
+        cache.put(SolveResult("2x + y", "2x + y", False), config)
+        assert len(cache) == 1
+        result = cache.get("4x+2x", config)
+        assert result is not None
+        assert result.cached and result.solved
+        assert result.problem == "4x+2x"
+        assert result.solution == "6x"
+        assert result.actions == [(3, 1)]
+        assert result.rules == ["Factor"]
+        assert cache.get("4x + 2x", config, max_steps=10) is None
+    finally:
+        cache.close()
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    config = SwarmConfig()
+    cache = SolutionCache(str(tmpdir / "cache.db"), max_entries=2)
+    try:
+        cache.put(solved("x + x"), config)
+        cache.put(solved("y + y"), config)
+        assert cache.get("x + x", config) is not None
+        cache.put(solved("z + z"), config)
+        assert len(cache) == 2
+        assert cache.get("y + y", config) is None
+        assert cache.get("x + x", config) is not None
+        assert cache.get("z + z", config) is not None
+    finally:
+        cache.close()
+
+
+def _put_problems(path: str, offset: int):
+    cache = SolutionCache(path)
+    config = SwarmConfig()
+    for i in range(25):
+        cache.put(solved(f"{i + offset}x + x", f"{i + offset + 1}x"), config)
+    cache.close()
+
+
+def test_cache_shared_between_processes(tmpdir):
+    path = str(tmpdir / "cache.db")
+    SolutionCache(path).close()
+    processes = [
+        multiprocessing.Process(target=_put_problems, args=(path, i * 100))
+        for i in range(3)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    cache = SolutionCache(path)
+    try:
+        assert len(cache) == 75
+        result = cache.get("201x + x", SwarmConfig())
+        assert result is not None and result.solution == "202x"
+    finally:
+        cache.close()
+
+
+def test_cache_mathy_simplify(tmpdir):
+    config = SwarmConfig(
+        use_mp=False, n_walkers=64, solution_cache=str(tmpdir / "cache.db")
+    )
+    with Mathy(config=config, silent=True) as mt:
+        first = mt.simplify(problem="4x + 2x", max_steps=10)
+        assert first.solved and not first.cached
+    # A new instance answers from the cache without creating a swarm
+    with Mathy(config=config, silent=True) as mt:
+        second = mt.simplify(problem="4x + 2x", max_steps=10)
+        assert second.cached
+        assert second.solution == first.solution
+        assert second.actions == first.actions
+        assert mt._solvers == []
+
+
+def test_cache_problem_template():
+    assert problem_template("4x + 2x") == problem_template("7y + 3y")
+    assert problem_template("4x + 2y") == problem_template("3b + 9a")
+    assert problem_template("4x + 2x") != problem_template("4x + 2y")
+    # Exponents decide which terms are alike
+    assert problem_template("x^2 + x^2") != problem_template("x^2 + x^3")
+    assert problem_template("4x++") is None
+    config = SwarmConfig()
+    assert template_key("4x + 2x", config, 20) == template_key("7y + 3y", config, 20)
+    assert template_key("4x + 2x", config, 20) != template_key("7y + 3y", config, 9)
+
+
+def test_cache_template_traces(tmpdir):
+    config = SwarmConfig()
+    cache = SolutionCache(str(tmpdir / "cache.db"))
+    try:
+        assert cache.get_trace("7y + 3y", config) is None
+        cache.put(solved("4x + 2x"), config)
+        assert cache.get_trace("7y + 3y", config) == [(3, 1)]
+        assert cache.get_trace("7y + 3z", config) is None
+        cache.clear()
+        assert cache.get_trace("7y + 3y", config) is None
+    finally:
+        cache.close()
+
+
+def test_cache_mathy_simplify_replays_templates(tmpdir):
+    config = SwarmConfig(
+        use_mp=False, n_walkers=64, solution_cache=str(tmpdir / "cache.db")
+    )
+    # The order of the solution's terms depends on the path the swarm finds
+    random_state.seed(1337)
+    with Mathy(config=config, silent=True) as mt:
+        first = mt.simplify(problem="4x + 2y + 3x + 7y", max_steps=20)
+        assert first.solved
+    with Mathy(config=config, silent=True) as mt:
+        replayed = mt.simplify(problem="9b + 2a + 3b + 5a", max_steps=20)
+        assert replayed.solved and replayed.replayed
+        assert replayed.actions == first.actions
+        assert replayed.solution == "12b + 7a"
+        assert mt._solvers == []
+        # The replayed problem is then cached exactly
+        again = mt.simplify(problem="9b + 2a + 3b + 5a", max_steps=20)
+        assert again.cached
@@ -65,3 +65,51 @@ def test_cli_simplify_swarm(use_mp: bool):
         args.append("--single-process")
     result = runner.invoke(cli, args)
     assert result.exit_code == 0
+
+
+def test_cli_bench(tmpdir):
+    runner = CliRunner()
+    report = str(tmpdir / "report.json")
+    args = ["bench", "--env=poly", "--number=2", "--single-process"]
+    result = runner.invoke(cli, args + ["--num-walkers=64", f"--output={report}"])
+    assert result.exit_code == 0
+    args += ["--num-walkers=64", f"--baseline={report}", "--tolerance=100"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+
+
+def test_cli_simplify_cache(tmpdir):
+    runner = CliRunner()
+    cache = str(tmpdir / "cache.db")
+    args = ["simplify", "4x + 2x", "--single-process", f"--cache={cache}"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    assert "(cached)" in result.stdout
+
+
+def test_cli_simplify_input_file(tmpdir):
+    runner = CliRunner()
+    problems = tmpdir / "problems.txt"
+    problems.write("4x + 2x\n2y + 3y\n")
+    output = str(tmpdir / "results.jsonl")
+    args = ["simplify", f"--input={problems}", f"--output={output}"]
+    args += ["--single-process", "--num-walkers=64", "--workers=1"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0
+    result = runner.invoke(cli, args + ["--resume"])
+    assert result.exit_code == 0
+    with open(output) as file:
+        assert len(file.readlines()) == 2
+    # A problem or an input file is required, but not both
+    assert runner.invoke(cli, ["simplify"]).exit_code != 0
+    assert runner.invoke(cli, args + ["4x + 2x"]).exit_code != 0
+    # Results are only written to --output for --input problems
+    result = runner.invoke(cli, ["simplify", "4x + 2x", f"--output={output}"])
+    assert result.exit_code != 0 and "--output requires an --input" in result.output
+    # Options that only apply to a single problem are rejected
+    cache = str(tmpdir / "cache.db")
+    for option in (f"--cache={cache}", "--metrics-file=m.prom", "--profile"):
+        result = runner.invoke(cli, args + [option])
+        assert result.exit_code != 0 and "can't be used with --input" in result.output
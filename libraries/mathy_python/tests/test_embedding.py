@@ -0,0 +1,31 @@
+import numpy as np
+from mathy.embedding import EMBEDDING_SIZE, SCALAR_FEATURES, TYPE_FEATURES, embed_state
+from mathy_core import ExpressionParser
+from mathy_envs import MathyEnvState
+
+
+def embed(problem: str, moves_remaining: int = 10) -> np.ndarray:
+    state = MathyEnvState(problem=problem, max_moves=10)
+    state.agent.moves_remaining = moves_remaining
+    return embed_state(ExpressionParser().parse(problem), state)
+
+
+def test_embedding_shape_and_dtype():
+    embedding = embed("4x + 2y^2 * 3 - (7z + x)")
+    assert embedding.shape == (EMBEDDING_SIZE,)
+    assert embedding.dtype == np.float32
+
+
+def test_embedding_ignores_constant_values():
+    assert np.array_equal(embed("4x + 2y"), embed("7x + 3y"))
+    assert not np.array_equal(embed("4x + 2y"), embed("4x + 2x"))
+
+
+def test_embedding_scalar_features():
+    scalars = embed("4x + 2x + 3y", moves_remaining=5)[
+        TYPE_FEATURES : TYPE_FEATURES + SCALAR_FEATURES
+    ]
+    depth, nodes, terms, like_terms, variables, constants, moves = scalars
+    assert nodes == 11 and terms == 3 and like_terms == 1
+    assert variables == 2 and constants == 3 and moves == 0.5
+    assert depth == 4
@@ -0,0 +1,100 @@
+import json
+
+import numpy as np
+from click.testing import CliRunner
+from mathy.cli import cli
+from mathy.generate import (
+    ProblemSampler,
+    SampleRecorder,
+    SeenFilter,
+    ShardWriter,
+    generate_samples,
+    load_shard,
+    read_index,
+)
+from mathy.solver import SwarmConfig, encode_state
+from mathy_envs import MathyEnvState
+
+
+def test_generate_seen_filter():
+    seen = SeenFilter(1000, error_rate=0.001)
+    keys = [f"key-{i}".encode("utf8") for i in range(1000)]
+    assert all(seen.add(key) for key in keys)
+    assert not any(seen.add(key) for key in keys)
+    unseen = sum(seen.add(f"other-{i}".encode("utf8")) for i in range(1000))
+    assert unseen > 980
+
+
+def test_generate_sample_recorder():
+    first = MathyEnvState(problem="4x + 2x", max_moves=10)
+    second = MathyEnvState(problem="2y + 3y", max_moves=10)
+    states = np.stack([encode_state(s) for s in (first, first, first, second)])
+    recorder = SampleRecorder()
+    recorder.record(
+        states,
+        np.array([1, 1, 2, 3]),
+        np.array([0.1, 0.1, 0.2, 0.3]),
+        terminals=np.array([False, False, False, True]),
+    )
+    texts, actions, rewards = recorder.samples()
+    # Repeated transitions and walkers that had already finished are left out
+    assert texts == [first.to_string()] * 2
+    assert actions.tolist() == [1, 2]
+    assert np.allclose(rewards, [0.1, 0.2])
+
+
+def test_generate_problem_sampler_environment():
+    config = SwarmConfig(use_mp=False, n_walkers=32, max_iters=5)
+    sampler = ProblemSampler("binomial", "easy", config)
+    try:
+        # The swarm searches with the rules of the problems' environment
+        mathy = sampler.solver.swarm.env._env._env.mathy
+        assert type(mathy) is type(sampler.env.mathy)
+        texts, _, _ = sampler.sample(seed=3, max_steps=20)
+        assert len(texts) > 0
+    finally:
+        sampler.solver.close()
+
+
+def test_generate_shard_writer(tmpdir):
+    for shard_format in ("npz", "npy"):
+        path = str(tmpdir / shard_format)
+        writer = ShardWriter(path, shard_size=2, shard_format=shard_format)
+        for i in range(5):
+            writer.add(f"state {i}", i, float(i))
+        # Only complete shards are in the index until the writer is closed
+        assert read_index(path)["samples"] == 4
+        writer.close()
+        index = read_index(path)
+        assert index["samples"] == 5
+        assert [shard["samples"] for shard in index["shards"]] == [2, 2, 1]
+        mmap_mode = "r" if shard_format == "npy" else None
+        arrays = load_shard(path, index["shards"][1], mmap_mode=mmap_mode)
+        assert arrays["states"].tolist() == [b"state 2", b"state 3"]
+        assert arrays["actions"].tolist() == [2, 3]
+
+
+def test_generate_samples(tmpdir):
+    path = str(tmpdir / "data")
+    config = SwarmConfig(n_walkers=32, max_iters=5)
+    index = generate_samples(
+        path, config, ["poly"], max_samples=100, shard_size=40, workers=1
+    )
+    assert index["samples"] == 100
+    assert [shard["samples"] for shard in index["shards"]] == [40, 40, 20]
+    arrays = [load_shard(path, shard) for shard in index["shards"]]
+    states = np.concatenate([a["states"] for a in arrays])
+    actions = np.concatenate([a["actions"] for a in arrays])
+    pairs = set(zip(states.tolist(), actions.tolist()))
+    assert len(pairs) == 100
+    state = MathyEnvState.from_string(states[0].decode("utf8"))
+    assert state.agent.problem
+
+
+def test_generate_cli(tmpdir):
+    path = str(tmpdir / "data")
+    args = ["generate", path, "--max-problems=2", "--num-walkers=32"]
+    result = CliRunner().invoke(cli, args + ["--max-iters=5", "--workers=1"])
+    assert result.exit_code == 0
+    with open(f"{path}/index.json") as file:
+        assert json.load(file)["problems"] == 2
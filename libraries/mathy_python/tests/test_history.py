@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pytest
+from mathy.history import SpillingHistoryTree, SpillStore, reduced_dtype
+from mathy.solver import SwarmConfig, decode_state, mathy_swarm
+
+
+def test_history_reduced_dtype():
+    assert reduced_dtype(np.dtype(np.float64)) == np.float16
+    assert reduced_dtype(np.dtype(np.float32)) == np.float16
+    assert reduced_dtype(np.dtype(np.int64)) == np.int32
+    assert reduced_dtype(np.dtype(np.uint8)) == np.uint8
+    assert reduced_dtype(np.dtype(np.bool_)) == np.bool_
+
+
+def test_history_spill_store():
+    # Each row is 8KB, so only a couple of them fit in memory
+    store = SpillStore(memory_budget_mb=0.02, full_precision=["states"])
+    rows = [np.full(1024, i, dtype=np.int64) for i in range(10)]
+    slots = [
+        store.put({"states": row, "rewards": np.float32(i)})
+        for i, row in enumerate(rows)
+    ]
+    assert len(store) == 10
+    assert store.spilled == 8
+    assert store.hot_bytes <= store.memory_budget
+    for i, slot in enumerate(slots):
+        data = store.get(slot)
+        # Values come back with the dtype they were stored with
+        assert data["states"].dtype == np.int64
+        assert np.array_equal(data["states"], rows[i])
+        assert data["rewards"].dtype == np.float32 and data["rewards"] == i
+    assert list(store.get(slots[0], ["rewards"])) == ["rewards"]
+    # Released rows are reused by later spills
+    store.release(slots[0])
+    assert slots[0] not in store and len(store) == 9
+    store.put({"states": rows[0], "rewards": np.float32(0)})
+    assert store._n_rows == 8
+    with pytest.raises(TypeError):
+        store.put({"other": object()})
+    path = store.path
+    assert os.path.isdir(path)
+    store.close()
+    assert len(store) == 0 and not os.path.exists(path)
+
+
+def test_history_spill_store_precision():
+    store = SpillStore(memory_budget_mb=0, full_precision=[])
+    slot = store.put({"rewards": np.float32(0.1), "actions": np.int64(12)})
+    data = store.get(slot)
+    assert data["rewards"].dtype == np.float32
+    assert data["rewards"] == np.float32(np.float16(0.1))
+    assert data["actions"] == 12
+    store.close()
+
+
+def test_history_spilling_tree_swarm(tmpdir):
+    names = ["states", "actions", "rewards"]
+    config = SwarmConfig(
+        use_mp=False,
+        history=True,
+        history_names=names,
+        history_memory_mb=0.1,
+        history_spill_dir=str(tmpdir),
+        history_full_precision=["states", "actions"],
+        n_walkers=32,
+        max_iters=10,
+    )
+    swarm = mathy_swarm(config)
+    swarm.env._env.set_problem("4x + 2y + 3x^2 + 7z - 2x", 10)
+    swarm.run()
+    tree = swarm.tree
+    assert isinstance(tree, SpillingHistoryTree)
+    # Pruned nodes release their data
+    assert len(tree.store) == len(tree)
+    assert tree.store.spilled > 0
+    total = 0
+    for states, actions, rewards in tree.iterate_nodes_at_random(
+        batch_size=8, names=names
+    ):
+        assert states.shape == (8, 2048) and states.dtype == np.int64
+        assert actions.shape == (8,) and rewards.dtype == np.float32
+        assert decode_state(states[0]).agent.problem
+        total += len(states)
+    assert total > 0
+    tree.close()
+    assert os.listdir(str(tmpdir)) == []
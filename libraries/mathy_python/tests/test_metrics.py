@@ -0,0 +1,107 @@
+import urllib.request
+
+import pytest
+from mathy.metrics import (
+    CACHE_REQUESTS,
+    ENV_ACTIONS,
+    ENV_STEPS,
+    REGISTRY,
+    SOLVE_SECONDS,
+    SOLVES,
+    MetricsRegistry,
+    serve_metrics,
+)
+from mathy.solver import (
+    BatchedSwarmSolver,
+    SwarmConfig,
+    SwarmSolver,
+    swarm_solve_batched,
+)
+
+
+def test_metrics_registry_prometheus_text():
+    registry = MetricsRegistry()
+    steps = registry.counter("steps_total", "Steps taken")
+    rules = registry.counter("rule_total", "Rules applied", ("rule",))
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    steps.inc(3)
+    rules.inc(rule='Say "hi"')
+    latency.observe(0.1)
+    latency.observe(5.0)
+    assert registry.counter("steps_total", "Steps taken") is steps
+    text = registry.to_prometheus()
+    assert "# TYPE steps_total counter\nsteps_total 3.0\n" in text
+    assert 'rule_total{rule="Say \\"hi\\""} 1.0' in text
+    assert 'latency_seconds_bucket{le="0.1"} 1.0' in text
+    assert 'latency_seconds_bucket{le="1.0"} 1.0' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2.0' in text
+    assert "latency_seconds_count 2.0" in text
+    assert "latency_seconds_sum 5.1" in text
+
+
+def test_metrics_registry_errors():
+    registry = MetricsRegistry()
+    counter = registry.counter("things_total", "Things", ("kind",))
+    with pytest.raises(ValueError):
+        counter.inc(-1, kind="a")
+    with pytest.raises(ValueError):
+        counter.inc(other="a")
+    with pytest.raises(ValueError):
+        registry.gauge("things_total", "Things")
+
+
+def test_metrics_write_and_serve(tmpdir):
+    registry = MetricsRegistry()
+    registry.gauge("busy_workers", "Busy workers").set(2)
+    path = str(tmpdir / "mathy.prom")
+    registry.write_prometheus(path)
+    with open(path) as file:
+        assert "busy_workers 2.0" in file.read()
+    server = serve_metrics(port=0, registry=registry)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert "busy_workers 2.0" in response.read().decode("utf8")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("use_mp", [True, False])
+def test_metrics_swarm_solver_records_metrics(use_mp: bool):
+    REGISTRY.clear()
+    config = SwarmConfig(use_mp=use_mp, n_walkers=32, max_iters=10, metrics=True)
+    solver = SwarmSolver(config)
+    try:
+        result = solver.solve("4x + 2x", max_steps=10)
+    finally:
+        solver.close()
+    # Walkers that already finished their episode aren't counted
+    assert 0 < ENV_STEPS.value() == result.env_steps
+    assert result.env_steps <= result.iterations * config.n_walkers
+    actions = sum(ENV_ACTIONS.value(rule=r.name) for r in solver.mathy_env.rules)
+    assert actions == ENV_STEPS.value()
+    assert SOLVES.value(outcome="solved") == 1
+    assert SOLVE_SECONDS.count() == 1
+    assert CACHE_REQUESTS.value(cache="parse", result="miss") > 0
+    # Disabled metrics aren't recorded
+    REGISTRY.clear()
+    solver = SwarmSolver(config.copy(update={"metrics": False}))
+    try:
+        solver.solve("4x + 2x", max_steps=10)
+    finally:
+        solver.close()
+    assert ENV_STEPS.value() == 0
+
+
+def test_metrics_batched_swarm_solver_records_metrics():
+    REGISTRY.clear()
+    config = SwarmConfig(use_mp=False, n_walkers=32, max_iters=10, metrics=True)
+    results = swarm_solve_batched(["4x + 2x", "2y + 3y"], config, 10, partitions=2)
+    assert 0 < ENV_STEPS.value() == sum(result.env_steps for result in results)
+    rules = BatchedSwarmSolver(config, partitions=2).mathy_env.rules
+    actions = sum(ENV_ACTIONS.value(rule=rule.name) for rule in rules)
+    assert actions == ENV_STEPS.value()
+    assert SOLVES.value(outcome="solved") == 2
+    with pytest.raises(ValueError):
+        BatchedSwarmSolver(config.copy(update={"profile": True}))
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from mathy.parallel import SharedArrays, SharedMemoryParallelEnv
+from mathy.solver import FragileMathyEnv, SwarmConfig, SwarmSolver
+
+
+def mathy_env() -> FragileMathyEnv:
+    return FragileMathyEnv(name="mathy_v0", problem="4x + 2x", repeat_problem=True)
+
+
+def test_parallel_shared_arrays_attach():
+    layout = {"a": ((2, 3), "<i8"), "b": ((2,), "|b1")}
+    owner = SharedArrays(layout)
+    other = SharedArrays(layout, owner.names)
+    try:
+        owner["a"][:] = 7
+        other["b"][1] = True
+        assert np.all(other["a"] == 7)
+        assert owner["b"].tolist() == [False, True]
+    finally:
+        other.close()
+        owner.close()
+
+
+def test_parallel_shared_memory_env_make_transitions():
+    env = SharedMemoryParallelEnv(env_callable=mathy_env, n_workers=3)
+    local = mathy_env()
+    try:
+        state = env.reset(batch_size=1).states[0]
+        states = np.array([state] * 5)
+        actions = np.array([387, 387, 0, 131, 0])
+        expected = {
+            key: np.copy(value)
+            for key, value in local.make_transitions(states, actions, 1).items()
+        }
+        # Run twice to step with the shared arrays that are already attached
+        for _ in range(2):
+            data = env.make_transitions(states, actions, 1)
+            for key, value in expected.items():
+                assert np.array_equal(data[key], value), key
+        assert env.call_workers("transition_cache_stats") == [{}, {}, {}]
+    finally:
+        env.close()
+
+
+def test_parallel_config_mp_backend():
+    with pytest.raises(ValueError):
+        SwarmConfig(mp_backend="carrier-pigeon")
+
+
+def test_parallel_swarm_solver_shared_memory():
+    config = SwarmConfig(max_iters=10, mp_backend="shared_memory")
+    solver = SwarmSolver(config)
+    try:
+        assert isinstance(solver.swarm.env, SharedMemoryParallelEnv)
+        assert solver.solve("4x + 2x").solution == "6x"
+        assert solver.solve("2y + 3y").solution == "5y"
+    finally:
+        solver.close()
@@ -0,0 +1,58 @@
+import json
+from typing import List
+
+import pytest
+from mathy.profiling import SWARM_PHASES, PhaseEvent, SwarmProfiler
+from mathy.solver import SwarmConfig, SwarmSolver
+
+
+def test_profiling_phase_totals_and_callbacks():
+    profiler = SwarmProfiler()
+    events: List[PhaseEvent] = []
+    profiler.add_callback(events.append)
+    with profiler.phase("sample"):
+        pass
+    profiler.record("sample", 1.0, 0.5)
+    assert [event.phase for event in events] == ["sample", "sample"]
+    assert profiler.totals["sample"] >= 0.5
+    # Events are only kept for traces when asked for
+    assert profiler.events == []
+    profiler.reset()
+    assert profiler.totals == {}
+
+
+@pytest.mark.parametrize("mp_backend", ["pipe", "shared_memory"])
+def test_profiling_swarm_solver_phase_times(mp_backend: str):
+    config = SwarmConfig(
+        n_walkers=64, max_iters=10, profile=True, mp_backend=mp_backend
+    )
+    solver = SwarmSolver(config)
+    try:
+        result = solver.solve("4x + 2y + 3x + 7y", max_steps=20)
+    finally:
+        solver.close()
+    assert result.phase_times
+    assert set(result.phase_times.keys()) <= set(SWARM_PHASES)
+    for phase in ("sample", "env_step", "distance", "clone"):
+        assert phase in result.phase_times
+    assert ("ipc" in result.phase_times) == (mp_backend == "shared_memory")
+    assert sum(result.phase_times.values()) <= result.elapsed
+
+
+def test_profiling_swarm_solver_writes_trace(tmpdir):
+    trace_path = str(tmpdir / "trace.json")
+    config = SwarmConfig(
+        use_mp=False, n_walkers=32, max_iters=5, profile_trace=trace_path
+    )
+    solver = SwarmSolver(config)
+    assert solver.profiler is not None
+    iterations: List[int] = []
+    solver.profiler.add_callback(lambda event: iterations.append(event.iteration))
+    result = solver.solve("4x + 2y + 3x + 7y", max_steps=20)
+    assert max(iterations) == result.iterations
+    with open(trace_path) as trace_file:
+        trace = json.load(trace_file)
+    events = trace["traceEvents"]
+    assert events[-1]["name"] == "solve"
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    assert {event["name"] for event in events} <= set(SWARM_PHASES) | {"solve"}
@@ -0,0 +1,125 @@
+import json
+import queue
+import threading
+import urllib.error
+import urllib.request
+from typing import Any, Dict, Tuple
+
+import pytest
+from mathy.server import SolverServer
+from mathy.solver import SwarmConfig
+
+
+def post(server: SolverServer, body: Any) -> Tuple[int, Dict[str, Any]]:
+    url = f"http://127.0.0.1:{server.address[1]}/simplify"
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf8"))
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def get(server: SolverServer, path: str) -> Tuple[int, bytes]:
+    url = f"http://127.0.0.1:{server.address[1]}{path}"
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def test_server_simplify():
+    config = SwarmConfig(use_mp=False, n_walkers=64)
+    server = SolverServer(config, port=0, workers=2, queue_size=4)
+    server.start()
+    try:
+        status, body = post(server, {"problem": "4x + 2x", "max_steps": 10})
+        assert status == 200
+        assert body["solved"] is True
+        assert body["solution"] == "6x"
+        # Both workers created their swarms before the server started
+        assert len(server.mathy._solvers) == 2
+        status, body = get(server, "/health")
+        assert status == 200
+        assert json.loads(body)["workers"] == 2
+        status, body = get(server, "/metrics")
+        assert status == 200
+        assert b'mathy_server_requests_total{status="200"}' in body
+        assert get(server, "/nope")[0] == 404
+    finally:
+        server.close()
+
+
+def test_server_start_fails_if_a_worker_fails():
+    config = SwarmConfig(use_mp=False, n_walkers=64)
+    server = SolverServer(config, port=0, workers=2)
+    calls = []
+
+    def warm_up():
+        # The second worker fails to create its swarm
+        calls.append(threading.current_thread().name)
+        if len(calls) == 2:
+            raise OSError("can't start worker processes")
+
+    server.mathy.warm_up = warm_up  # type:ignore
+    errors = []
+
+    def start():
+        try:
+            server.start()
+        except OSError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=start, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert [str(error) for error in errors] == ["can't start worker processes"]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [{}, {"problem": 4}, {"problem": "4x", "max_steps": 0}, [1, 2]],
+)
+def test_server_bad_requests(body: Any):
+    config = SwarmConfig(use_mp=False, n_walkers=16)
+    server = SolverServer(config, port=0)
+    server.start()
+    try:
+        assert post(server, body)[0] == 400
+    finally:
+        server.close()
+
+
+def test_server_time_budget():
+    config = SwarmConfig(use_mp=False, n_walkers=64, max_iters=10000)
+    server = SolverServer(config, port=0, max_time_budget_ms=200)
+    server.start()
+    try:
+        problem = "4x + 2y + 3x^2 + 7z - 2x + 6y^2 + 2z + 3x + 8x^2"
+        body = {"problem": problem, "max_steps": 100, "time_budget_ms": 60000}
+        status, result = post(server, body)
+        assert status == 200
+        # The request's budget is capped by the server's max budget
+        assert result["timed_out"] is True
+        assert result["elapsed"] < 2.0
+    finally:
+        server.close()
+
+
+def test_server_sheds_load_when_queue_is_full():
+    config = SwarmConfig(use_mp=False, n_walkers=16)
+    server = SolverServer(config, port=0, queue_size=1)
+    # Serve requests without starting the workers, so the queue stays full
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        server.submit("4x + 2x", 10, 1000)
+        with pytest.raises(queue.Full):
+            server.submit("4x + 2x", 10, 1000)
+        status, body = post(server, {"problem": "4x + 2x"})
+        assert status == 503
+        assert "error" in body
+    finally:
+        server.close()
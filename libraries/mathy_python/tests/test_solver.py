@@ -0,0 +1,438 @@
+import time
+
+import numpy as np
+import pytest
+from mathy.solver import (
+    BatchedSwarmSolver,
+    BoundedExpressionParser,
+    DiscreteMasked,
+    FragileEnvironment,
+    FragileMathyEnv,
+    LRUCache,
+    SolveResult,
+    StateStore,
+    SwarmSolver,
+    SwarmConfig,
+    TransitionCache,
+    decode_state,
+    encode_state,
+    get_transition_cache_stats,
+    mathy_swarm,
+    replay_solution,
+    sample_masked,
+    run_swarm,
+    swarm_env_kwargs,
+    swarm_solve,
+    swarm_solve_batched,
+)
+from mathy.embedding import EMBEDDING_SIZE
+from mathy_envs import MathyEnvState
+
+
+def test_solver_encode_decode_state():
+    state = MathyEnvState(problem="4x + 2x", max_moves=10)
+    codes = encode_state(state)
+    assert np.array_equal(codes, state.to_np(len(codes)))
+    assert decode_state(codes).to_string() == state.to_string()
+
+
+def test_solver_step_batch_matches_step():
+    env = FragileEnvironment(name="mathy_v0", problem="4x + 2x", repeat_problem=True)
+    state, _ = env.reset()
+    actions = np.array([3, 3, 0, 0, 3])
+    states = np.array([state] * len(actions))
+    new_states, observs, rewards, oobs, terminals, masks = env.step_batch(
+        actions=actions, states=states
+    )
+    assert new_states.shape == states.shape
+    assert len(observs) == len(rewards) == len(oobs) == len(terminals) == 5
+    assert masks.shape == (5, env.action_space.n) and masks.dtype == np.uint8
+    for i, action in enumerate(actions):
+        new_state, obs, reward, oob, info = env.step(action, states[i])
+        assert np.array_equal(new_states[i], new_state)
+        assert np.allclose(observs[i], obs)
+        assert np.array_equal(masks[i], info["mask"])
+        assert rewards[i] == np.float32(reward)
+        assert oobs[i] == oob
+        assert terminals[i] == info["done"]
+
+
+def test_solver_step_batch_skips_terminal_walkers():
+    env = FragileEnvironment(name="mathy_v0", problem="4x + 2x", repeat_problem=True)
+    out_of_moves = MathyEnvState(problem="4x + 2x", max_moves=4)
+    out_of_moves.agent.moves_remaining = 0
+    states = np.array([encode_state(out_of_moves)] * 2)
+    new_states, _, _, oobs, terminals, _ = env.step_batch(
+        actions=np.array([3, 0]), states=states
+    )
+    assert np.array_equal(new_states, states)
+    assert oobs.all() and terminals.all()
+
+
+def test_solver_state_store_interns_states():
+    store = StateStore()
+    first = store.intern(MathyEnvState(problem="4x + 2x"))
+    assert store.intern(MathyEnvState(problem="4x + 2x")) == first
+    second = store.intern(MathyEnvState(problem="6x"))
+    assert first != second and len(store) == 2
+    store.update_refs(np.array([first, first]))
+    assert store.refs(first) == 2
+    # Unreferenced states are released
+    assert len(store) == 1
+    assert store.get(first).agent.problem == "4x + 2x"
+
+
+def test_solver_step_batch_interned_states():
+    env = FragileEnvironment(
+        name="mathy_v0", problem="4x + 2x", repeat_problem=True, intern_states=True
+    )
+    state, _ = env.reset()
+    assert state.shape == (1,)
+    states = np.array([state] * 4)
+    new_states, _, _, oobs, _, _ = env.step_batch(
+        actions=np.array([387, 387, 0, 0]), states=states
+    )
+    assert new_states.shape == (4, 1)
+    assert new_states[0] == new_states[1]
+    assert env.store.refs(int(new_states[0])) == 2
+    assert env.to_env_state(new_states[0]).agent.problem == "(4 + 2) * x"
+    assert not oobs[0] and oobs[2]
+
+
+def test_solver_masks_are_separate_from_observations():
+    env = FragileMathyEnv(name="mathy_v0", problem="4x + 2x", repeat_problem=True)
+    states = env.reset(batch_size=2)
+    n_actions = env.action_space.n
+    assert states.masks.shape == (2, n_actions) and states.masks.dtype == np.uint8
+    gym_obs = env._env._env._observe(env._env._env.state)
+    assert states.observs.shape == (2, EMBEDDING_SIZE)
+    assert np.array_equal(states.masks[0], gym_obs[-n_actions:])
+    # The model only samples valid actions
+    model = DiscreteMasked(env=env)
+    model_states = model.create_new_states(batch_size=2)
+    actions = model.sample(2, model_states=model_states, env_states=states).actions
+    assert all(states.masks[i, action] == 1 for i, action in enumerate(actions))
+
+
+def problem_env(config: SwarmConfig, problem: str) -> FragileMathyEnv:
+    return FragileMathyEnv(
+        name="mathy_v0",
+        problem=problem,
+        repeat_problem=True,
+        **swarm_env_kwargs(config),
+    )
+
+
+def test_solver_swarm_masks_match_walker_states():
+    config = SwarmConfig(use_mp=False, n_walkers=32, max_iters=8)
+    swarm = mathy_swarm(config, lambda: problem_env(config, "4x + 2y + 3x + 7z"))
+    swarm.reset()
+    for _ in range(config.max_iters):
+        swarm.run_step()
+        env_states = swarm.walkers.env_states
+        for state, mask in zip(env_states.states, env_states.masks):
+            _, expected = swarm.env.observe(swarm.env.to_env_state(state))
+            assert np.array_equal(mask, expected)
+
+
+def test_solver_config_intern_states_requires_single_process():
+    with pytest.raises(ValueError):
+        SwarmConfig(use_mp=True, intern_states=True)
+    config = SwarmConfig(use_mp=False, intern_states=True, max_iters=5)
+    swarm = mathy_swarm(config, lambda: problem_env(config, "4x + 2x"))
+    run_swarm(swarm)
+    assert swarm.walkers.env_states.states.shape == (512, 1)
+
+
+def test_solver_transition_cache_lru():
+    cache = TransitionCache(max_size=2)
+    state = MathyEnvState(problem="4x + 2x")
+    value = (state, np.zeros(1), 0.0, {})
+    assert cache.get(("a", 0)) is None
+    cache.put(("a", 0), value)
+    cache.put(("b", 0), value)
+    assert cache.get(("a", 0)) is value
+    # "b" is the least recently used entry, so it is evicted
+    cache.put(("c", 0), value)
+    assert cache.get(("b", 0)) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "size": 2}
+
+
+def test_solver_step_batch_transition_cache():
+    env = FragileEnvironment(
+        name="mathy_v0",
+        problem="4x + 2x",
+        repeat_problem=True,
+        transition_cache_size=16,
+    )
+    state, _ = env.reset()
+    states = np.array([state] * 2)
+    first = [np.copy(a) for a in env.step_batch(np.array([387, 0]), states)]
+    second = env.step_batch(np.array([387, 0]), states)
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b)
+    assert env.transition_cache_stats() == {"hits": 2, "misses": 2, "size": 2}
+
+
+@pytest.mark.parametrize("use_mp", [True, False])
+def test_solver_swarm_transition_cache_stats(use_mp: bool):
+    config = SwarmConfig(use_mp=use_mp, transition_cache=True, max_iters=5)
+    swarm = mathy_swarm(config, lambda: problem_env(config, "4x + 2x + 3y - 2y"))
+    # The env (and its cache) is reused when solving the same problem again
+    run_swarm(swarm)
+    run_swarm(swarm)
+    try:
+        stats = get_transition_cache_stats(swarm)
+    finally:
+        if use_mp:
+            swarm.env.close()
+    assert stats["hits"] > 0 and stats["misses"] > 0
+
+
+def test_solver_transition_cache_ignores_history():
+    cached = FragileEnvironment(
+        name="mathy_v0", problem="4x + 2x", transition_cache_size=16
+    )
+    uncached = FragileEnvironment(name="mathy_v0", problem="4x + 2x")
+    state, _ = cached.reset()
+    # The same expression, reached by a different path with fewer moves left
+    env_state = cached.to_env_state(state)
+    env_state = env_state.get_out_state(
+        problem="4x + 2x", action=(0, 0), moves_remaining=3
+    )
+    other = cached.to_state_row(env_state)
+    for action in (387, 0):
+        cached.step(action, state)
+        new_state, obs, reward, oob, info = cached.step(action, other)
+        expected = uncached.step(action, other)
+        assert np.array_equal(new_state, expected[0])
+        assert np.allclose(obs, expected[1])
+        assert reward == expected[2] and oob == expected[3]
+        assert info["done"] == expected[4]["done"]
+        assert np.array_equal(info["mask"], expected[4]["mask"])
+    assert cached.transition_cache_stats()["hits"] == 2
+
+
+def test_solver_swarm_transition_cache_hits_within_solve():
+    config = SwarmConfig(use_mp=False, transition_cache=True, max_iters=10)
+    swarm = mathy_swarm(
+        config, lambda: problem_env(config, "4x + 2y + 3x + 7z - 2x + 6y")
+    )
+    run_swarm(swarm)
+    assert get_transition_cache_stats(swarm)["hits"] > 0
+
+
+def test_solver_swarm_solve_result():
+    config = SwarmConfig(use_mp=False, max_iters=10)
+    result = swarm_solve("4x + 2x", config, max_steps=32, silent=True)
+    assert isinstance(result, SolveResult)
+    assert result.problem == "4x + 2x"
+    assert result.solution == "6x" and result.solved
+    assert len(result.actions) == len(result.rules) > 0
+    assert result.rules[0] == "Distributive Factoring"
+    assert 0 < result.iterations <= 10
+    # Walkers that already finished their episode don't take steps
+    assert 0 < result.env_steps <= result.iterations * config.n_walkers
+    assert result.elapsed > 0.0
+    # Multiple problems return a result for each one
+    results = swarm_solve(["4x + 2x"] * 2, config, silent=True)
+    assert [r.problem for r in results] == ["4x + 2x"] * 2
+
+
+def test_solver_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache["a"] == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert list(cache.keys()) == ["a", "c"]
+
+
+def test_solver_bounded_parser_cache():
+    parser = BoundedExpressionParser(max_size=2)
+    first = parser.parse("4x + 2x")
+    assert parser.parse("4x + 2x") is first
+    parser.parse("2y")
+    parser.parse("3z")
+    assert len(parser._parse_cache) == 2
+    assert parser.parse("4x + 2x") is not first
+
+
+def test_solver_env_parse_cache_size():
+    env = FragileEnvironment(name="mathy_v0", problem="4x + 2x", parse_cache_size=8)
+    assert isinstance(env._env.mathy.parser, BoundedExpressionParser)
+    state, _ = env.reset()
+    env.step_batch(np.arange(64), np.array([state] * 64))
+    assert len(env._env.mathy.parser._parse_cache) <= 8
+    assert len(env._env.mathy.valid_actions_mask_cache) <= 8
+
+
+def test_solver_env_cache_bounds_survive_new_problems():
+    # Without a problem each reset generates a new one, which replaces the valid
+    # move caches of the env with dicts
+    config = SwarmConfig(use_mp=False, single_problem=False, parse_cache_size=8)
+    env = FragileEnvironment(name="mathy_v0", **swarm_env_kwargs(config))
+    for _ in range(3):
+        state, _ = env.reset()
+        env.step_batch(np.arange(64), np.array([state] * 64))
+        mathy = env._env.mathy
+        assert isinstance(mathy.parser, BoundedExpressionParser)
+        assert isinstance(mathy.valid_actions_mask_cache, LRUCache)
+        assert isinstance(mathy.valid_rules_cache, LRUCache)
+        assert len(mathy.valid_actions_mask_cache) <= 8
+
+
+def test_solver_swarm_solve_time_budget():
+    # A hard problem that can't be solved within the budget
+    problem = "4x + 2y + 3x^2 + 7z - 2x + 6y^2 + 2z + 3x + 8x^2"
+    config = SwarmConfig(use_mp=False, max_iters=10000, time_budget_ms=500)
+    start = time.time()
+    result = swarm_solve(problem, config, silent=True)
+    assert time.time() - start < 10.0
+    assert result.timed_out and not result.solved
+    assert 0 < result.iterations < 10000
+    # The batch deadline applies even without a per problem budget
+    config = SwarmConfig(use_mp=False, max_iters=10000)
+    result = swarm_solve(problem, config, silent=True, deadline=time.time())
+    assert result.timed_out and result.iterations == 0
+    assert result.solution == problem
+
+
+@pytest.mark.parametrize("use_mp", [True, False])
+def test_solver_swarm_solver_reuse(use_mp: bool):
+    solver = SwarmSolver(SwarmConfig(use_mp=use_mp, max_iters=10))
+    try:
+        # The same swarm (and env workers) solve each problem in turn
+        first = solver.solve("4x + 2x", max_steps=32)
+        second = solver.solve("2y + 3y", max_steps=32)
+        assert first.solution == "6x"
+        assert second.problem == "2y + 3y" and second.solution == "5y"
+    finally:
+        solver.close()
+
+
+def test_solver_swarm_solver_environment():
+    solver = SwarmSolver(SwarmConfig(use_mp=False, environment="binomial"))
+    try:
+        mathy = solver.swarm.env._env._env.mathy
+        assert type(mathy).__name__ == "BinomialDistribute"
+    finally:
+        solver.close()
+
+
+def test_solver_swarm_solve_many_problems():
+    # Each problem is sent to the envs, rather than solving the first one again
+    config = SwarmConfig(max_iters=10)
+    results = swarm_solve(["4x + 2x", "2y + 3y"], config, max_steps=32, silent=True)
+    assert [r.solution for r in results] == ["6x", "5y"]
+
+
+def test_solver_sample_masked_uniform_and_dead_rows():
+    masks = np.zeros((3, 6), dtype=np.uint8)
+    masks[0, [1, 4]] = 1
+    masks[2, 5] = 1
+    random_state = np.random.RandomState(0)
+    seen = set()
+    for _ in range(50):
+        actions = sample_masked(masks, random_state)
+        assert actions[0] in (1, 4)
+        # Rows without valid actions get action 0
+        assert actions[1] == 0 and actions[2] == 5
+        seen.add(int(actions[0]))
+    assert seen == {1, 4}
+
+
+def test_solver_sample_masked_weights():
+    masks = np.ones((1000, 4), dtype=np.uint8)
+    weights = np.array([0.0, 1.0, 0.0, 3.0])
+    actions = sample_masked(masks, np.random.RandomState(0), weights)
+    assert set(actions.tolist()) == {1, 3}
+    assert 0.65 < np.mean(actions == 3) < 0.85
+    # Rows whose valid actions all have zero weight are sampled uniformly
+    masks = np.array([[1, 0, 1, 0]], dtype=np.uint8)
+    actions = sample_masked(masks, np.random.RandomState(0), weights)
+    assert actions[0] in (0, 2)
+
+
+def test_solver_discrete_masked_rule_weights():
+    env = FragileMathyEnv(name="mathy_v0", problem="4x + 2x", repeat_problem=True)
+    n_rules = len(env._env._env.mathy.rules)
+    with pytest.raises(ValueError):
+        DiscreteMasked(env=env, rule_weights=[1.0] * (n_rules + 1))
+    with pytest.raises(ValueError):
+        SwarmConfig(rule_weights=[-1.0] * n_rules)
+    # Only the distributive factoring rule (index 3) has any weight
+    weights = [0.0] * n_rules
+    weights[3] = 1.0
+    model = DiscreteMasked(env=env, rule_weights=weights)
+    states = env.reset(batch_size=8)
+    model_states = model.create_new_states(batch_size=8)
+    actions = model.sample(8, model_states=model_states, env_states=states).actions
+    assert all(action // 128 == 3 for action in actions)
+
+
+@pytest.mark.parametrize("mp_backend", ["pipe", "shared_memory"])
+def test_solver_rule_weights_with_parallel_envs(mp_backend: str):
+    env = FragileMathyEnv(name="mathy_v0", problem="4x + 2x", repeat_problem=True)
+    weights = [0.0] * env.n_rules
+    weights[3] = 1.0
+    config = SwarmConfig(
+        use_mp=True, mp_backend=mp_backend, max_iters=10, rule_weights=weights
+    )
+    solver = SwarmSolver(config)
+    try:
+        result = solver.solve("4x + 2x", max_steps=32)
+        assert result.solution == "6x"
+        assert result.rules[0] == "Distributive Factoring"
+    finally:
+        solver.close()
+
+
+def test_solver_replay_solution():
+    from mathy_envs.envs import PolySimplify
+
+    env = PolySimplify()
+    trace = [(3, 3), (0, 1)]
+    result = replay_solution("7y + 3y", trace, env, max_steps=10)
+    assert result is not None
+    assert result.solved and result.replayed
+    assert result.solution == "10y"
+    assert result.rules == ["Distributive Factoring", "Constant Arithmetic"]
+    assert result.env_steps == 2
+    # Traces that make an invalid move, don't finish, or are too long fail
+    assert replay_solution("7y + 3z", trace, env) is None
+    assert replay_solution("7y + 3y", trace[:1], env) is None
+    assert replay_solution("7y + 3y", trace, env, max_steps=1) is None
+    assert replay_solution("7y + 3y", [(99, 0)], env) is None
+
+
+@pytest.mark.parametrize("use_mp", [True, False])
+def test_solver_swarm_solve_batched(use_mp: bool):
+    # More problems than partitions, so partitions move on to queued problems
+    problems = ["4x + 2x", "2y + 3y", "7k + k", "x * 2 + x", "3b + b"]
+    config = SwarmConfig(use_mp=use_mp, n_walkers=128, max_iters=20)
+    results = swarm_solve_batched(problems, config, max_steps=32, partitions=2)
+    assert [r.problem for r in results] == problems
+    assert [r.solution for r in results] == ["6x", "5y", "8k", "3x", "4b"]
+    assert all(r.solved for r in results)
+    # Each partition steps its own half of the walkers
+    assert all(r.env_steps == r.iterations * 64 for r in results)
+
+
+def test_solver_batched_swarm_solver_deadline():
+    problem = "4x + 2y + 3x^2 + 7z - 2x + 6y^2 + 2z + 3x + 8x^2"
+    config = SwarmConfig(use_mp=False, n_walkers=64, max_iters=10000)
+    solver = BatchedSwarmSolver(config, partitions=2)
+    try:
+        results = dict(solver.solve([problem] * 3, deadline=time.time()))
+        assert sorted(results) == [0, 1, 2]
+        assert all(r.timed_out and r.iterations == 0 for r in results.values())
+    finally:
+        solver.close()
+    with pytest.raises(ValueError):
+        BatchedSwarmSolver(config, partitions=0)
+    with pytest.raises(ValueError):
+        BatchedSwarmSolver(config, partitions=64)
+    with pytest.raises(ValueError):
+        BatchedSwarmSolver(config.copy(update={"intern_states": True}))